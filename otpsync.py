@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.4
+#!/usr/bin/env python3
 ##
 ## ONE-TIME SYNC
 ## ==============
@@ -7,26 +7,84 @@
 ## By Nicolai Lang
 ## Run as >> python3 ./otpsync.py
 
-## Modules
+## Modules (all others are imported where they are used, to keep quick syncs fast)
 import sys
 import os.path
 import os
-import imp
-import re
-from subprocess import call
-import datetime
 from os.path import expanduser
-import hashlib
-import filecmp
-import shutil
 import time
-
+import struct
+import collections
+import io
+import threading
+import contextlib
 
 #-------------------------
 # Parameters
 #-------------------------
 
-DT = 60 # time difference for newer files (sec)
+OTP_MAGIC = b'OTPSYNC\x01' # header of natively encrypted files
+OTP_FRAME = struct.Struct('>16sQI') # frame header: pad ID, pad offset, length
+OTP_BLOCK = 1 << 16 # plaintext bytes per frame
+OTP_RESERVE = 1 << 20 # pad bytes claimed at once while encrypting
+PAD_LOCK = '.otpsync/pads.lock' # lock of pad indexes and claims (below the pad folder, shared by all processes)
+PAD_CLAIMS = '.otpsync/pads.claims' # first unclaimed byte of every pad (below the pad folder, shared by all indexes)
+PAD_IDLEN = 32 # leading pad bytes reserved for the pad ID (never used for encryption)
+PAD_BLOCK = 1 << 20 # block size of pad generation reads
+PAD_NAME = "^(.+)_([0-9]{2}-[0-9]{2}-[0-9]{4}_[0-9]{2}-[0-9]{2}-[0-9]{2})\\.pad$" # pad file names
+MANIFEST_HEAD = 'OTPSYNC-MANIFEST 2' # first line of text manifests (read for migration)
+MANIFEST_MAGIC = b'OTPSYNCM' # header of binary manifests and log segments
+MANIFEST_VERSION = 1
+MANIFEST_HEADER = struct.Struct('>8sHQIQIQ') # magic, version, end of sorted records, file records, end of (unused) index, chunk records, appended records
+MANIFEST_RECORD = struct.Struct('>cI') # record kind, payload length
+MANIFEST_FILE = struct.Struct('>BQq32sI') # directory flag, size, mtime, hash, number of chunks (then chunk IDs, path)
+MANIFEST_CHUNK = struct.Struct('>16s16sII') # chunk ID, object, plaintext length, pad bytes
+MANIFEST_WRITER = struct.Struct('>QQ') # log segments: sequence number, Lamport time (then client ID)
+LOCAL_MANIFEST = '.otpsync/manifest' # manifest and chunk index of the objects in TMP
+SCAN_HEAD = 'OTPSYNC-SCAN 1' # first line of directory listing caches
+HASH_HEAD = 'OTPSYNC-HASHES 1' # first line of hash caches
+HASH_CACHE = '.otpsync/hashes' # hashes of the files of the synced directory and TMP by size and mtime
+SYNC_HEAD = 'OTPSYNC-SYNCED 1' # first line of sync states
+SYNC_STATE = '.otpsync/synced' # hash and stat of both copies of every file after the last sync
+SIG_FILE = '.otpsync/safe.sig' # size, mtime and hash of the last archive applied or pushed
+STATE_FILE = '.otpsync/state' # remote generation and hash applied last
+BACKUP_HEAD = 'OTPSYNC-VERSIONS 1' # first line of version indexes
+BACKUP_INDEX = '.versions' # versions of every path by sync generation (below BACKUP)
+BACKUP_OBJECTS = '.objects/' # contents of all versions by hash (below BACKUP)
+BACKUP_PRUNED = '.pruned' # time of the last retention pass (below BACKUP)
+BACKUP_KEEP = 100 # generations whose trees can always be restored (BACKUPKEEP)
+BACKUP_DAYS = 90 # days whose trees can always be restored (BACKUPDAYS)
+METRICS_FILE = '.otpsync/metrics' # cumulative counters of all runs (JSON)
+LOG_STATE = '.otpsync/logs' # last segment and Lamport time applied per client
+SEGMENT_HEAD = 'OTPSYNC-SEGMENT 1' # first line of text log segments (read for migration)
+CONTAINER_MAGIC = b'OTPSYNCC' # header of seekable archives
+CONTAINER_VERSION = 2 # 2: members stored as chunks with a Merkle tree
+CONTAINER_HEADER = struct.Struct('>8sHQQ') # magic, version, member index (offset, length)
+CONTAINER_MEMBER = struct.Struct('>BQq32sQQQ') # directory flag, size, mtime, hash, offset, length, pad bytes (then path)
+CONTAINER_STATE = '.otpsync/members' # member index of the seekable archive mirrored in TMP
+MERKLE_CHUNK = 1 << 18 # plaintext bytes per chunk of archive members (leaves of the Merkle tree)
+MERKLE_LEAF = struct.Struct('>32sQI') # leaf hash, encrypted length, pad bytes
+MERKLE_TREE = struct.Struct('>QQ32s') # Merkle tree of an archive: offset, length, root hash
+PIPE_DEPTH = 16 # blocks buffered between pipeline stages
+CODECS = ['none','zlib','bz2','lzma','zdict'] # codec tags of objects and archives (legacy zlib objects start with 0x78)
+ARCHIVE_MAGIC = b'OTPZ' # header of archives with a codec tag (legacy archives are gzip)
+LZMA_PRESET = 6 # preset of raw LZMA2 streams (no container overhead)
+ZDICT_SIZE = 1 << 15 # size of trained deflate dictionaries (deflate window)
+ZDICT_DIR = '.otpsync/zdicts' # decrypted dictionaries of the group
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, name length
+IN_CHANGES = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 # modify, attrib, close write, moves, create, delete
+IN_ISDIR = 0x40000000
+STAGE_SUFFIX = '.otpsync-stage' # cloud files are written under hidden staging names first
+CLOUD_WORKERS = 4 # cloud files written at the same time
+QUICK_STAMP = '.otpsync/quick' # signature of the state the last sync left behind (no-op fast path)
+BATCH_FILE = '~/.otpsync-roots' # default list of directories for batch synchronization
+BATCH_WORKERS = 8 # directories synced at the same time in batch mode
+S3_PART = 8 << 20 # bytes per part of multipart uploads and downloads
+S3_WORKERS = 8 # parallel transfers (and pooled connections) of a network store
+S3_RETRIES = 5 # retries of a failed request (exponential backoff)
+S3_BACKOFF = 0.2 # delay before the first retry (sec)
+S3_TIMEOUT = 60 # socket timeout of requests (sec)
+FICLONE = 0x40049409 # ioctl sharing the extents of another file (Linux: btrfs, xfs, ...)
 sys.dont_write_bytecode = True
     
 #-------------------------
@@ -76,6 +134,7 @@ def all_files_of(b='.'):
 
 ## Clear folder
 def clear_folder(folder):
+    import shutil
     for the_file in os.listdir(folder):
         file_path = os.path.join(folder, the_file)
         if os.path.isfile(file_path):
@@ -83,17 +142,25 @@ def clear_folder(folder):
         elif os.path.isdir(file_path):
             shutil.rmtree(file_path)
             
-## Create file tree with modification times
+## Remove files and directories of a folder that are not in paths
+def prune_folder(folder,paths):
+    import shutil
+    dirs, files = file_structure(folder)
+    for pth in files:
+        if pth not in paths:
+            os.unlink(folder+pth)
+    for pth in sorted(dirs,reverse=True):
+        if pth != '.' and pth not in paths and os.path.exists(folder+pth):
+            shutil.rmtree(folder+pth)
+
+## File index entry
+fentry = collections.namedtuple('fentry',['mtime','size','type'])
+
+## Create path-keyed file tree index with modification times
 def file_structure(folder):
-    a_files = []
-    a_dirs = []
-    regex=re.compile("^\./\.otpsync.*$")
-    for path, dirs, files in os.walk(folder):
-        if re.match(regex,path) == None:
-            a_dirs.append([os.path.relpath(path+"/",folder),mod_time(path)])
-            for file in files:
-                a_files.append([os.path.join(os.path.relpath(path,folder),file),mod_time(os.path.join(path,file))])
-    return (a_dirs,a_files)
+    t = tree(folder)
+    t.scan()
+    return (t.dirs,t.files)
 
 ## Modification times
 def mod_time(filename):
@@ -113,7 +180,15 @@ def print_help():
     out_text("push, p, -p : Push local data in cloud (overwrites remote files).")
     out_text("get, g, -g  : Get remote data (overwrites local files).")
     out_text("copy, c, -c : Copy this script into the cloud.")
-    out_text("otp, o, -o  : Generate a one-time pad via /dev/random for this client ID.")
+    out_text("otp, o, -o  : Generate a one-time pad from the entropy sources for this client ID.")
+    out_text("refill, r, -r: Keep generating pads for this client ID (background refill).")
+    out_text("watch, w, -w: Watch for changes and sync continuously (quick sync).")
+    out_text("verify, v, -v: Verify the remote archive against its Merkle tree and list files that differ.")
+    out_text("batch, m, -m: Quick sync of many directories at once (batch [-jN] [dir ...] [@file], default ~/.otpsync-roots).")
+    out_text("bench, b, -b: Benchmark the encryption engine, the tree scan and full sync cycles.")
+    out_text("versions [path]: List the versions of a file or folder in the backups (all generations without path).")
+    out_text("restore path [gen] [dest]: Restore a file or folder ('.' for all) as of a sync generation.")
+    out_text("prune: Drop old versions from the backups (BACKUPKEEP generations, BACKUPDAYS days) and free their space.")
     out_line()
     
 ## Print info
@@ -142,24 +217,2819 @@ def def_input(description,default):
         data = default
     return(str(data))
 
+## Read key = value file
+def load_info(filename):
+    if not os.path.exists(filename):
+        return({})
+    with open(filename, "rb") as cfg:
+        return(parse_info(cfg.read()))
+
+def parse_info(data):
+    import re
+    info = {}
+    regex=re.compile("^([a-zA-Z]+) = (.+)$")
+    for line in data.decode().splitlines():
+        result = re.match(regex,line)
+        if result != None:
+            info[result.group(1)] = result.group(2)
+    return(info)
+
+## Write key = value file
+def save_info(filename,info):
+    with open(filename, "w") as output:
+        for key, data in info.items():
+            output.write(key+' = '+str(data)+'\n')
+
 ## Create directory if it does not exist
 def create_dir(pth):
     if not os.path.exists(expanduser(pth)):
         os.makedirs(expanduser(pth))
         
-## Differences of nested lists
+## Differences of path indices
 def diff(a, b):
-    bnames = [item[0] for item in b]
-    return [aa[0] for aa in a if aa[0] not in bnames]
+    return [pth for pth in a if pth not in b]
 
-## Intersection of nested lists
+## Intersection of path indices
 def intsct(a, b):
-    bnames = [item[0] for item in b]
-    return [aa[0] for aa in a if aa[0] in bnames]
+    return [pth for pth in a if pth in b]
+
+
+#-------------------------
+# Tree model
+#-------------------------
+
+## In-memory model of a folder (kept up to date by sync instead of rescanning)
+class tree:
+
+    def __init__(self,folder,cache=None):
+        self.folder = folder
+        self.cache = cache
+        self.dirs = {}
+        self.files = {}
+        self.listings = {}
+        if cache != None and os.path.exists(cache):
+            with open(cache,'r') as f:
+                if f.readline() == SCAN_HEAD+'\n':
+                    for line in f:
+                        fields = line.rstrip('\n').split('\t')
+                        self.listings[fields[1]] = (int(fields[0]),[(x[0],x[1:]) for x in fields[2:]])
+
+    ## Full path of an index key
+    def path(self,pth):
+        return os.path.join(self.folder,pth)
+
+    ## Scan with os.scandir (directory listings are reused while a directory's mtime is unchanged)
+    def scan(self):
+        old = self.listings
+        self.dirs = {}
+        self.files = {}
+        self.listings = {}
+        ## Listings of directories changed in the last seconds may change again within the same mtime tick
+        settled = int((time.time()-2)*1e9)
+        queue = ['.']
+        i = 0
+        while i < len(queue):
+            rel = queue[i]
+            i += 1
+            path = self.folder if rel == '.' else self.path(rel)
+            if rel == '.otpsync':
+                continue
+            st = os.stat(path)
+            self.dirs[rel] = fentry(st.st_mtime,0,'d')
+            if rel in old and old[rel][0] == st.st_mtime_ns:
+                names = old[rel][1]
+            else:
+                names = []
+                for entry in os.scandir(path):
+                    if entry.is_dir():
+                        ## Symbolic links to directories are not followed
+                        if not entry.is_symlink():
+                            names.append(('d',entry.name))
+                    else:
+                        names.append(('f',entry.name))
+            if st.st_mtime_ns < settled:
+                self.listings[rel] = (st.st_mtime_ns,names)
+            for kind, name in names:
+                if kind == 'd':
+                    queue.append(name if rel == '.' else os.path.join(rel,name))
+                else:
+                    self.add_file(os.path.join(rel,name))
+
+    ## Add (or refresh) a file
+    def add_file(self,pth):
+        try:
+            st = os.stat(self.path(pth))
+        except FileNotFoundError:
+            return
+        self.files[pth] = fentry(st.st_mtime,st.st_size,'f')
+
+    ## Add a directory and its parents
+    def add_dir(self,pth):
+        while pth not in ['','.'] and pth not in self.dirs:
+            self.dirs[pth] = fentry(mod_time(self.path(pth)),0,'d')
+            pth = os.path.dirname(pth)
+
+    ## Remove a file or a directory with everything below it
+    def remove(self,pth):
+        self.files.pop(pth,None)
+        if pth in self.dirs:
+            prefix = pth+'/'
+            for key in [key for key in self.dirs if key == pth or key.startswith(prefix)]:
+                del self.dirs[key]
+            for key in [key for key in self.files if key.startswith(prefix)]:
+                del self.files[key]
+
+    ## Save directory listings for the next scan
+    def save(self):
+        with open(self.cache+'.new','w') as f:
+            f.write(SCAN_HEAD+'\n')
+            for rel, (mtime, names) in self.listings.items():
+                f.write('\t'.join([str(mtime),rel]+[kind+name for kind, name in names])+'\n')
+        os.replace(self.cache+'.new',self.cache)
+
+## Sync state of a file: content hash ('' if not known) and (size, mtime) of the local and the remote copy
+sentry = collections.namedtuple('sentry',['sha','local','remote'])
+
+def load_synced(filename):
+    synced = {}
+    if os.path.exists(filename):
+        with open(filename,'r') as f:
+            if f.readline() == SYNC_HEAD+'\n':
+                for line in f:
+                    sha, lsize, lmtime, rsize, rmtime, pth = line.rstrip('\n').split('\t',5)
+                    synced[pth] = sentry(sha,(int(lsize),float(lmtime)),(int(rsize),float(rmtime)))
+    return synced
+
+def save_synced(filename,synced):
+    with open(filename+'.new','w') as f:
+        f.write(SYNC_HEAD+'\n')
+        for pth, s in sorted(synced.items()):
+            f.write('\t'.join([s.sha,str(s.local[0]),repr(s.local[1]),str(s.remote[0]),repr(s.remote[1]),pth])+'\n')
+    os.replace(filename+'.new',filename)
+
+
+#-------------------------
+# One-time pad engine
+#-------------------------
+
+## XOR two byte strings of equal length in one bulk integer operation
+def xor_bytes(a, b):
+    return (int.from_bytes(a,'little') ^ int.from_bytes(b,'little')).to_bytes(len(a),'little')
+
+## Pad ID (hash of the reserved pad header)
+def pad_id(pad):
+    import hashlib
+    return hashlib.sha256(pad[:PAD_IDLEN]).digest()[:16]
+
+## Check whether an open file was encrypted by the native engine (rewinds it)
+def is_native(f):
+    native = f.read(len(OTP_MAGIC)) == OTP_MAGIC
+    f.seek(0)
+    return native
+
+## Owner ID and creation time of a pad file (<ID>_<dd-mm-YYYY_HH-MM-SS>.pad)
+def pad_owner(filename):
+    import re
+    import datetime
+    result = re.match(PAD_NAME,os.path.basename(filename))
+    if result == None:
+        return (None,None)
+    return (result.group(1),datetime.datetime.strptime(result.group(2),"%d-%m-%Y_%H-%M-%S"))
+
+## Pad index record (path, size, first unused byte, state: active/retired/missing)
+padrec = collections.namedtuple('padrec',['path','size','used','state'])
+
+## Index of all pads with their consumed range and state (stored in the onetime config directory);
+## pad bytes for encryption are claimed under a file lock in the pad folder, so no other thread, process or
+## index sharing the pads gets them
+class padbook:
+
+    def __init__(self,conf,folder):
+        import re
+        self.file = os.path.join(conf,'pads.cfg')
+        self.folder = folder
+        self.pads = {}
+        self.owners = {}
+        self.claims = {}
+        self.spare = {}
+        self.mtime = 0
+        self.floor = PAD_IDLEN
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.loaded = None
+        create_dir(conf)
+        ## Never hand out bytes that onetime may already have used
+        legacy = os.path.join(conf,'pad-records')
+        if os.path.exists(legacy):
+            with open(legacy,'r') as rec:
+                for off, length in re.findall("<offset>([0-9]+)</offset>\\s*<length>([0-9]+)</length>",rec.read()):
+                    self.floor = max(self.floor,int(off)+int(length))
+        self.refresh()
+
+    ## Hold the index for this thread and process (the index and the claims are read again if they changed)
+    @contextlib.contextmanager
+    def locked(self):
+        import fcntl
+        with self.lock:
+            if self.depth > 0:
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+                return
+            ## In a subfolder, so that the mtime of the pad folder only changes with its pads
+            create_dir(os.path.dirname(os.path.join(self.folder,PAD_LOCK)))
+            with open(os.path.join(self.folder,PAD_LOCK),'w') as lock:
+                fcntl.flock(lock,fcntl.LOCK_EX)
+                self.depth = 1
+                try:
+                    self.load()
+                    yield
+                finally:
+                    self.depth = 0
+
+    ## Read the index (if another process changed it) and the claims
+    def load(self):
+        import re
+        try:
+            st = os.stat(self.file)
+            key = (st.st_ino,st.st_mtime_ns,st.st_size)
+        except FileNotFoundError:
+            key = None
+        if key != None and key != self.loaded:
+            self.pads = {}
+            regex = re.compile("^([0-9a-f]{32}) = ([0-9]+)(?: ([0-9]+) ([a-z]+) (.+))?$")
+            with open(self.file,'r') as cfg:
+                for line in cfg:
+                    line = line.rstrip('\n')
+                    result = re.match(regex,line)
+                    if line.startswith('MTIME = '):
+                        self.mtime = int(line[8:])
+                    elif result != None and result.group(3) == None:
+                        ## Written by older versions (offset only)
+                        self.pads[bytes.fromhex(result.group(1))] = padrec('',0,int(result.group(2)),'active')
+                    elif result != None:
+                        self.pads[bytes.fromhex(result.group(1))] = padrec(result.group(5),int(result.group(3)),
+                                                                          int(result.group(2)),result.group(4))
+            self.loaded = key
+            self.sort()
+        self.claims = {}
+        claims = os.path.join(self.folder,PAD_CLAIMS)
+        if os.path.exists(claims):
+            with open(claims,'r') as f:
+                for line in f:
+                    result = re.match("^([0-9a-f]{32}) = ([0-9]+)$",line.rstrip('\n'))
+                    if result != None:
+                        self.claims[bytes.fromhex(result.group(1))] = int(result.group(2))
+
+    ## Index new pads (the pad folder is only listed when its mtime changed)
+    def refresh(self,force=False):
+        with self.locked():
+            mtime = os.stat(self.folder).st_mtime_ns
+            if not force and mtime == self.mtime and all(p.path != '' for p in self.pads.values()):
+                return
+            known = dict((p.path,pid) for pid, p in self.pads.items())
+            found = set()
+            for pth in all_files_of(self.folder):
+                if not os.path.isfile(pth) or pth.endswith(('.part','.state')) or os.path.basename(pth).startswith('.'):
+                    continue
+                size = os.path.getsize(pth)
+                pid = known.get(pth)
+                if pid == None or self.pads[pid].size != size:
+                    with open(pth,'rb') as f:
+                        head = f.read(PAD_IDLEN)
+                    if len(head) < PAD_IDLEN:
+                        continue
+                    pid = pad_id(head)
+                p = self.pads.get(pid,padrec(pth,size,0,'active'))
+                if p.state == 'missing':
+                    p = p._replace(state='active')
+                self.pads[pid] = p._replace(path=pth,size=size)
+                found.add(pid)
+            for pid, p in self.pads.items():
+                if pid not in found and p.state != 'retired':
+                    self.pads[pid] = p._replace(path='-',state='missing')
+            self.mtime = mtime
+            self.save()
+
+    ## Rebuild the per-ID queues (oldest pad first; swapped in as a whole)
+    def sort(self):
+        owners = {}
+        for pid, p in self.pads.items():
+            ID, created = pad_owner(p.path)
+            if ID != None and p.state == 'active':
+                owners.setdefault(ID,[]).append((created,pid))
+        for ID in owners:
+            owners[ID] = [pid for created, pid in sorted(owners[ID])]
+        self.owners = owners
+
+    ## Active pads of a client ID in order of use (current pad first)
+    def select(self,ID):
+        with self.lock:
+            return list(self.owners.get(ID,[]))
+
+    ## Path of a pad (None if it is not available)
+    def path(self,pid):
+        with self.lock:
+            if pid not in self.pads or self.pads[pid].state == 'missing':
+                self.refresh(True)
+            if pid not in self.pads or self.pads[pid].state == 'missing':
+                return None
+            return self.pads[pid].path
+
+    ## First unused byte of a pad
+    def offset(self,pid):
+        if pid not in self.pads:
+            return max(self.floor,self.claims.get(pid,0))
+        return max(self.floor,self.pads[pid].used,self.claims.get(pid,0),PAD_IDLEN)
+
+    ## Unused pad bytes of a client ID (as claimed by all processes)
+    def remaining(self,ID):
+        with self.locked():
+            return sum(max(0,self.pads[pid].size-self.offset(pid)) for pid in self.select(ID))
+
+    ## Mark pad bytes up to end as used (pads of other clients, after decryption)
+    def consume(self,pid,end):
+        with self.locked():
+            if end > self.offset(pid):
+                self.update(pid,used=end)
+
+    ## Claim up to n unused bytes of the current pad of a client ID (recorded in the claims before they are used,
+    ## the index follows at release); returns (pad ID, start, end), or None if all pads are used up
+    def claim(self,ID,n):
+        with self.locked():
+            ## Tails handed back behind the claims of others are used first (also of pads claimed up to the end)
+            for pid, spare in self.spare.items():
+                if len(spare) > 0 and pid in self.pads and pad_owner(self.pads[pid].path)[0] == ID:
+                    start, end = spare.pop()
+                    if end-start > n:
+                        spare.append((start+n,end))
+                        end = start+n
+                    return pid, start, end
+            for pid in self.select(ID):
+                start = self.offset(pid)
+                if start >= self.pads[pid].size:
+                    self.retire(pid)
+                    continue
+                end = min(self.pads[pid].size,start+n)
+                self.claims[pid] = end
+                self.save_claims()
+                return pid, start, end
+            return None
+
+    ## Hand back the unused tail of a claim (kept for this process; tails that end where the claims of the pad end,
+    ## once joined, are handed back to the claims) and record the claims of the pad in the index
+    def release(self,pid,pos,end):
+        with self.locked():
+            spare = self.spare.setdefault(pid,[])
+            if pos < end:
+                spare.append((pos,end))
+            claimed = frontier = self.claims.get(pid,0)
+            while True:
+                tails = [s for s in spare if s[1] == frontier]
+                if len(tails) == 0:
+                    break
+                spare.remove(tails[0])
+                frontier = tails[0][0]
+            if frontier != claimed:
+                self.claims[pid] = frontier
+                self.save_claims()
+            ## A pad retired once it was claimed up to the end is used again if a tail came back
+            if pid in self.pads and self.pads[pid].state == 'retired' and frontier < self.pads[pid].size:
+                self.update(pid,used=frontier,state='active')
+            elif pid in self.pads and self.pads[pid].used != frontier:
+                self.update(pid,used=frontier)
+
+    ## Retire an exhausted pad
+    def retire(self,pid):
+        self.update(pid,state='retired')
+
+    ## Change a pad record and store the index
+    def update(self,pid,**fields):
+        with self.locked():
+            self.pads[pid] = self.pads.get(pid,padrec('',0,0,'active'))._replace(**fields)
+            self.save()
+
+    ## Store the index
+    def save(self):
+        with open(self.file+'.new','w') as output:
+            output.write('MTIME = '+str(self.mtime)+'\n')
+            for pid, p in self.pads.items():
+                output.write(pid.hex()+' = '+str(p.used)+' '+str(p.size)+' '+p.state+' '+p.path+'\n')
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(self.file+'.new',self.file)
+        st = os.stat(self.file)
+        self.loaded = (st.st_ino,st.st_mtime_ns,st.st_size)
+        self.sort()
+
+    ## Store the claims
+    def save_claims(self):
+        claims = os.path.join(self.folder,PAD_CLAIMS)
+        with open(claims+'.new','w') as output:
+            for pid, end in sorted(self.claims.items()):
+                output.write(pid.hex()+' = '+str(end)+'\n')
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(claims+'.new',claims)
+
+## Encrypt stream src into stream dst with the pads of a client ID; returns pad bytes used
+def otp_encrypt(src,dst,book,ID):
+    ## Pad bytes are claimed in growing steps (encryptions in other threads and processes get other bytes), the
+    ## first claim is exact for short data, and the unused tail of the last claim is handed back at the end
+    import mmap
+    pid = pad = None
+    pos = end = 0
+    step = OTP_BLOCK
+    used = 0
+    dst.write(OTP_MAGIC)
+    try:
+        while True:
+            data = src.read(OTP_BLOCK)
+            if not data:
+                break
+            while len(data) > 0:
+                ## Continue seamlessly with the next claim (and pad) once the current one is used up
+                if pos == end:
+                    claim = book.claim(ID,len(data) if used == 0 and len(data) < OTP_BLOCK else step)
+                    step = min(2*step,OTP_RESERVE)
+                    if claim == None:
+                        out_text("All pads of "+ID+" are used up! Exiting...")
+                        exit(1)
+                    if claim[0] != pid:
+                        if pad != None:
+                            pad.close()
+                            pad = None
+                        pid = claim[0]
+                        with open(book.path(pid),'rb') as f:
+                            pad = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+                    pid, pos, end = claim
+                n = min(len(data),end-pos)
+                dst.write(OTP_FRAME.pack(pid,pos,n))
+                if n == len(data):
+                    dst.write(xor_bytes(data,pad[pos:pos+n]))
+                    data = b''
+                else:
+                    dst.write(xor_bytes(data[:n],pad[pos:pos+n]))
+                    data = data[n:]
+                pos += n
+                used += n
+    finally:
+        if pid != None:
+            book.release(pid,pos,end)
+        if pad != None:
+            pad.close()
+    return used
+
+## Pad indexes shared by all directories synced in this process (one per index and pad folder)
+padbooks = {}
+padbooks_lock = threading.Lock()
+
+def open_padbook(conf,folder):
+    key = (os.path.realpath(conf),os.path.realpath(folder))
+    with padbooks_lock:
+        if key not in padbooks:
+            padbooks[key] = padbook(conf,folder)
+        else:
+            padbooks[key].refresh()
+        return padbooks[key]
+
+## Decrypt stream src into stream dst with the indexed pads
+def otp_decrypt(src,dst,book):
+    import mmap
+    if src.read(len(OTP_MAGIC)) != OTP_MAGIC:
+        out_text("Unknown encryption format! Exiting...")
+        exit(1)
+    open_pads = {}
+    used = {}
+    try:
+        while True:
+            head = src.read(OTP_FRAME.size)
+            if not head:
+                break
+            pid, pos, n = OTP_FRAME.unpack(head)
+            if pid not in open_pads:
+                pth = book.path(pid)
+                if pth == None:
+                    out_text("No matching pad available! Exiting...")
+                    exit(1)
+                with open(pth,'rb') as f:
+                    open_pads[pid] = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            data = src.read(n)
+            dst.write(xor_bytes(data,open_pads[pid][pos:pos+n]))
+            used[pid] = max(used.get(pid,0),pos+n)
+    finally:
+        for pad in open_pads.values():
+            pad.close()
+        with book.locked():
+            for pid, end in used.items():
+                book.consume(pid,end)
+
+
+#-------------------------
+# Pad generation
+#-------------------------
+
+## Fill a region of a pad file from an entropy source (progress[k] counts finished blocks)
+def fill_region(fd,source,first,last,size,progress,k):
+    with open(source,'rb',buffering=0) as rng:
+        for block in range(first+progress[k],last):
+            n = min(PAD_BLOCK,size-block*PAD_BLOCK)
+            data = b''
+            while len(data) < n:
+                chunk = rng.read(n-len(data))
+                if len(chunk) == 0:
+                    raise OSError("Entropy source "+source+" ran dry")
+                data += chunk
+            os.pwrite(fd,data,block*PAD_BLOCK)
+            progress[k] += 1
+
+## Generate a pad from one or more entropy sources (resumable, renamed into place when complete)
+def make_pad(filename,size,sources):
+    part = filename+'.part'
+    state = part+'.state'
+    nblocks = (size+PAD_BLOCK-1)//PAD_BLOCK
+    ## Each source fills its own region of the preallocated file
+    regions = [(k*nblocks//len(sources),(k+1)*nblocks//len(sources)) for k in range(len(sources))]
+    progress = [0]*len(sources)
+    if os.path.exists(part) and os.path.exists(state):
+        with open(state,'r') as f:
+            fields = f.read().split()
+        if fields[:2] == [str(size),str(len(sources))]:
+            progress = [int(x) for x in fields[2:]]
+            out_text("Resuming '"+os.path.basename(filename)+"' ...")
+    fd = os.open(part,os.O_RDWR | os.O_CREAT,0o600)
+    try:
+        os.ftruncate(fd,size)
+        threads = []
+        for k, (first, last) in enumerate(regions):
+            thread = threading.Thread(target=fill_region,args=(fd,sources[k],first,last,size,progress,k),daemon=True)
+            thread.start()
+            threads.append(thread)
+        start = time.time()
+        done = sum(progress)
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.5)
+                ## Progress only counts once it is on disk
+                blocks = list(progress)
+                os.fsync(fd)
+                with open(state,'w') as f:
+                    f.write(' '.join([str(size),str(len(sources))]+[str(x) for x in blocks]))
+                rate = (sum(blocks)-done)*PAD_BLOCK/max(time.time()-start,1e-6)/1e6
+                print("\r--> {:5.1f}% of {:.0f} MB, {:.2f} MB/s ".format(100*sum(blocks)/max(nblocks,1),size/1e6,rate),
+                      end="",flush=True)
+        except KeyboardInterrupt:
+            out_text("Interrupted, run again to resume.")
+            exit(1)
+        if sum(progress) < nblocks:
+            out_text("Reading from the entropy sources failed! Exiting...")
+            exit(1)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(part,filename)
+    os.unlink(state)
+
+
+#-------------------------
+# Compression
+#-------------------------
+
+## Trained deflate dictionaries loaded so far (ID: dictionary; IDs are content hashes, so objects of any group
+## are unpacked with the right one, but each group only packs with its own, see otpsync.zdict)
+zdicts = {}
+
+## Codec that leaves the data as it is
+class nocodec:
+
+    def compress(self,data):
+        return data
+
+    def decompress(self,data):
+        return data
+
+    def flush(self):
+        return b''
+
+## Streaming compressor / decompressor of a codec (raw streams, the tag identifies the codec)
+def compressor(codec,zdict=None):
+    import zlib
+    import bz2
+    import lzma
+    if codec == 'zlib':
+        return zlib.compressobj(9,zlib.DEFLATED,-15)
+    if codec == 'zdict':
+        return zlib.compressobj(9,zlib.DEFLATED,-15,zlib.DEF_MEM_LEVEL,zlib.Z_DEFAULT_STRATEGY,zdict)
+    if codec == 'bz2':
+        return bz2.BZ2Compressor(9)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(lzma.FORMAT_RAW,filters=[{'id':lzma.FILTER_LZMA2,'preset':LZMA_PRESET}])
+    return nocodec()
+
+def decompressor(codec,zdict=None):
+    import zlib
+    import bz2
+    import lzma
+    if codec == 'zlib':
+        return zlib.decompressobj(-15)
+    if codec == 'zdict':
+        return zlib.decompressobj(-15,zdict)
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor(lzma.FORMAT_RAW,filters=[{'id':lzma.FILTER_LZMA2,'preset':LZMA_PRESET}])
+    return nocodec()
+
+## Compress data with a codec (tag, dictionary ID for zdict, stream)
+def pack(data,codec,zdict=None):
+    c = compressor(codec,zdict)
+    head = bytes([CODECS.index(codec)])
+    if codec == 'zdict':
+        head += zdict_id(zdict)
+    return head+c.compress(data)+c.flush()
+
+## Decompress packed data (or a legacy zlib object)
+def unpack(data):
+    import zlib
+    if data[:1] == b'\x78':
+        return zlib.decompress(data)
+    codec = CODECS[data[0]]
+    zdict = None
+    payload = data[1:]
+    if codec == 'zdict':
+        if data[1:9] not in zdicts:
+            out_text("Compression dictionary "+data[1:9].hex()+" is missing! Exiting...")
+            exit(1)
+        zdict = zdicts[data[1:9]]
+        payload = data[9:]
+    d = decompressor(codec,zdict)
+    return d.decompress(payload)+getattr(d,'flush',lambda: b'')()
+
+## Smallest packing of data among the allowed codecs; returns (packed, codec, size of the gzip path)
+## (gzip only applies to tar archives, objects are packed with the same deflate as zlib)
+def pack_best(data,codec='auto',zdict=None):
+    import zlib
+    baseline = len(zlib.compress(data,9))
+    if codec == 'gzip' or (codec == 'zdict' and zdict == None):
+        codec = 'zlib'
+    if codec != 'auto':
+        return pack(data,codec,zdict), codec, baseline
+    candidates = [pack(data,'none'),pack(data,'zlib')]
+    ## Already compressed or encrypted data is not worth the other codecs
+    if len(candidates[1]) < 0.98*len(candidates[0]):
+        candidates += [pack(data,'bz2'),pack(data,'lzma')]
+        if zdict != None:
+            candidates.append(pack(data,'zdict',zdict))
+    best = min(candidates,key=len)
+    return best, CODECS[best[0]], baseline
+
+## Codec for a whole archive, chosen on a sample of the files (up to 64 KiB of each, 1 MiB in total)
+def choose_codec(folder,codec='auto'):
+    if codec != 'auto':
+        return codec
+    sample = b''
+    dirs, files = file_structure(folder)
+    for pth in sorted(files):
+        with open(os.path.join(folder,pth),'rb') as f:
+            sample += f.read(1 << 16)
+        if len(sample) >= 1 << 20:
+            break
+    if len(sample) == 0:
+        return 'zlib'
+    return pack_best(sample)[1]
+
+## ID of a dictionary
+def zdict_id(zdict):
+    import hashlib
+    return hashlib.sha256(zdict).digest()[:8]
+
+## Train a deflate dictionary: fragments (at content-defined positions) shared by most samples, most common last
+def train_zdict(samples,size=ZDICT_SIZE,length=32):
+    counts = collections.Counter()
+    gear = gear_table()
+    for data in samples:
+        h = 0
+        fragments = set()
+        for i, b in enumerate(data):
+            h = ((h << 1)+gear[b]) & 0xffffffffffffffff
+            if h & (0xf << 20) == 0 and i+length < len(data):
+                fragments.add(data[i+1:i+1+length])
+        counts.update(fragments)
+    zdict = []
+    for fragment, n in counts.most_common(size//length):
+        if n > 1:
+            zdict.append(fragment)
+    return b''.join(reversed(zdict))
+
+## Stage: compress with a codec (the gzip path is run alongside to report the savings)
+def compress_stage(src,dst,codec,result):
+    import zlib
+    c = compressor(codec)
+    z = zlib.compressobj(6,zlib.DEFLATED,31)
+    result['gzip'] = 0
+    result['raw'] = result['packed'] = 0
+    dst.write(ARCHIVE_MAGIC+bytes([CODECS.index(codec)]))
+    for block in iter(lambda: src.read(OTP_BLOCK),b''):
+        result['raw'] += len(block)
+        result['gzip'] += len(z.compress(block))
+        result['packed'] += dst.write(c.compress(block))
+    result['gzip'] += len(z.flush())
+    result['packed'] += dst.write(c.flush())
+
+## Stage: decompress an archive (codec tag or legacy gzip)
+def decompress_stage(src,dst):
+    import zlib
+    head = b''
+    for block in iter(lambda: src.read(len(ARCHIVE_MAGIC)+1-len(head)),b''):
+        head += block
+        if len(head) == len(ARCHIVE_MAGIC)+1:
+            break
+    if head[:len(ARCHIVE_MAGIC)] == ARCHIVE_MAGIC:
+        d = decompressor(CODECS[head[-1]])
+    else:
+        d = zlib.decompressobj(47)
+        dst.write(d.decompress(head))
+    for block in iter(lambda: src.read(OTP_BLOCK),b''):
+        dst.write(d.decompress(block))
+    dst.write(getattr(d,'flush',lambda: b'')())
+
+
+#-------------------------
+# Object store
+#-------------------------
+
+## Manifest entry (directories have no hash and no chunks)
+mentry = collections.namedtuple('mentry',['sha','size','mtime','chunks'])
+
+## Chunk table entry (object, plaintext length, pad bytes used)
+centry = collections.namedtuple('centry',['obj','size','pad'])
+
+## Gear table (built on first use) and parameters of the content-defined chunker
+GEAR = []
+CHUNK_MIN = 1 << 11
+CHUNK_MAX = 1 << 16
+CHUNK_WINDOW = 1 << 6 # bytes hashed for a boundary (doubled in each of 6 steps)
+CHUNK_MASK = 0x1F # windows with a zero byte hash and these crc32 bits zero end a chunk (8 KiB on average)
+CHUNK_SCAN = 1 << 20 # bytes hashed at once
+CHUNK_TABLES = []
+
+## Gear table of the rolling hash
+def gear_table():
+    import hashlib
+    if len(GEAR) == 0:
+        GEAR[:] = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8],'little') for i in range(256)]
+    return GEAR
+
+## Byte permutations of the chunker (one to start, one per doubling step)
+def chunk_tables():
+    import hashlib
+    if len(CHUNK_TABLES) == 0:
+        CHUNK_TABLES[:] = [bytes(sorted(range(256),key=lambda i: hashlib.sha256(bytes([step,i])).digest()))
+                           for step in range(CHUNK_WINDOW.bit_length())]
+    return CHUNK_TABLES
+
+## Hashes of files seen in this run (path, size, mtime: hash)
+hash_cache = {}
+
+## SHA-256 of a file
+def file_hash(filename):
+    import hashlib
+    h = hashlib.sha256()
+    with open(filename,'rb') as f:
+        st = os.fstat(f.fileno())
+        for block in iter(lambda: f.read(OTP_BLOCK),b''):
+            h.update(block)
+    hash_cache[(os.path.abspath(filename),st.st_size,st.st_mtime_ns)] = h.hexdigest()
+    return h.hexdigest()
+
+## Hash of a file if it is known already (None otherwise)
+def cached_hash(filename,st):
+    return hash_cache.get((os.path.abspath(filename),st.st_size,st.st_mtime_ns))
+
+## Hash of a file (computed only if its size or mtime changed)
+def content_hash(filename):
+    return cached_hash(filename,os.stat(filename)) or file_hash(filename)
+
+## Record the hash of a file whose content is known (e.g. a copy)
+def set_hash(filename,sha):
+    st = os.stat(filename)
+    hash_cache[(os.path.abspath(filename),st.st_size,st.st_mtime_ns)] = sha
+
+## Load the hashes of earlier runs; returns the number of entries
+def load_hashes(filename):
+    if os.path.exists(filename):
+        with open(filename,'r') as f:
+            if f.readline() == HASH_HEAD+'\n':
+                for line in f:
+                    size, mtime, sha, pth = line.rstrip('\n').split('\t',3)
+                    hash_cache[(pth,int(size),int(mtime))] = sha
+    return len(hash_cache)
+
+## Save the newest hash of every existing file below the folders (only settled mtimes: an edit within the
+## same mtime tick would keep the key)
+def save_hashes(filename,folders):
+    settled = int((time.time()-2)*1e9)
+    latest = {}
+    for (pth, size, mtime), sha in list(hash_cache.items()):
+        if mtime < settled and pth.startswith(folders) and (pth not in latest or latest[pth][1] < mtime):
+            latest[pth] = (size,mtime,sha)
+    with open(filename+'.new','w') as f:
+        f.write(HASH_HEAD+'\n')
+        for pth, (size, mtime, sha) in sorted(latest.items()):
+            if os.path.isfile(pth):
+                f.write(str(size)+'\t'+str(mtime)+'\t'+sha+'\t'+pth+'\n')
+    os.replace(filename+'.new',filename)
+
+## Chunk ID
+def chunk_id(data):
+    import hashlib
+    return hashlib.sha256(data).hexdigest()[:32]
+
+## Chunks of a manifest entry
+def chunk_list(e):
+    if e.chunks == '-':
+        return []
+    return [cid for cid in e.chunks.split(',') if cid != '']
+
+## Content-defined cut positions: ends of the windows whose byte hash is zero and whose crc32 matches the mask
+## (the hashes of all windows of a block are built at once: bytes are permuted with translate and combined with
+## the window half as far ahead by xor on the whole block as one integer)
+def chunk_cuts(data):
+    import zlib
+    tables = chunk_tables()
+    cuts = []
+    view = memoryview(data)
+    for lo in range(0,len(data)-CHUNK_WINDOW+1,CHUNK_SCAN):
+        block = bytes(view[lo:lo+CHUNK_SCAN+CHUNK_WINDOW-1])
+        n = len(block)
+        last = n-CHUNK_WINDOW+1
+        h = block.translate(tables[0])
+        value = int.from_bytes(h,'little')
+        for step, table in enumerate(tables[1:]):
+            value = int.from_bytes(h.translate(table),'little') ^ (value >> (8 << step))
+            h = value.to_bytes(n,'little')
+        i = h.find(0,0,last)
+        while i >= 0:
+            if zlib.crc32(view[lo+i:lo+i+CHUNK_WINDOW]) & CHUNK_MASK == 0:
+                cuts.append(lo+i+CHUNK_WINDOW)
+            i = h.find(0,i+1,last)
+    return cuts
+
+## Split data at content-defined boundaries (the first cut after the minimum chunk size)
+def chunk_bounds(data):
+    import bisect
+    cuts = chunk_cuts(data)
+    bounds = []
+    start = 0
+    while start < len(data):
+        end = min(len(data),start+CHUNK_MAX)
+        cut = end
+        i = bisect.bisect_left(cuts,start+CHUNK_MIN)
+        if i < len(cuts) and cuts[i] < end:
+            cut = cuts[i]
+        bounds.append((start,cut))
+        start = cut
+    return bounds
+
+## Parse text manifest (F lines: files and directories, C lines: chunk table)
+def read_manifest(text):
+    lines = text.split('\n')
+    entries = {}
+    chunks = {}
+    if lines[0] == 'OTPSYNC-MANIFEST 1':
+        ## One object per file
+        for line in lines[1:]:
+            if line != '':
+                sha, size, mtime, obj, pth = line.split('\t',4)
+                entries[pth] = mentry(sha,int(size),int(mtime),obj)
+                if obj != '-':
+                    chunks[obj] = centry(obj,int(size),0)
+        return (entries,chunks)
+    if lines[0] != MANIFEST_HEAD:
+        out_text("Unknown manifest format! Exiting...")
+        exit(1)
+    for line in lines[1:]:
+        if line.startswith('F\t'):
+            sha, size, mtime, cids, pth = line[2:].split('\t',4)
+            entries[pth] = mentry(sha,int(size),int(mtime),cids)
+        elif line.startswith('C\t'):
+            cid, obj, size, pad = line[2:].split('\t')
+            chunks[cid] = centry(obj,int(size),int(pad))
+    return (entries,chunks)
+
+## Record of a binary manifest
+def pack_record(kind,payload):
+    return MANIFEST_RECORD.pack(kind,len(payload))+payload
+
+def pack_file(pth,e):
+    cids = chunk_list(e)
+    sha = b'' if e.sha == '-' else bytes.fromhex(e.sha)
+    head = MANIFEST_FILE.pack(1 if e.chunks == '-' else 0,e.size,e.mtime,sha,len(cids))
+    return pack_record(b'F',head+b''.join(bytes.fromhex(cid) for cid in cids)+pth.encode())
+
+def pack_chunk(cid,c):
+    return pack_record(b'C',MANIFEST_CHUNK.pack(bytes.fromhex(cid),bytes.fromhex(c.obj),c.size,c.pad))
+
+def unpack_file(payload):
+    isdir, size, mtime, sha, n = MANIFEST_FILE.unpack_from(payload,0)
+    pos = MANIFEST_FILE.size
+    pth = bytes(payload[pos+16*n:]).decode()
+    if isdir:
+        return pth, mentry('-',0,0,'-')
+    cids = [bytes(payload[pos+16*i:pos+16*i+16]).hex() for i in range(n)]
+    return pth, mentry(sha.hex(),size,mtime,','.join(cids))
+
+def unpack_chunk(payload):
+    cid, obj, size, pad = MANIFEST_CHUNK.unpack_from(payload,0)
+    return cid.hex(), centry(obj.hex(),size,pad)
+
+## Records between two offsets (kind, payload offset, payload); a torn last record is ignored
+def records(data,start,end):
+    pos = start
+    while pos+MANIFEST_RECORD.size <= end:
+        kind, n = MANIFEST_RECORD.unpack_from(data,pos)
+        if pos+MANIFEST_RECORD.size+n > end:
+            break
+        yield kind, pos, data[pos+MANIFEST_RECORD.size:pos+MANIFEST_RECORD.size+n]
+        pos += MANIFEST_RECORD.size+n
+
+## Binary manifest: sorted records, then appended records (later ones win)
+class manifest:
+
+    def __init__(self,data=None):
+        if data == None:
+            data = MANIFEST_HEADER.pack(MANIFEST_MAGIC,MANIFEST_VERSION,0,0,0,0,MANIFEST_HEADER.size)
+        self.data = memoryview(data)
+        ## (manifests of older versions have hash indexes between the sorted records and the tail, they are skipped)
+        magic, version, self.sorted_end, self.fcount, index, self.ccount, self.tail = MANIFEST_HEADER.unpack_from(self.data,0)
+        if magic != MANIFEST_MAGIC or version > MANIFEST_VERSION:
+            out_text("Unknown manifest format! Exiting...")
+            exit(1)
+        ## Appended records are few (they are compacted on save), so they are read right away
+        self.files = {}
+        self.chunks = {}
+        self.writer = None
+        self.appended = 0
+        self.end = self.tail
+        for kind, pos, payload in records(self.data,self.tail,len(self.data)):
+            self.appended += 1
+            self.end = pos+MANIFEST_RECORD.size+len(payload)
+            if kind == b'F':
+                pth, e = unpack_file(payload)
+                self.files[pth] = e
+            elif kind == b'D':
+                self.files[bytes(payload).decode()] = None
+            elif kind == b'C':
+                cid, c = unpack_chunk(payload)
+                self.chunks[cid] = c
+            elif kind == b'X':
+                self.chunks[bytes(payload).hex()] = None
+            elif kind == b'W':
+                seq, lamport = MANIFEST_WRITER.unpack_from(payload,0)
+                self.writer = (bytes(payload[MANIFEST_WRITER.size:]).decode(),seq,lamport)
+
+    ## All entries and the whole chunk table
+    def load(self):
+        entries = {}
+        chunks = {}
+        for kind, pos, payload in records(self.data,MANIFEST_HEADER.size,max(self.sorted_end,MANIFEST_HEADER.size)):
+            if kind == b'F':
+                pth, e = unpack_file(payload)
+                entries[pth] = e
+            elif kind == b'C':
+                cid, c = unpack_chunk(payload)
+                chunks[cid] = c
+        for table, changes in [(entries,self.files),(chunks,self.chunks)]:
+            for key, value in changes.items():
+                if value == None:
+                    table.pop(key,None)
+                else:
+                    table[key] = value
+        return (entries,chunks)
+
+## Binary manifest of entries and chunks (sorted records)
+def pack_manifest(entries,chunks):
+    out = bytearray(MANIFEST_HEADER.size)
+    for pth, e in sorted(entries.items()):
+        out += pack_file(pth,e)
+    for cid, c in sorted(chunks.items()):
+        out += pack_chunk(cid,c)
+    MANIFEST_HEADER.pack_into(out,0,MANIFEST_MAGIC,MANIFEST_VERSION,len(out),len(entries),len(out),len(chunks),len(out))
+    return bytes(out)
+
+## Entries and chunks of a manifest (binary or text)
+def parse_manifest(data):
+    if data[:len(MANIFEST_MAGIC)] == MANIFEST_MAGIC:
+        return manifest(data).load()
+    return read_manifest(data.decode())
+
+## Open a local manifest (text manifests are converted)
+def open_manifest(filename):
+    import mmap
+    if not os.path.exists(filename):
+        return manifest()
+    with open(filename,'rb') as f:
+        if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+            f.seek(0)
+            return manifest(pack_manifest(*read_manifest(f.read().decode())))
+        return manifest(mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ))
+
+## Load manifest and chunk index from a local file
+def load_manifest(filename):
+    return open_manifest(filename).load()
+
+## Save manifest and chunk index to a local file (changes are appended, compacted once they pile up)
+def save_manifest(filename,entries,chunks):
+    if os.path.exists(filename):
+        with open(filename,'rb') as f:
+            binary = f.read(len(MANIFEST_MAGIC)) == MANIFEST_MAGIC
+        if binary:
+            m = open_manifest(filename)
+            old, old_chunks = m.load()
+            changes = [pack_file(pth,e) for pth, e in sorted(entries.items()) if old.get(pth) != e]
+            changes += [pack_record(b'D',pth.encode()) for pth in sorted(old) if pth not in entries]
+            changes += [pack_chunk(cid,c) for cid, c in sorted(chunks.items()) if old_chunks.get(cid) != c]
+            changes += [pack_record(b'X',bytes.fromhex(cid)) for cid in sorted(old_chunks) if cid not in chunks]
+            if m.appended+len(changes) <= max(256,(m.fcount+m.ccount)//4):
+                end = m.end
+                m = None
+                with open(filename,'r+b') as f:
+                    ## Drop a torn record of an interrupted save
+                    f.truncate(end)
+                    f.seek(end)
+                    f.write(b''.join(changes))
+                    f.flush()
+                    os.fsync(f.fileno())
+                return
+    with open(filename+'.new','wb') as f:
+        f.write(pack_manifest(entries,chunks))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename+'.new',filename)
+
+## Manifest of a folder (files that differ from the old manifest get no chunks)
+def build_manifest(folder,old):
+    entries = {}
+    dirs, files = file_structure(folder)
+    for pth in dirs:
+        if pth != '.':
+            entries[pth] = mentry('-',0,0,'-')
+    for pth in files:
+        st = os.stat(os.path.join(folder,pth))
+        e = old.get(pth)
+        if e != None and e.size == st.st_size and e.mtime == st.st_mtime_ns:
+            entries[pth] = e
+            continue
+        sha = file_hash(os.path.join(folder,pth))
+        if e != None and e.sha == sha:
+            entries[pth] = mentry(sha,st.st_size,st.st_mtime_ns,e.chunks)
+        else:
+            entries[pth] = mentry(sha,st.st_size,st.st_mtime_ns,None)
+    return entries
+
+## Log segment (writer, sequence number, Lamport time, changed entries, deleted paths, new chunks)
+segment = collections.namedtuple('segment',['ID','seq','lamport','entries','deleted','chunks'])
+
+## Write log segment (binary manifest of appended records: writer, deleted paths, entries, chunks)
+def write_segment(seg):
+    out = [MANIFEST_HEADER.pack(MANIFEST_MAGIC,MANIFEST_VERSION,0,0,0,0,MANIFEST_HEADER.size)]
+    out.append(pack_record(b'W',MANIFEST_WRITER.pack(seg.seq,seg.lamport)+seg.ID.encode()))
+    out += [pack_record(b'D',pth.encode()) for pth in sorted(seg.deleted)]
+    out += [pack_file(pth,e) for pth, e in sorted(seg.entries.items())]
+    out += [pack_chunk(cid,c) for cid, c in sorted(seg.chunks.items())]
+    return b''.join(out)
+
+## Parse log segment (binary or text)
+def read_segment(data):
+    if data[:len(MANIFEST_MAGIC)] == MANIFEST_MAGIC:
+        m = manifest(data)
+        ID, seq, lamport = m.writer
+        entries = dict((pth,e) for pth, e in m.files.items() if e != None)
+        deleted = [pth for pth, e in m.files.items() if e == None]
+        return segment(ID,seq,lamport,entries,deleted,dict(m.chunks))
+    lines = data.decode().split('\n')
+    if lines[0] != SEGMENT_HEAD:
+        out_text("Unknown log segment format! Exiting...")
+        exit(1)
+    ID, seq, lamport = lines[1].split('\t')[1:]
+    deleted = [line[2:] for line in lines[2:] if line.startswith('D\t')]
+    body = [line for line in lines[2:] if not line.startswith('D\t')]
+    entries, chunks = read_manifest('\n'.join([MANIFEST_HEAD]+body))
+    return segment(ID,int(seq),int(lamport),entries,deleted,chunks)
+
+## Apply segments in Lamport order to a manifest (and record them as applied)
+def merge_segments(entries,chunks,segments,applied):
+    touched = {}
+    for seg in sorted(segments,key=lambda seg: (seg.lamport,seg.ID,seg.seq)):
+        chunks.update(seg.chunks)
+        for pth in seg.deleted:
+            entries.pop(pth,None)
+        entries.update(seg.entries)
+        for pth in list(seg.entries)+seg.deleted:
+            if touched.get(pth,seg.ID) != seg.ID:
+                out_text("Concurrent changes of "+pth+" (keeping the one of "+seg.ID+").")
+            touched[pth] = seg.ID
+        seq, lamport = applied.get(seg.ID,(0,0))
+        applied[seg.ID] = (max(seq,seg.seq),max(lamport,seg.lamport))
+
+## Last applied segment and Lamport time per client
+def load_logs(filename):
+    applied = {}
+    if os.path.exists(filename):
+        with open(filename,'r') as f:
+            for line in f:
+                seq, lamport, ID = line.rstrip('\n').split(' ',2)
+                applied[ID] = (int(seq),int(lamport))
+    return applied
+
+def save_logs(filename,applied):
+    with open(filename+'.new','w') as f:
+        for ID, (seq, lamport) in sorted(applied.items()):
+            f.write(str(seq)+' '+str(lamport)+' '+ID+'\n')
+    os.replace(filename+'.new',filename)
+
+## Hash of the applied log heads
+def log_hash(applied):
+    import hashlib
+    return hashlib.sha256(repr(sorted(applied.items())).encode()).hexdigest()
+
+## Compress and encrypt data into an object; returns (encrypted object, pad bytes used)
+def seal_object(data,book,ID,codec='auto',zdict=None):
+    stats.count(len(data))
+    packed, codec, baseline = pack_best(data,codec,zdict)
+    stats.packed(codec,len(data),len(packed),baseline)
+    sealed = io.BytesIO()
+    used = otp_encrypt(io.BytesIO(packed),sealed,book,ID)
+    return sealed.getvalue(), used
+
+## Compress and encrypt data into an object of the cloud group (written in the background by a cloud writer); returns pad bytes used
+def store_object(name,data,book,ID,codec,zdict,out):
+    sealed, used = seal_object(data,book,ID,codec,zdict)
+    out.write(name,sealed)
+    return used
+
+## Decrypt and decompress an object (file name or stream)
+def load_object(src,book):
+    data = io.BytesIO()
+    if isinstance(src,str):
+        with open(src,'rb') as f:
+            otp_decrypt(f,data,book)
+    else:
+        otp_decrypt(src,data,book)
+    data = unpack(data.getvalue())
+    stats.count(len(data))
+    return data
+
+
+#-------------------------
+# Streaming pipeline
+#-------------------------
+
+## Bounded in-memory pipe between pipeline stages
+class blockpipe:
+
+    def __init__(self,depth=PIPE_DEPTH):
+        import queue
+        self.queue = queue.Queue(depth)
+        self.buffer = b''
+        self.eof = False
+        self.error = None
+
+    def write(self,data):
+        if len(data) > 0:
+            self.queue.put(bytes(data))
+        return len(data)
+
+    ## Reads may return less than n bytes (empty only at the end of the stream)
+    def read(self,n=-1):
+        if len(self.buffer) == 0 and not self.eof:
+            block = self.queue.get()
+            if block == None:
+                self.eof = True
+                if self.error != None:
+                    raise self.error
+            else:
+                self.buffer = block
+        if n < 0:
+            n = len(self.buffer)
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def close(self):
+        self.queue.put(None)
+
+    def fail(self,err):
+        self.error = err
+        self.queue.put(None)
+
+## File wrapper that hashes everything read or written
+class hashed:
+
+    def __init__(self,fileobj):
+        import hashlib
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self,n=-1):
+        data = self.fileobj.read(n)
+        self.hash.update(data)
+        stats.count(len(data))
+        return data
+
+    def write(self,data):
+        self.hash.update(data)
+        stats.count(len(data))
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+## Run a pipeline stage in a thread (errors are raised by the next stage)
+def start_stage(fn,out,*args):
+    target = stats.target
+    def run():
+        stats.target = target
+        try:
+            fn(*args)
+            out.close()
+        except BaseException as err:
+            out.fail(err)
+    thread = threading.Thread(target=run,daemon=True)
+    thread.start()
+    return thread
+
+## Stage: gzip compression
+def gzip_stage(src,dst):
+    import zlib
+    z = zlib.compressobj(6,zlib.DEFLATED,31)
+    for block in iter(lambda: src.read(OTP_BLOCK),b''):
+        dst.write(z.compress(block))
+    dst.write(z.flush())
+
+## Stage: tar a folder
+def tar_stage(folder,dst):
+    import tarfile
+    with tarfile.open(fileobj=dst,mode='w|') as tar:
+        tar.add(folder,arcname='.')
+
+## Stage: decrypt
+def decrypt_stage(src,dst,book):
+    otp_decrypt(src,dst,book)
+
+## Extract a tar stream into a folder
+def untar(src,folder):
+    import tarfile
+    with tarfile.open(fileobj=src,mode='r|') as tar:
+        if hasattr(tarfile,'data_filter'):
+            tar.extractall(folder,filter='data')
+        else:
+            tar.extractall(folder)
+
+## Signature of an archive (size, version tag of the cloud file, hash)
+def load_sig(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename,'r') as f:
+        size, tag, sha = f.read().split()
+    return (int(size),tag,sha)
+
+def save_sig(filename,st,sha):
+    with open(filename,'w') as f:
+        f.write(str(st.size)+' '+st.tag+' '+sha+'\n')
+
+
+#-------------------------
+# Cloud output
+#-------------------------
+
+## Staging name of a cloud file (hidden, next to the final name)
+def staging_name(filename):
+    head, tail = os.path.split(filename)
+    return os.path.join(head,'.'+tail+STAGE_SUFFIX)
+
+## Flush a file or directory to disk
+def fsync_path(pth):
+    fd = os.open(pth,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+## Writes into a cloud group directory: files go to staging names (written on a small thread pool while the next one
+## is encrypted), are flushed in one batch and renamed to their final names in order at commit, so no client sees a torn file
+class cloudwriter:
+
+    def __init__(self,store,workers=CLOUD_WORKERS):
+        self.store = store
+        self.workers = workers
+        self.pool = None
+        self.pending = []
+        self.staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,kind,err,trace):
+        if kind == None:
+            self.commit()
+        else:
+            self.abort()
+
+    def executor(self):
+        import concurrent.futures
+        if self.pool == None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        return self.pool
+
+    ## Staging name of a file of the group to be committed
+    def stage(self,name):
+        final = self.store.path(name)
+        create_dir(os.path.dirname(final))
+        staged = staging_name(final)
+        self.staged.append((staged,final))
+        return staged
+
+    ## Open a file for writing (under its staging name)
+    def open(self,name,mode='wb'):
+        return open(self.stage(name),mode)
+
+    ## Write data to a file in the background (waits while too many writes are pending)
+    def write(self,name,data):
+        while len(self.pending) >= 2*self.workers:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor().submit(counted(self.save),self.stage(name),data))
+
+    def save(self,staged,data):
+        with open(staged,'wb') as output:
+            output.write(data)
+
+    ## Wait for the writes, flush all files in one batch, then rename them in order and flush their directories
+    def commit(self):
+        try:
+            for future in self.pending:
+                future.result()
+            self.pending = []
+            list(self.executor().map(fsync_path,[staged for staged, final in self.staged]))
+            folders = []
+            for staged, final in self.staged:
+                os.replace(staged,final)
+                if os.path.dirname(final) not in folders:
+                    folders.append(os.path.dirname(final))
+            self.staged = []
+            for folder in folders:
+                fsync_path(folder)
+        finally:
+            self.abort()
+
+    ## Drop everything not committed
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        for future in self.pending:
+            if not future.cancelled():
+                future.exception()
+        self.pending = []
+        for staged, final in self.staged:
+            if os.path.exists(staged):
+                os.unlink(staged)
+        self.staged = []
+        if self.pool != None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+#-------------------------
+# Cloud storage
+#-------------------------
+
+## State of a file in the cloud (size, modification time, version tag: changes with every write)
+rstat = collections.namedtuple('rstat',['size','mtime','tag'])
+
+## Storage of a cloud group (CLOUD: directory of a cloud client, or s3://bucket/prefix/ for S3-compatible storage)
+def open_store(cloud,group,config):
+    if cloud.startswith('s3://'):
+        return s3store(cloud,group,config)
+    if '://' in cloud:
+        out_text("Cloud storage "+cloud+" is not supported! Exiting...")
+        exit(1)
+    return fsstore(cloud+group)
+
+## SHA-256 of a file in the cloud
+def cloud_hash(store,name):
+    import hashlib
+    h = hashlib.sha256()
+    with store.open(name) as f:
+        for block in iter(lambda: f.read(OTP_BLOCK),b''):
+            h.update(block)
+    return h.hexdigest()
+
+## Cloud group in a local directory (uploaded by the cloud client)
+class fsstore:
+
+    def __init__(self,folder):
+        self.folder = folder
+
+    def path(self,name):
+        return os.path.join(self.folder,name)
+
+    ## State of a file (None if it does not exist)
+    def stat(self,name):
+        try:
+            st = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        return rstat(st.st_size,st.st_mtime,str(st.st_mtime_ns))
+
+    def exists(self,name):
+        return os.path.isfile(self.path(name))
+
+    ## Names of the files and folders in a folder of the group
+    def list(self,folder=''):
+        try:
+            return sorted(os.listdir(self.path(folder)))
+        except (FileNotFoundError,NotADirectoryError):
+            return []
+
+    def open(self,name):
+        return open(self.path(name),'rb')
+
+    ## Content of a file (None if it does not exist)
+    def read(self,name):
+        try:
+            with open(self.path(name),'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def read_range(self,name,offset,length):
+        fd = os.open(self.path(name),os.O_RDONLY)
+        try:
+            return os.pread(fd,length,offset)
+        finally:
+            os.close(fd)
+
+    def delete(self,name):
+        if os.path.exists(self.path(name)):
+            os.unlink(self.path(name))
+
+    ## Write a file that must not exist yet; returns False if it does (another client was first)
+    def publish(self,name,data):
+        final = self.path(name)
+        create_dir(os.path.dirname(final))
+        with open(final+'.new','wb') as f:
+            f.write(data)
+        fsync_path(final+'.new')
+        try:
+            os.link(final+'.new',final)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.unlink(final+'.new')
+
+    def writer(self):
+        return cloudwriter(self)
+
+    ## Signature of the group for the no-op fast path (top level and log folders)
+    def signature(self):
+        state = []
+        for folder in ['','log']:
+            for name in self.list(folder):
+                st = os.stat(self.path(os.path.join(folder,name)))
+                state.append((folder,name,st.st_mtime_ns,st.st_size,st.st_ino))
+        return state
+
+## AWS signature version 4 of a request (headers: lower case names, signed as given); returns the Authorization header
+def sigv4(method,path,query,headers,region,key,secret,service='s3'):
+    import hashlib
+    import hmac
+    import urllib.parse
+    date = headers['x-amz-date']
+    scope = date[:8]+'/'+region+'/'+service+'/aws4_request'
+    names = sorted(headers)
+    canonical = '\n'.join([method,path,
+                           '&'.join(urllib.parse.quote(k,safe='~')+'='+urllib.parse.quote(v,safe='~') for k, v in sorted(query)),
+                           ''.join(k+':'+' '.join(headers[k].split())+'\n' for k in names),
+                           ';'.join(names),headers['x-amz-content-sha256']])
+    signed = 'AWS4-HMAC-SHA256\n'+date+'\n'+scope+'\n'+hashlib.sha256(canonical.encode()).hexdigest()
+    k = ('AWS4'+secret).encode()
+    for part in [date[:8],region,service,'aws4_request']:
+        k = hmac.new(k,part.encode(),hashlib.sha256).digest()
+    return ('AWS4-HMAC-SHA256 Credential='+key+'/'+scope+', SignedHeaders='+';'.join(names)+
+            ', Signature='+hmac.new(k,signed.encode(),hashlib.sha256).hexdigest())
+
+## Elements of an XML document by tag (namespaces ignored)
+def xml_items(data,tag):
+    import xml.etree.ElementTree
+    return [e for e in xml.etree.ElementTree.fromstring(data).iter() if e.tag.split('}')[-1] == tag]
+
+def xml_text(e,tag):
+    for child in e:
+        if child.tag.split('}')[-1] == tag:
+            return child.text or ''
+    return ''
+
+## Open connections to an HTTP(S) endpoint, shared by all threads
+class connpool:
+
+    def __init__(self,endpoint,size):
+        import urllib.parse
+        url = urllib.parse.urlsplit(endpoint)
+        self.secure = url.scheme == 'https'
+        self.host = url.netloc
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    ## Connection (and whether it was used before)
+    def get(self):
+        import http.client
+        with self.lock:
+            if len(self.idle) > 0:
+                return self.idle.pop(), True
+        if self.secure:
+            return http.client.HTTPSConnection(self.host,timeout=S3_TIMEOUT), False
+        return http.client.HTTPConnection(self.host,timeout=S3_TIMEOUT), False
+
+    def put(self,conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+## Cloud group in an S3-compatible bucket (ENDPOINT, REGION, ACCESSKEY, SECRETKEY or the AWS_* environment variables);
+## large files are transferred in parts on several pooled connections, and failed requests are retried with backoff
+class s3store:
+
+    def __init__(self,cloud,group,config):
+        import urllib.parse
+        url = urllib.parse.urlsplit(cloud)
+        self.bucket = url.netloc
+        self.prefix = '/'.join(p for p in [url.path.strip('/'),group.strip('/')] if p != '')+'/'
+        self.region = config.get('REGION',os.environ.get('AWS_REGION','us-east-1'))
+        self.endpoint = config.get('ENDPOINT','https://s3.'+self.region+'.amazonaws.com')
+        self.key = config.get('ACCESSKEY',os.environ.get('AWS_ACCESS_KEY_ID',''))
+        self.secret = config.get('SECRETKEY',os.environ.get('AWS_SECRET_ACCESS_KEY',''))
+        self.token = os.environ.get('AWS_SESSION_TOKEN')
+        self.workers = int(config.get('TRANSFERS',str(S3_WORKERS)))
+        self.pool = connpool(self.endpoint,self.workers)
+        self.transfers = None
+        self.lock = threading.Lock()
+
+    ## Thread pool of part transfers
+    def executor(self):
+        import concurrent.futures
+        with self.lock:
+            if self.transfers == None:
+                self.transfers = concurrent.futures.ThreadPoolExecutor(self.workers)
+            return self.transfers
+
+    ## Signed request on a pooled connection (retried with exponential backoff on network errors, 5xx and 429);
+    ## returns (status, headers, body) for the accepted statuses
+    def request(self,method,name,query=[],body=b'',headers={},accept=(200,)):
+        import hashlib
+        import http.client
+        import urllib.parse
+        import random
+        path = '/'+self.bucket+'/'+urllib.parse.quote(self.prefix+name if name != None else '',safe='/~')
+        if len(query) > 0:
+            url = path+'?'+'&'.join(urllib.parse.quote(k,safe='~')+'='+urllib.parse.quote(v,safe='~') for k, v in query)
+        else:
+            url = path
+        attempt = 0
+        while True:
+            signed = dict((k.lower(),v) for k, v in headers.items())
+            signed['host'] = self.pool.host
+            signed['x-amz-date'] = time.strftime('%Y%m%dT%H%M%SZ',time.gmtime())
+            signed['x-amz-content-sha256'] = hashlib.sha256(body).hexdigest()
+            if self.token != None:
+                signed['x-amz-security-token'] = self.token
+            signed['authorization'] = sigv4(method,path,query,signed,self.region,self.key,self.secret)
+            conn, reused = self.pool.get()
+            try:
+                conn.request(method,url,body,signed)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError,http.client.HTTPException) as err:
+                conn.close()
+                error = str(err) or type(err).__name__
+                ## A pooled connection the server has closed meanwhile is replaced right away
+                if reused:
+                    continue
+            else:
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.pool.put(conn)
+                stats.count(len(data)+len(body))
+                if response.status in accept:
+                    return response.status, response, data
+                error = 'HTTP '+str(response.status)
+                if response.status < 500 and response.status != 429:
+                    break
+            attempt += 1
+            if attempt > S3_RETRIES:
+                break
+            time.sleep(S3_BACKOFF*2**(attempt-1)*(0.5+random.random()))
+        out_text("Cloud request "+method+" "+self.prefix+(name or '')+" failed ("+error+")! Exiting...")
+        exit(1)
+
+    ## State of a file (None if it does not exist)
+    def stat(self,name):
+        import email.utils
+        status, response, data = self.request('HEAD',name,accept=(200,404))
+        if status == 404:
+            return None
+        mtime = email.utils.parsedate_to_datetime(response.getheader('Last-Modified')).timestamp()
+        return rstat(int(response.getheader('Content-Length')),mtime,response.getheader('ETag','').strip('"'))
+
+    def exists(self,name):
+        return self.stat(name) != None
+
+    ## Keys below a prefix of the group (with size and ETag) and the folders below it (with delimiter)
+    def listing(self,prefix,delimiter=None):
+        files = {}
+        folders = []
+        query = [('list-type','2'),('prefix',self.prefix+prefix)]
+        if delimiter != None:
+            query.append(('delimiter',delimiter))
+        while True:
+            status, response, data = self.request('GET',None,query)
+            for e in xml_items(data,'Contents'):
+                files[xml_text(e,'Key')[len(self.prefix):]] = (int(xml_text(e,'Size')),xml_text(e,'ETag').strip('"'))
+            for e in xml_items(data,'CommonPrefixes'):
+                folders.append(xml_text(e,'Prefix')[len(self.prefix):])
+            token = [e.text for e in xml_items(data,'NextContinuationToken')]
+            if len(token) == 0 or not token[0]:
+                return files, folders
+            query = [q for q in query if q[0] != 'continuation-token']+[('continuation-token',token[0])]
+
+    ## Names of the files and folders in a folder of the group
+    def list(self,folder=''):
+        prefix = folder.strip('/')+'/' if folder.strip('/') != '' else ''
+        files, folders = self.listing(prefix,'/')
+        return sorted([name[len(prefix):] for name in files]+[name[len(prefix):].rstrip('/') for name in folders])
+
+    ## File opened for reading (ranged requests, sequential reads are fetched ahead in parallel)
+    def open(self,name):
+        st = self.stat(name)
+        if st == None:
+            raise FileNotFoundError(self.prefix+name)
+        return rangereader(self,name,st.size)
+
+    ## Content of a file (None if it does not exist)
+    def read(self,name):
+        status, response, data = self.request('GET',name,accept=(200,404))
+        return data if status == 200 else None
+
+    def read_range(self,name,offset,length):
+        if length <= 0:
+            return b''
+        status, response, data = self.request('GET',name,headers={'Range':'bytes='+str(offset)+'-'+str(offset+length-1)},
+                                              accept=(200,206,416))
+        if status == 200:
+            return data[offset:offset+length]
+        return data if status == 206 else b''
+
+    def delete(self,name):
+        self.request('DELETE',name,accept=(200,204,404))
+
+    ## Write a file that must not exist yet (conditional write); returns False if it does (another client was first)
+    def publish(self,name,data):
+        status, response, body = self.request('PUT',name,body=data,headers={'If-None-Match':'*'},accept=(200,409,412))
+        return status == 200
+
+    ## Write a file (in parts on several connections if it is large)
+    def put(self,name,data):
+        if len(data) <= S3_PART:
+            self.request('PUT',name,body=data)
+        else:
+            self.multipart(name,len(data),lambda offset, length: data[offset:offset+length])
+
+    ## Upload a local file
+    def upload(self,name,filename):
+        size = os.path.getsize(filename)
+        def read(offset,length):
+            with open(filename,'rb') as f:
+                f.seek(offset)
+                return f.read(length)
+        if size <= S3_PART:
+            self.request('PUT',name,body=read(0,size))
+        else:
+            self.multipart(name,size,read)
+
+    ## Multipart upload: parts are read and sent in parallel, the upload is aborted if one of them fails
+    def multipart(self,name,size,read):
+        status, response, data = self.request('POST',name,[('uploads','')])
+        upload = xml_text(xml_items(data,'InitiateMultipartUploadResult')[0],'UploadId')
+        def part(n):
+            offset = (n-1)*S3_PART
+            status, response, data = self.request('PUT',name,[('partNumber',str(n)),('uploadId',upload)],
+                                                  read(offset,min(S3_PART,size-offset)))
+            return response.getheader('ETag')
+        try:
+            tags = list(self.executor().map(counted(part),range(1,(size+S3_PART-1)//S3_PART+1)))
+            body = '<CompleteMultipartUpload>'+''.join('<Part><PartNumber>'+str(n)+'</PartNumber><ETag>'+tag+'</ETag></Part>'
+                                                       for n, tag in enumerate(tags,1))+'</CompleteMultipartUpload>'
+            status, response, data = self.request('POST',name,[('uploadId',upload)],body.encode())
+            if len(xml_items(data,'Error')) > 0:
+                out_text("Multipart upload of "+self.prefix+name+" failed! Exiting...")
+                exit(1)
+        except BaseException:
+            self.request('DELETE',name,[('uploadId',upload)],accept=(200,204,404))
+            raise
+
+    def writer(self):
+        return s3writer(self)
+
+    ## Signature of the group for the no-op fast path (top level and log segments)
+    def signature(self):
+        return sorted(self.listing('','/')[0].items())+sorted(self.listing('log/')[0].items())
+
+## Reads a file of a network store like an open file: random reads fetch exactly the range asked for, and while
+## it is read sequentially, the next blocks are fetched in parallel (never more ahead than has been read in a row)
+class rangereader:
+
+    def __init__(self,store,name,size):
+        self.store = store
+        self.name = name
+        self.size = size
+        self.pos = 0
+        self.buf = b''
+        self.start = 0
+        self.ahead = []
+        self.tail = None
+        self.streak = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,kind,err,trace):
+        self.close()
+
+    def seek(self,offset,whence=0):
+        self.pos = [offset,self.pos+offset,self.size+offset][whence]
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self,n=-1):
+        end = self.size if n < 0 else min(self.size,self.pos+n)
+        if self.pos != self.tail:
+            self.streak = 0
+        start = self.pos
+        data = []
+        while self.pos < end:
+            if not self.start <= self.pos < self.start+len(self.buf):
+                self.fill(end)
+            block = self.buf[self.pos-self.start:end-self.start]
+            if len(block) == 0:
+                break
+            data.append(block)
+            self.pos += len(block)
+        self.streak += self.pos-start
+        self.tail = self.pos
+        return b''.join(data)
+
+    ## Next block: fetched ahead already, or the range asked for
+    def fill(self,end):
+        if len(self.ahead) > 0 and self.ahead[0][0] == self.pos:
+            self.start, length, future = self.ahead.pop(0)
+            self.buf = future.result()
+        else:
+            self.drop()
+            self.start = self.pos
+            self.buf = self.store.read_range(self.name,self.pos,end-self.pos)
+        if self.streak == 0:
+            return
+        offset = self.ahead[-1][0]+self.ahead[-1][1] if len(self.ahead) > 0 else self.start+len(self.buf)
+        span = min(S3_PART,max(OTP_BLOCK,len(self.buf)*2))
+        while offset < self.size and len(self.ahead) < self.store.workers and sum(a[1] for a in self.ahead) < self.streak:
+            length = min(span,self.size-offset)
+            self.ahead.append((offset,length,self.store.executor().submit(counted(self.store.read_range),self.name,offset,length)))
+            offset += length
+
+    def drop(self):
+        for start, length, future in self.ahead:
+            future.cancel()
+        self.ahead = []
+
+    def close(self):
+        self.drop()
+
+## Writes into a network store: objects are uploaded in the background while the next one is encrypted, opened
+## and staged files are spooled locally and uploaded in order at commit (after the background uploads)
+class s3writer:
+
+    def __init__(self,store,workers=CLOUD_WORKERS):
+        self.store = store
+        self.workers = workers
+        self.pool = None
+        self.pending = []
+        self.staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,kind,err,trace):
+        if kind == None:
+            self.commit()
+        else:
+            self.abort()
+
+    def executor(self):
+        import concurrent.futures
+        if self.pool == None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        return self.pool
+
+    ## Local spool file of a file of the group to be committed
+    def stage(self,name):
+        import tempfile
+        fd, spool = tempfile.mkstemp(prefix='.otpsync-',suffix=STAGE_SUFFIX)
+        os.close(fd)
+        self.staged.append((spool,name))
+        return spool
+
+    def open(self,name,mode='wb'):
+        return open(self.stage(name),mode)
+
+    ## Upload data in the background (waits while too many uploads are pending)
+    def write(self,name,data):
+        while len(self.pending) >= 2*self.workers:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor().submit(counted(self.store.put),name,data))
+
+    ## Wait for the uploads, then upload the spooled files in order
+    def commit(self):
+        try:
+            for future in self.pending:
+                future.result()
+            self.pending = []
+            for spool, name in self.staged:
+                self.store.upload(name,spool)
+        finally:
+            self.abort()
+
+    ## Drop everything not committed
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        for future in self.pending:
+            if not future.cancelled():
+                future.exception()
+        self.pending = []
+        for spool, name in self.staged:
+            if os.path.exists(spool):
+                os.unlink(spool)
+        self.staged = []
+        if self.pool != None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+#-------------------------
+# Merkle tree
+#-------------------------
+
+## Leaf of a Merkle tree (hash of a plaintext chunk, encrypted length, pad bytes)
+leaf = collections.namedtuple('leaf',['hash','length','pad'])
+
+## Hashes of chunks, inner nodes and files (BLAKE2b, one personalization each)
+def merkle_leaf(data):
+    import hashlib
+    return hashlib.blake2b(data,digest_size=32,person=b'otpsync-chunk').digest()
+
+def merkle_node(left,right):
+    import hashlib
+    return hashlib.blake2b(left+right,digest_size=32,person=b'otpsync-node').digest()
+
+def merkle_file(pth,root):
+    import hashlib
+    return hashlib.blake2b(pth.encode()+b'\0'+root,digest_size=32,person=b'otpsync-file').digest()
+
+## Levels of a Merkle tree over hashes (leaves first, root last; an odd node is carried up)
+def merkle_levels(hashes):
+    levels = [list(hashes) or [merkle_leaf(b'')]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([merkle_node(level[i],level[i+1]) if i+1 < len(level) else level[i] for i in range(0,len(level),2)])
+    return levels
+
+def merkle_root(hashes):
+    return merkle_levels(hashes)[-1][0]
+
+## Root of an archive: tree over the roots of its files in path order
+def archive_root(trees):
+    return merkle_root([merkle_file(pth,merkle_root([l.hash for l in leaves])) for pth, leaves in sorted(trees.items())])
+
+## Leaves in which two trees differ (subtrees with equal roots are skipped)
+def merkle_diff(a,b):
+    if len(a[0]) != len(b[0]):
+        return [i for i in range(len(a[0])) if i >= len(b[0]) or a[0][i] != b[0][i]]
+    nodes = [0]
+    for depth in range(len(a)-1,-1,-1):
+        nodes = [i for i in nodes if a[depth][i] != b[depth][i]]
+        if depth > 0:
+            nodes = [j for i in nodes for j in (2*i,2*i+1) if j < len(a[depth-1])]
+    return nodes
+
+## Leaves of the files of an archive (records sorted by path)
+def pack_trees(trees):
+    data = b''
+    for pth, leaves in sorted(trees.items()):
+        body = b''.join(MERKLE_LEAF.pack(*l) for l in leaves)
+        data += pack_record(b'L',struct.pack('>I',len(leaves))+body+pth.encode())
+    return data
+
+def parse_trees(data):
+    trees = {}
+    for kind, pos, payload in records(data,0,len(data)):
+        if kind == b'L':
+            n = struct.unpack_from('>I',payload,0)[0]
+            leaves = [leaf(*MERKLE_LEAF.unpack_from(payload,4+i*MERKLE_LEAF.size)) for i in range(n)]
+            trees[bytes(payload[4+n*MERKLE_LEAF.size:]).decode()] = leaves
+    return trees
+
+## Worker threads for hashing and decrypting chunks
+hashers = []
+
+def hash_pool():
+    import concurrent.futures
+    if len(hashers) == 0:
+        hashers.append(concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1))
+    return hashers[0]
+
+## Chunks of a file and their leaf hashes (hashed in parallel)
+def file_chunks(filename):
+    with open(filename,'rb') as f:
+        chunks = list(iter(lambda: f.read(MERKLE_CHUNK),b''))
+    return chunks, list(hash_pool().map(merkle_leaf,chunks))
+
+
+#-------------------------
+# Seekable archive
+#-------------------------
+
+## Member of a seekable archive: hash, size, mtime, encrypted data (offset, length), pad bytes (directories have no hash)
+member = collections.namedtuple('member',['sha','size','mtime','offset','length','pad'])
+
+## Member index (records sorted by path)
+def pack_members(members):
+    data = b''
+    for pth, m in sorted(members.items()):
+        sha = b'' if m.sha == '-' else bytes.fromhex(m.sha)
+        head = CONTAINER_MEMBER.pack(1 if m.sha == '-' else 0,m.size,m.mtime,sha,m.offset,m.length,m.pad)
+        data += pack_record(b'M',head+pth.encode())
+    return data
+
+def parse_members(data):
+    members = {}
+    for kind, pos, payload in records(data,0,len(data)):
+        if kind == b'M':
+            isdir, size, mtime, sha, offset, length, pad = CONTAINER_MEMBER.unpack_from(payload,0)
+            pth = bytes(payload[CONTAINER_MEMBER.size:]).decode()
+            members[pth] = member('-' if isdir else sha.hex(),size,mtime,offset,length,pad)
+    return members
+
+## Local copy of the member index TMP mirrors
+def load_members(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename,'rb') as f:
+        data = f.read()
+    if data[:len(CONTAINER_MAGIC)] != CONTAINER_MAGIC:
+        return {}
+    return parse_members(data[len(CONTAINER_MAGIC):])
+
+def save_members(filename,members):
+    with open(filename+'.new','wb') as output:
+        output.write(CONTAINER_MAGIC+pack_members(members))
+    os.replace(filename+'.new',filename)
+
+## Header, member index and Merkle tree (None in version 1) of an open seekable archive;
+## returns (members, trees, hash of header and encrypted index)
+def read_container(f,book):
+    import hashlib
+    head = f.read(CONTAINER_HEADER.size)
+    if len(head) < CONTAINER_HEADER.size or head[:len(CONTAINER_MAGIC)] != CONTAINER_MAGIC:
+        out_text("Unknown archive format! Exiting...")
+        exit(1)
+    magic, version, offset, length = CONTAINER_HEADER.unpack(head)
+    if version > CONTAINER_VERSION:
+        out_text("Archive version "+str(version)+" is not supported! Exiting...")
+        exit(1)
+    f.seek(offset)
+    index = f.read(length)
+    data = load_object(io.BytesIO(index),book)
+    trees = None
+    for kind, pos, payload in records(data,0,len(data)):
+        if kind == b'T':
+            offset, length, root = MERKLE_TREE.unpack_from(payload,0)
+            f.seek(offset)
+            trees = parse_trees(load_object(io.BytesIO(f.read(length)),book))
+            if archive_root(trees) != root:
+                out_text("Merkle tree of the archive is corrupt! Exiting...")
+                exit(1)
+    return parse_members(data), trees, hashlib.sha256(head+index).hexdigest()
+
+## Offsets of the chunks of a member
+def chunk_offsets(m,leaves):
+    offsets = []
+    offset = m.offset
+    for l in leaves:
+        offsets.append(offset)
+        offset += l.length
+    return offsets
+
+## Decrypt chunks of a member in parallel (read: offset, length -> archive bytes), each checked against its leaf;
+## returns (chunks, first bad index or None)
+def read_chunks(read,m,leaves,indices,book):
+    offsets = chunk_offsets(m,leaves)
+    def load(i):
+        try:
+            data = load_object(io.BytesIO(read(offsets[i],leaves[i].length)),book)
+        except (Exception,SystemExit):
+            return None
+        return data if merkle_leaf(data) == leaves[i].hash else None
+    chunks = {}
+    window = 2*(os.cpu_count() or 1)
+    ## Stop at the first bad chunk (only a window of chunks is decrypted ahead)
+    for start in range(0,len(indices),window):
+        batch = indices[start:start+window]
+        for i, data in zip(batch,hash_pool().map(counted(load),batch)):
+            if data == None:
+                return chunks, i
+            chunks[i] = data
+    return chunks, None
+
+## Decrypt one member of an open version 1 archive (checked against its hash)
+def read_member(f,m,book):
+    import hashlib
+    f.seek(m.offset)
+    data = load_object(io.BytesIO(f.read(m.length)),book)
+    if hashlib.sha256(data).hexdigest() != m.sha:
+        return None
+    return data
+
+## Compress and encrypt data at the end of an open archive; returns (offset, length, pad bytes used)
+def write_member(dst,data,book,ID,codec='auto'):
+    offset = dst.tell()
+    stats.count(len(data))
+    packed, codec, baseline = pack_best(data,codec)
+    stats.packed(codec,len(data),len(packed),baseline)
+    used = otp_encrypt(io.BytesIO(packed),dst,book,ID)
+    return offset, dst.tell()-offset, used
+
+## Copy encrypted data from one archive to the end of another; returns its new offset
+def copy_range(src,dst,start,length):
+    offset = dst.tell()
+    src.seek(start)
+    left = length
+    while left > 0:
+        block = src.read(min(left,OTP_BLOCK))
+        if not block:
+            out_text("Archive is truncated! Exiting...")
+            exit(1)
+        dst.write(block)
+        left -= len(block)
+    return offset
+
+## Plaintext of a member: chunks the file holds already, changed ones decrypted; returns (data, archive bytes read)
+def fetch_member(read,filename,m,leaves,book):
+    local = []
+    changed = list(range(len(leaves)))
+    if os.path.isfile(filename):
+        local, hashes = file_chunks(filename)
+        diff = merkle_diff(merkle_levels([l.hash for l in leaves]),merkle_levels(hashes))
+        changed = [i for i in diff if i < len(leaves)]
+    chunks, bad = read_chunks(read,m,leaves,changed,book)
+    if bad != None:
+        out_text("Chunk "+str(bad)+" of "+filename+" does not match the Merkle tree! Exiting...")
+        exit(1)
+    data = b''.join(chunks[i] if i in chunks else local[i] for i in range(len(leaves)))
+    return data, sum(leaves[i].length for i in changed)
+
+## Check whether a file holds a member already (by its recorded state or its hash); its mtime is set to the member's
+def mirrored(filename,m,recorded):
+    if not os.path.isfile(filename):
+        return False
+    st = os.stat(filename)
+    if st.st_size != m.size:
+        return False
+    known = recorded != None and recorded.sha == m.sha and recorded.mtime == st.st_mtime_ns
+    if not known and (cached_hash(filename,st) or file_hash(filename)) != m.sha:
+        return False
+    if st.st_mtime_ns != m.mtime:
+        os.utime(filename,ns=(m.mtime,m.mtime))
+    return True
+
+
+#-------------------------
+# Watching
+#-------------------------
+
+## Watch the local tree and the cloud group directory with inotify
+class inotify_watch:
+
+    def __init__(self,folder,cloud):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),"inotify is not available")
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+        self.paths = {}
+        self.cloud = self.add(cloud)
+        for pth in file_structure(folder)[0]:
+            self.add(os.path.join(folder,pth))
+
+    def add(self,path):
+        wd = self.add_watch(self.fd,os.fsencode(path),IN_CHANGES)
+        if wd >= 0:
+            self.paths[wd] = path
+        return wd
+
+    ## Wait for changes (returns local, remote)
+    def wait(self,timeout):
+        import select
+        local = remote = False
+        ready = select.select([self.fd],[],[],timeout)[0]
+        if len(ready) > 0:
+            data = os.read(self.fd,1 << 16)
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, n = INOTIFY_EVENT.unpack_from(data,i)
+                name = os.fsdecode(data[i+INOTIFY_EVENT.size:i+INOTIFY_EVENT.size+n].rstrip(b'\0'))
+                i += INOTIFY_EVENT.size+n
+                if wd == self.cloud:
+                    remote = remote or name == 'safe.info'
+                elif wd in self.paths:
+                    local = True
+                    ## Watch new directories (and everything already inside them)
+                    if mask & IN_ISDIR and mask & (0x80 | 0x100):
+                        new = os.path.join(self.paths[wd],name)
+                        for pth in file_structure(new)[0]:
+                            self.add(os.path.normpath(os.path.join(new,pth)))
+        return (local,remote)
+
+## Watch the local tree and the cloud group by polling
+class poll_watch:
+
+    def __init__(self,folder,store,interval):
+        self.local = tree(folder)
+        self.store = store
+        self.interval = interval
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        self.local.scan()
+        return (dict(self.local.files),dict(self.local.dirs),self.store.stat('safe.info'))
+
+    ## Wait for changes (returns local, remote)
+    def wait(self,timeout):
+        time.sleep(min(timeout,self.interval))
+        old, self.state = self.state, self.snapshot()
+        return (old[:2] != self.state[:2],old[2] != self.state[2])
+
+
+#-------------------------
+# Metrics
+#-------------------------
+
+## Duration, bytes processed and pad bytes used per step of a run
+class runstats:
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.current = []
+        self.profiler = None
+        self.codecs = {}
+
+    def begin(self,name):
+        self.phases.setdefault(name,{'calls':0,'time':0.0,'bytes':0,'pad':0})
+        self.current.append(name)
+
+    def end(self,name,t,pad):
+        self.phases[name]['calls'] += 1
+        self.phases[name]['time'] += t
+        self.phases[name]['pad'] += pad
+        self.current.pop()
+
+    ## Count processed bytes for the running step
+    def count(self,n):
+        if len(self.current) > 0:
+            self.phases[self.current[-1]]['bytes'] += n
+
+    ## Count compressed data per codec (raw, packed and gzip path bytes)
+    def packed(self,codec,raw,packed,baseline):
+        counts = self.codecs.setdefault(codec,[0,0,0,0])
+        for i, n in enumerate([1,raw,packed,baseline]):
+            counts[i] += n
+
+    def clear(self):
+        self.phases = collections.OrderedDict()
+
+## Statistics of the run in this thread (pipeline stages count for the thread that started them)
+class threadstats(threading.local):
+
+    def __init__(self):
+        threading.local.__setattr__(self,'target',runstats())
+
+    def __getattr__(self,name):
+        return getattr(self.target,name)
+
+    def __setattr__(self,name,value):
+        if name == 'target':
+            threading.local.__setattr__(self,name,value)
+        else:
+            setattr(self.target,name,value)
+
+stats = threadstats()
+
+## Run fn in worker threads on the statistics of the calling thread
+def counted(fn):
+    target = stats.target
+    def run(*args):
+        stats.target = target
+        return fn(*args)
+    return run
+
+## Record a step of otpsync in stats (and profile it if PROFILE is set)
+def measured(name):
+    def wrap(fn):
+        def step(self,*args):
+            before = self.padbook().remaining(self.config['ID'])
+            if 'PROFILE' in self.config and stats.profiler == None:
+                import cProfile
+                stats.profiler = cProfile.Profile()
+            stats.begin(name)
+            if stats.profiler != None:
+                stats.profiler.enable()
+            start = time.perf_counter()
+            try:
+                return fn(self,*args)
+            finally:
+                t = time.perf_counter()-start
+                if stats.profiler != None:
+                    stats.profiler.disable()
+                stats.end(name,t,max(0,before-self.padbook().remaining(self.config['ID'])))
+        return step
+    return wrap
+
+## Copy file data in the kernel where possible (reflink, copy_file_range, sendfile); returns the method
+def copy_data(fsrc,fdst):
+    import fcntl
+    import shutil
+    if sys.platform.startswith('linux'):
+        try:
+            fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    methods = []
+    if hasattr(os,'copy_file_range'):
+        methods.append(('copy_file_range',lambda: os.copy_file_range(fsrc.fileno(),fdst.fileno(),1 << 30)))
+    if sys.platform.startswith('linux'):
+        methods.append(('sendfile',lambda: os.sendfile(fdst.fileno(),fsrc.fileno(),None,1 << 30)))
+    for name, fn in methods:
+        copied = 0
+        try:
+            for n in iter(fn,0):
+                copied += n
+            return name
+        except OSError:
+            ## Not supported between these files (nothing copied yet): try the next method
+            if copied > 0:
+                raise
+    shutil.copyfileobj(fsrc,fdst,OTP_BLOCK)
+    return 'userspace'
+
+## Copy a file with its metadata like shutil.copy2 (skipped if dst is identical: same hashes, or same size and mtime
+## if a hash is not known; never if the caller knows the contents differ); returns the method
+def copy_file(src,dst,differ=False):
+    import shutil
+    st = os.stat(src)
+    if not differ and os.path.isfile(dst):
+        dt = os.stat(dst)
+        if dt.st_size == st.st_size:
+            sha = cached_hash(src,st)
+            dsha = cached_hash(dst,dt)
+            if (sha != None and sha == dsha) or ((sha == None or dsha == None) and dt.st_mtime_ns == st.st_mtime_ns):
+                shutil.copystat(src,dst)
+                return 'identical'
+    with open(src,'rb') as fsrc, open(dst,'wb') as fdst:
+        method = copy_data(fsrc,fdst)
+    shutil.copystat(src,dst)
+    stats.count(st.st_size)
+    return method
+
+## Move a file or folder (rename, or copy through copy_file across file systems)
+def move_file(src,dst):
+    import shutil
+    shutil.move(src,dst,copy_function=copy_file)
+
+## Prometheus text format of the last run and the cumulative counters
+def prometheus(labels,phases,totals,remaining):
+    tag = ','.join(key+'="'+value+'"' for key, value in sorted(labels.items()))
+    lines = []
+
+    def metric(name,kind,text,values):
+        lines.append('# HELP '+name+' '+text)
+        lines.append('# TYPE '+name+' '+kind)
+        for extra, value in values:
+            lines.append(name+'{'+tag+extra+'} '+str(value))
+
+    def steps(source,key):
+        return [(',step="'+step+'"',p[key]) for step, p in source.items()]
+
+    metric('otpsync_runs_total','counter','Number of recorded runs.',[('',totals['runs'])])
+    metric('otpsync_step_calls_total','counter','Number of calls per step.',steps(totals['steps'],'calls'))
+    metric('otpsync_step_seconds_total','counter','Time spent per step.',steps(totals['steps'],'time'))
+    metric('otpsync_step_bytes_total','counter','Bytes processed per step.',steps(totals['steps'],'bytes'))
+    metric('otpsync_step_pad_bytes_total','counter','Pad bytes used per step.',steps(totals['steps'],'pad'))
+    metric('otpsync_last_step_seconds','gauge','Time spent per step in the last run.',steps(phases,'time'))
+    metric('otpsync_pad_remaining_bytes','gauge','Remaining pad capacity.',[('',remaining)])
+    metric('otpsync_last_run_timestamp_seconds','gauge','Time of the last run.',[('',totals['last'])])
+    return '\n'.join(lines)+'\n'
+
+#-------------------------
+# Backups
+#-------------------------
+
+## Version of a path in the backups: sync generation, time, kind (sync: content of the synced tree, deleted: removed
+## from the synced tree, backup: copy kept aside, e.g. the losing side of a conflict), hash, size, mtime
+bversion = collections.namedtuple('bversion',['gen','time','kind','sha','size','mtime','path'])
+
+## Deduplicated, versioned backups: every content is stored once by its hash (.objects/), and an index lists the
+## versions of every path by sync generation (.versions, appended)
+class backupstore:
+
+    def __init__(self,folder,keep=BACKUP_KEEP,days=BACKUP_DAYS):
+        self.folder = os.path.join(expanduser(folder),'')
+        self.index = self.folder+BACKUP_INDEX
+        self.keepgens = keep
+        self.keepdays = days
+        self.paths = None
+        self.pending = []
+
+    ## Stored content of a hash
+    def object(self,sha):
+        return self.folder+BACKUP_OBJECTS+sha[:2]+'/'+sha[2:]
+
+    ## Versions of every path in the order they were recorded (read once)
+    def versions(self):
+        if self.paths == None:
+            self.paths = {}
+            if os.path.exists(self.index):
+                with open(self.index,'r') as f:
+                    if f.readline() == BACKUP_HEAD+'\n':
+                        for line in f:
+                            fields = line.rstrip('\n').split('\t',6)
+                            ## A line torn by a crash is skipped
+                            if len(fields) == 7:
+                                v = bversion(int(fields[0]),float(fields[1]),fields[2],fields[3],int(fields[4]),
+                                             float(fields[5]),fields[6])
+                                self.paths.setdefault(v.path,[]).append(v)
+        return(self.paths)
+
+    ## Latest version of a path (recorded or pending; None if the path has no versions)
+    def latest(self,pth):
+        pth = os.path.normpath(pth)
+        pending = [v for v in self.pending if v.path == pth]
+        if len(pending) > 0:
+            return(pending[-1])
+        vs = self.versions().get(pth,[])
+        return(vs[-1] if len(vs) > 0 else None)
+
+    ## Record a version of a path (generation None: the one the running sync is committed with)
+    def note(self,pth,kind,sha='-',size=0,mtime=0.0,gen=None):
+        self.pending.append(bversion(gen,time.time(),kind,sha,size,mtime,os.path.normpath(pth)))
+
+    ## Store the content of a file once (a move if move=True); returns its hash and stat
+    def put(self,filename,move=False):
+        st = os.stat(filename)
+        sha = content_hash(filename)
+        obj = self.object(sha)
+        if os.path.exists(obj):
+            if move:
+                os.unlink(filename)
+        else:
+            create_dir(os.path.dirname(obj))
+            if move:
+                move_file(filename,obj+'.new')
+            else:
+                copy_file(filename,obj+'.new')
+            os.replace(obj+'.new',obj)
+        return(sha,st)
+
+    ## Record a new version of the synced tree (stored right away, so edits outside of a sync cannot lose it)
+    def add(self,pth,filename):
+        sha, st = self.put(filename)
+        self.note(pth,'sync',sha,st.st_size,st.st_mtime)
+
+    ## Keep the content of a file before it is replaced or deleted (a move if move=True). The previous content of
+    ## the synced tree (kind sync) is a version already, unless the path was never recorded (then it is recorded
+    ## as generation 0) or the file differs from it; anything else is recorded as a copy kept aside.
+    def keep(self,pth,filename,kind,move=False):
+        sha, st = self.put(filename,move)
+        last = self.latest(pth)
+        if kind == 'sync' and last == None:
+            self.note(pth,'sync',sha,st.st_size,st.st_mtime,0)
+        elif last == None or last.kind != 'sync' or last.sha != sha:
+            self.note(pth,'backup',sha,st.st_size,st.st_mtime)
+
+    ## Append the pending versions to the index (retention pass once a day)
+    def commit(self,gen):
+        if len(self.pending) > 0:
+            create_dir(self.folder)
+            new = not os.path.exists(self.index)
+            with open(self.index,'a') as f:
+                if new:
+                    f.write(BACKUP_HEAD+'\n')
+                for v in self.pending:
+                    v = v._replace(gen=gen if v.gen == None else v.gen)
+                    f.write('\t'.join([str(v.gen),repr(v.time),v.kind,v.sha,str(v.size),repr(v.mtime),v.path])+'\n')
+                    if self.paths != None:
+                        self.paths.setdefault(v.path,[]).append(v)
+            self.pending = []
+        stamp = self.folder+BACKUP_PRUNED
+        if os.path.exists(self.index) and (not os.path.exists(stamp) or os.path.getmtime(stamp) < time.time()-86400):
+            return(self.prune())
+
+    ## Content of the synced tree as of a generation: path -> version (paths below prefix; '' for all)
+    def state(self,gen,prefix=''):
+        state = {}
+        for pth, vs in self.versions().items():
+            if prefix not in ['','.'] and pth != prefix and not pth.startswith(prefix+'/'):
+                continue
+            vs = [v for v in vs if v.gen <= gen and v.kind != 'backup']
+            if len(vs) > 0 and vs[-1].kind == 'sync':
+                state[pth] = vs[-1]
+        return(state)
+
+    ## File that holds the content of a version (None if it is gone)
+    def content(self,v):
+        if os.path.exists(self.object(v.sha)):
+            return(self.object(v.sha))
+        return(None)
+
+    ## Retention: keep what is needed to restore the trees of the last keep generations and of the last days
+    ## (the versions of a path before the one current at that point are dropped, and so are older copies kept
+    ## aside), then delete the contents no version refers to; returns (versions, bytes) removed
+    def prune(self):
+        paths = self.versions()
+        gens = [v.gen for vs in paths.values() for v in vs]
+        if len(gens) == 0:
+            return(0,0)
+        cutoff = max(gens)-self.keepgens
+        recent = [v.gen for vs in paths.values() for v in vs if v.time >= time.time()-self.keepdays*86400]
+        if len(recent) > 0:
+            cutoff = min(cutoff,min(recent))
+        kept = {}
+        dropped = 0
+        for pth, vs in paths.items():
+            base = [i for i, v in enumerate(vs) if v.gen <= cutoff and v.kind != 'backup']
+            first = base[-1] if len(base) > 0 else 0
+            vs2 = [v for i, v in enumerate(vs) if i >= first and (v.kind != 'backup' or v.gen > cutoff)]
+            ## A path deleted before the cutoff did not exist as of the cutoff
+            while len(vs2) > 0 and vs2[0].kind == 'deleted' and vs2[0].gen <= cutoff:
+                vs2.pop(0)
+            dropped += len(vs)-len(vs2)
+            if len(vs2) > 0:
+                kept[pth] = vs2
+        if dropped > 0:
+            with open(self.index+'.new','w') as f:
+                f.write(BACKUP_HEAD+'\n')
+                for v in sorted([v for vs in kept.values() for v in vs],key=lambda v: (v.gen,v.time)):
+                    f.write('\t'.join([str(v.gen),repr(v.time),v.kind,v.sha,str(v.size),repr(v.mtime),v.path])+'\n')
+            os.replace(self.index+'.new',self.index)
+            self.paths = kept
+
+        ## Garbage collection of the contents
+        used = set(v.sha for vs in kept.values() for v in vs)
+        freed = 0
+        for folder, dirs, files in os.walk(self.folder+BACKUP_OBJECTS):
+            for name in files:
+                if os.path.basename(folder)+name not in used:
+                    freed += os.path.getsize(os.path.join(folder,name))
+                    os.unlink(os.path.join(folder,name))
+        with open(self.folder+BACKUP_PRUNED,'w') as f:
+            f.write(str(time.time())+'\n')
+        return(dropped,freed)
+
+#-------------------------
+# Batch
+#-------------------------
+
+## Standard output that goes to a buffer of its own in threads that set one
+class threadout:
+
+    def __init__(self,stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        buffer = getattr(self.local,'buffer',None)
+        return self.stream if buffer == None else buffer
+
+    def write(self,data):
+        return self.target().write(data)
+
+    def flush(self):
+        self.target().flush()
+
+## Directories of a registry file (one per line, # starts a comment)
+def read_roots(filename):
+    roots = []
+    with open(expanduser(filename),'r') as f:
+        for line in f:
+            line = line.split('#',1)[0].strip()
+            if line != '':
+                roots.append(line)
+    return roots
+
+## Quick sync of one directory with its output collected (runs in a batch worker)
+def batch_sync(root):
+    result = {'root':root,'status':'synced','time':0.0,'pad':0,'log':''}
+    buffer = io.StringIO()
+    sys.stdout.local.buffer = buffer
+    stats.target = runstats()
+    start = time.perf_counter()
+    try:
+        otps = otpsync(root)
+        if not otps.under_control(otps.root):
+            result['status'] = 'not set up'
+            return result
+        otps.load_config(otps.root,False)
+        if otps.unchanged():
+            result['status'] = 'unchanged'
+            return result
+        otps.show_config()
+        if otps.run():
+            result['status'] = 'pushed'
+        result['pad'] = sum(p['pad'] for p in stats.phases.values())
+        otps.report_metrics()
+    except SystemExit:
+        result['status'] = 'failed'
+    except Exception as err:
+        result['status'] = 'failed'
+        print(repr(err))
+    finally:
+        result['time'] = time.perf_counter()-start
+        sys.stdout.local.buffer = None
+        result['log'] = buffer.getvalue()
+    return result
+
+## Quick sync of many directories on a bounded worker pool (pad indexes and hashes are shared); True if all succeeded
+def run_batch(roots,workers=BATCH_WORKERS):
+    import concurrent.futures
+    roots = list(collections.OrderedDict((os.path.abspath(expanduser(root)),None) for root in roots))
+    workers = max(1,min(workers,len(roots)))
+    out_head("Batch synchronization of "+str(len(roots))+" directories ("+str(workers)+" workers)")
+    proxy = threadout(sys.stdout)
+    sys.stdout = proxy
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(batch_sync,roots))
+    finally:
+        sys.stdout = proxy.stream
+    fmt_data = '{0:40} {1:10} {2:8.2f} s {3:10d} pad bytes'
+    for result in results:
+        line = fmt_data.format(result['root'],result['status'],result['time'],result['pad'])
+        if result['status'] in ['unchanged','synced','pushed']:
+            out_green(line)
+        else:
+            out_text(line)
+            for log in result['log'].splitlines()[-10:]:
+                print('    '+log)
+    return all(result['status'] in ['unchanged','synced','pushed'] for result in results)
+
+
+#-------------------------
+# Benchmarks
+#-------------------------
+
+## Time a function call (sec)
+def timed(fn,*args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter()-start
+
+## Throughput of the native engine against the onetime subprocess
+def bench_engine(onetime,size=64):
+    import filecmp
+    import shutil
+    import tempfile
+    from subprocess import call
+    results = {}
+    nbytes = size << 20
+    out_head("Encryption throughput ("+str(size)+" MB)")
+    with tempfile.TemporaryDirectory() as tmp:
+        ## Benchmark data only: pseudo random pad and plaintext
+        pad = os.path.join(tmp,'bench_01-01-2000_00-00-00.pad')
+        plain = os.path.join(tmp,'plain')
+        with open(pad,'wb') as f:
+            f.write(os.urandom(2*nbytes+PAD_IDLEN))
+        with open(plain,'wb') as f:
+            f.write(os.urandom(nbytes))
+        fmt_data = '{0:20} {1:9.1f} MB/s'
+
+        def native_encrypt():
+            with open(plain,'rb') as src, open(plain+'.otp','wb') as dst:
+                otp_encrypt(src,dst,padbook(os.path.join(tmp,'native'),tmp),'bench')
+
+        def native_decrypt():
+            with open(plain+'.otp','rb') as src, open(plain+'.out','wb') as dst:
+                otp_decrypt(src,dst,padbook(os.path.join(tmp,'native'),tmp))
+
+        for name, fn in [('native encrypt',native_encrypt),('native decrypt',native_decrypt)]:
+            results[name] = size/timed(fn)
+            out_green(fmt_data.format(name,results[name]))
+        if not filecmp.cmp(plain,plain+'.out',shallow=False):
+            out_text("Native round trip FAILED!")
+
+        ## Subprocess path
+        if not (os.path.exists(onetime) and shutil.which("python2.7")):
+            out_text("onetime not available, skipping subprocess benchmark.")
+            return results
+        conf = os.path.join(tmp,'onetime')
+        for name, args in [('onetime encrypt',["-e","-o",plain+'.1t',plain]),
+                           ('onetime decrypt',["-d","-o",plain+'.1t.out',plain+'.1t'])]:
+            results[name] = size/timed(call,["python2.7",onetime,"-p",pad,"-C",conf]+args)
+            out_green(fmt_data.format(name,results[name]))
+    return results
+
+## Create a synthetic tree (100 files per directory)
+def make_tree(folder,first,count):
+    for i in range(first,first+count):
+        d = os.path.join(folder,'d'+str(i//100))
+        create_dir(d)
+        with open(os.path.join(d,'f'+str(i)),'w') as f:
+            f.write(str(i))
+
+## Scaling of tree scans and local/remote reconciliation (10% of the files differ)
+def bench_scan(counts=(1000,10000,100000)):
+    import tempfile
+    results = []
+    out_head("Tree scan and reconcile")
+    fmt_data = '{0:7d} files: scan {1:8.3f} s, reconcile {2:8.3f} s'
+    for count in counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            make_tree(os.path.join(tmp,'local'),0,count)
+            make_tree(os.path.join(tmp,'remote'),count//10,count)
+            trees = []
+
+            def scan():
+                trees.append(file_structure(os.path.join(tmp,'local')))
+                trees.append(file_structure(os.path.join(tmp,'remote')))
+
+            def reconcile():
+                (local_dirs, local_files), (remote_dirs, remote_files) = trees
+                for pth in intsct(local_files,remote_files):
+                    (local_files[pth].size,local_files[pth].mtime) != (remote_files[pth].size,remote_files[pth].mtime)
+                diff(local_files,remote_files)
+                diff(remote_files,local_files)
+                diff(local_dirs,remote_dirs)
+                diff(remote_dirs,local_dirs)
+
+            results.append({'files':count,'scan':timed(scan),'reconcile':timed(reconcile)})
+            out_green(fmt_data.format(count,results[-1]['scan'],results[-1]['reconcile']))
+    return results
+
+## Reset the peak RSS of this process (Linux only), so that every phase reports its own peak
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+## Peak RSS of this process (MB)
+def peak_rss():
+    import resource
+    try:
+        with open('/proc/self/status','r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/(1<<20) if sys.platform == 'darwin' else rss/1024
+
+## Create a synthetic tree of random files with log-normal sizes; returns the file paths
+def make_sized_tree(folder,count,median,sigma,rng):
+    import math
+    paths = []
+    for i in range(count):
+        pth = os.path.join(folder,'d'+str(i//100),'f'+str(i))
+        create_dir(os.path.dirname(pth))
+        with open(pth,'wb') as f:
+            f.write(os.urandom(min(int(rng.lognormvariate(math.log(median),sigma)),1<<20)))
+        paths.append(pth)
+    return paths
+
+## Client of a benchmark group (pads and cloud stand-in shared by all clients)
+def bench_client(root,ID,mode):
+    folder = os.path.join(root,ID)
+    for sub in ['tmp','backup','onetime']:
+        create_dir(os.path.join(folder,'.otpsync',sub))
+    otps = otpsync(folder)
+    otps.config = {'PADS':os.path.join(root,'pads')+'/','TMP':otps.path('.otpsync/tmp/'),'BACKUP':otps.path('.otpsync/backup/'),
+                   'CLOUD':os.path.join(root,'cloud')+'/','ONETIME':'/usr/bin/onetime','ID':ID,
+                   'GROUP':'bench','MODE':mode,'CONF':otps.path('.otpsync/onetime'),'PADWARN':'0'}
+    return folder, otps
+
+## Run one phase of a client (time, peak RSS, pad bytes used)
+def bench_phase(phases,name,folder,otps,fn,*args):
+    before = otps.padbook().remaining(otps.config['ID'])
+    reset_peak()
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = timed(fn,*args)
+    used = before-otps.padbook().remaining(otps.config['ID'])
+    phases[name] = {'time':t,'rss':peak_rss(),'pad':used}
+
+## Full sync cycle of two clients (initial push, get, local changes, quick sync, get)
+def bench_sync(counts=(100,1000),median=4096,sigma=1.0,ratios=(0.1,),modes=('archive','objects','log')):
+    import shutil
+    import tempfile
+    import random
+    results = []
+    out_head("Sync phases (time, peak RSS, pad bytes)")
+    fmt_data = '{0:8} {1:6d} files {2:4.0%} changed {3:10} {4:8.3f} s {5:8.1f} MB {6:10d} pad bytes'
+    for mode in modes:
+        for count in counts:
+            for ratio in ratios:
+                with tempfile.TemporaryDirectory() as root:
+                    rng = random.Random(count)
+                    ## Both clients and TMP of the pushing client start with the same tree
+                    paths = make_sized_tree(os.path.join(root,'a'),count,median,sigma,rng)
+                    total = sum(os.path.getsize(pth) for pth in paths)
+                    shutil.copytree(os.path.join(root,'a'),os.path.join(root,'b'))
+                    shutil.copytree(os.path.join(root,'a'),os.path.join(root,'seed'))
+                    create_dir(os.path.join(root,'a','.otpsync'))
+                    os.rename(os.path.join(root,'seed'),os.path.join(root,'a','.otpsync','tmp'))
+                    a, otps_a = bench_client(root,'a',mode)
+                    b, otps_b = bench_client(root,'b',mode)
+                    create_dir(os.path.join(root,'cloud','bench'))
+                    create_dir(os.path.join(root,'pads'))
+                    ## Benchmark data only: pseudo random pads
+                    for ID, size in [('a',3*total+(8<<20)),('b',8<<20)]:
+                        with open(os.path.join(root,'pads',ID+'_01-01-2000_00-00-00.pad'),'wb') as f:
+                            for pos in range(0,size,PAD_BLOCK):
+                                f.write(os.urandom(min(PAD_BLOCK,size-pos)))
+
+                    phases = collections.OrderedDict()
+                    bench_phase(phases,'scan',a,otps_a,file_structure,otps_a.root)
+                    bench_phase(phases,'push',a,otps_a,otps_a.put_remote)
+                    bench_phase(phases,'get',b,otps_b,otps_b.get_remote)
+                    bench_phase(phases,'reconcile',b,otps_b,otps_b.sync,False)
+
+                    ## Local changes (same sizes, newer than the remote copies)
+                    future = time.time()+120
+                    for pth in rng.sample(paths,int(count*ratio)):
+                        size = os.path.getsize(pth)
+                        with open(pth,'wb') as f:
+                            f.write(os.urandom(size))
+                        os.utime(pth,(future,future))
+                    bench_phase(phases,'quick get',a,otps_a,otps_a.get_remote)
+                    bench_phase(phases,'quick sync',a,otps_a,otps_a.sync,False)
+                    bench_phase(phases,'quick push',a,otps_a,otps_a.put_remote)
+                    bench_phase(phases,'update get',b,otps_b,otps_b.get_remote)
+                    bench_phase(phases,'update sync',b,otps_b,otps_b.sync,False)
+
+                    for name, phase in phases.items():
+                        out_green(fmt_data.format(mode,count,ratio,name,phase['time'],phase['rss'],phase['pad']))
+                    results.append({'mode':mode,'files':count,'bytes':total,'change':ratio,'phases':phases})
+    return results
 
-## Get modification time by path
-def get_time(path,lst):
-    return int([aa[1] for aa in lst if (aa[0] == path)][0])
+## Run all benchmarks (parameters from bench.cfg) and write the results as JSON
+def bench_all(onetime,cfg='bench.cfg'):
+    import datetime
+    import json
+    import platform
+    info = load_info(cfg)
+    ints = lambda key, default: [int(x) for x in info.get(key,default).split(',')]
+    results = collections.OrderedDict()
+    results['date'] = datetime.datetime.now().isoformat()
+    results['python'] = platform.python_version()
+    results['platform'] = platform.platform()
+    results['params'] = info
+    results['engine'] = bench_engine(onetime,int(info.get('ENGINE','64')))
+    results['scan'] = bench_scan(ints('SCAN','1000,10000,100000'))
+    results['sync'] = bench_sync(ints('FILES','100,1000'),int(info.get('MEDIAN','4096')),float(info.get('SIGMA','1.0')),
+                                 [float(x) for x in info.get('CHANGE','0.1').split(',')],info.get('MODES','archive,objects,log').split(','))
+    output = info.get('OUTPUT','otpsync-bench_'+datetime.datetime.now().strftime('%d-%m-%Y_%H-%M-%S')+'.json')
+    with open(output,'w') as f:
+        json.dump(results,f,indent=1)
+    out_text("Results written to "+output)
 
 
 #*************************************************
@@ -168,11 +3038,73 @@ def get_time(path,lst):
 
 class otpsync:
 
-    def __init__(self):
+    def __init__(self,root='./'):
+        self.root = os.path.join(root,'')
         self.config = {}
         self.rconfig = {}
+        self.cloud = None
+        self.backup = None
+        self.zdicts = {}
         self.script_path=os.path.realpath(__file__)
 
+
+    ## Path of a file in the synced directory
+    def path(self,name):
+        return self.root+name
+
+
+    ## Get, sync and push (quick sync unless ask); returns True if local changes were pushed
+    def run(self,ask=False):
+        if not self.under_control(self.root):
+            out_text(self.root+" is not an active OTPsync directory! Exiting...")
+            exit(1)
+        if len(self.config) == 0:
+            self.load_config(self.root)
+        if not ask and self.unchanged():
+            out_text("Nothing changed since the last sync.")
+            return(False)
+        if os.path.exists(self.path(QUICK_STAMP)):
+            os.unlink(self.path(QUICK_STAMP))
+        self.get_remote()
+        out_line()
+        pushed = self.sync(ask)
+        if pushed:
+            self.put_remote()
+        self.save_stamp()
+        return(pushed)
+
+
+    ## Signature of everything a quick sync depends on: config, cloud group, local tree and TMP
+    def stamp(self):
+        import hashlib
+        state = []
+        try:
+            st = os.stat(self.path('.otpsync/otpsync.cfg'))
+            state.append((st.st_mtime_ns,st.st_size,st.st_ino))
+            state.append(self.store().signature())
+            for folder, cache in [(self.root,'.otpsync/scan-local'),(self.config['TMP'],'.otpsync/scan-tmp')]:
+                t = tree(folder,self.path(cache))
+                t.scan()
+                state.append((sorted(t.dirs.items()),sorted(t.files.items())))
+        except OSError:
+            return(None)
+        return(hashlib.sha256(repr(state).encode()).hexdigest())
+
+
+    ## Whether nothing changed on either side since the last sync (a quick sync would do nothing)
+    def unchanged(self):
+        if not os.path.exists(self.path(QUICK_STAMP)):
+            return(False)
+        with open(self.path(QUICK_STAMP),'r') as f:
+            return(f.read().strip() == self.stamp())
+
+
+    def save_stamp(self):
+        sig = self.stamp()
+        if sig != None:
+            with open(self.path(QUICK_STAMP),'w') as output:
+                output.write(sig+'\n')
+
         
     ## Check whether config file is present
     def under_control(self,pth):
@@ -186,12 +3118,22 @@ class otpsync:
 
     
     ## Load configuration file
-    def load_config(self,pth):
+    def load_config(self,pth,show=True):
+        import re
         regex=re.compile("^([a-zA-Z]+) = (.+)$")
         with open(pth+'.otpsync/otpsync.cfg', "r") as cfg:
             for line in cfg:
                 result = re.match(regex,line)
                 self.config[result.group(1)] = result.group(2)
+        ## Relative paths are relative to the synced directory
+        for key in ['PADS','TMP','BACKUP','CLOUD','CONF']:
+            if key in self.config and not os.path.isabs(expanduser(self.config[key])) and '://' not in self.config[key]:
+                self.config[key] = pth+self.config[key]
+        if show:
+            self.show_config()
+
+    ## Print the configuration
+    def show_config(self):
         out_text("Found the following OTPsync parameters:")
         fmt_data = '{0:7} = {1:20}'
         for key, parameter in self.config.items():
@@ -203,7 +3145,7 @@ class otpsync:
         ## Create directories & files
         create_dir(pth+'.otpsync')
         ## Write configuration
-        with open('.otpsync/otpsync.cfg', "w+") as output:
+        with open(pth+'.otpsync/otpsync.cfg', "w+") as output:
 
             ## Path to OTPs
             data1 = def_input('Path to OTPs','.otpsync/pads/')    
@@ -218,7 +3160,7 @@ class otpsync:
             output.write('BACKUP'+' = '+expanduser(data6)+'\n')
 
             ## Path to cloud directory
-            data3 = def_input('Path to cloud directory','~/Dropbox/otpsync/')
+            data3 = def_input('Path to cloud directory (or s3://bucket/prefix/)','~/Dropbox/otpsync/')
             output.write('CLOUD'+' = '+expanduser(data3)+'\n')
 
             ## Path to onetime
@@ -233,6 +3175,14 @@ class otpsync:
             data5 = def_input('OTPsync group','mysync')
             output.write('GROUP'+' = '+data5+'\n')
 
+            ## Storage mode in the cloud
+            data8 = def_input('Storage mode (archive|objects|log)','archive')
+            output.write('MODE'+' = '+data8+'\n')
+
+            ## Entropy sources for pad generation
+            data9 = def_input('Entropy sources for pads (comma separated)','/dev/random')
+            output.write('RNG'+' = '+data9+'\n')
+
             ## Config directory for onetime
             output.write('CONF'+' = '+'.otpsync/onetime'+'\n')
             
@@ -244,83 +3194,770 @@ class otpsync:
         create_dir(data2)
         ## Backups
         create_dir(data6)
-        ## Cloud
-        create_dir(data3)
-        create_dir(data3+data5)
-        ## Copy otpsync to remote directory
-        if not os.path.exists(expanduser(data3+data5)):
-            out_text("Copying otpsync.py to remote directory ...")
-            shutil.copy2(self.script_path,expanduser(data3+data5))
+        ## Cloud (network stores need no directories)
+        if '://' not in data3:
+            create_dir(data3)
+            create_dir(data3+data5)
+            ## Copy otpsync to remote directory
+            self.config.update({'CLOUD':expanduser(data3),'GROUP':data5})
+            self.copy_script()
+        else:
+            ## Region, endpoint and credentials are set in the config first
+            out_text("Call otpsync copy to copy otpsync.py to the cloud once the store is configured.")
         
 
-    ## Get remote archive (copy, decrypt, extract)
-    def get_remote(self):
-        remote_tar_gz_otp = self.config['CLOUD']+self.config['GROUP']+'/safe.tar.gz.otp'
-        local_tar_gz_otp = './.otpsync/safe.tar.gz.otp'
+    ## Storage of the cloud group
+    def store(self):
+        if self.cloud == None:
+            self.cloud = open_store(self.config['CLOUD'],self.config['GROUP'],self.config)
+        return(self.cloud)
+
+
+    ## Versioned backups of the synced tree
+    def backups(self):
+        if self.backup == None:
+            self.backup = backupstore(self.config['BACKUP'],int(self.config.get('BACKUPKEEP',str(BACKUP_KEEP))),
+                                      float(self.config.get('BACKUPDAYS',str(BACKUP_DAYS))))
+        return(self.backup)
 
-        ## Check whether local files need updating
-        do = True
-        done = False
-        if os.path.exists(remote_tar_gz_otp) and os.path.exists(local_tar_gz_otp):
-            if filecmp.cmp(remote_tar_gz_otp,local_tar_gz_otp):
-                do = False
-                done = True
 
+    ## Generation of the remote data applied or pushed last
+    def generation(self):
+        return(int(load_info(self.path(STATE_FILE)).get('GEN','0')))
+
+
+    ## Decrypt an object of the cloud group
+    def load_remote(self,name,book):
+        data = self.store().read(name)
+        if data == None:
+            out_text("Remote file "+name+" is missing! Exiting...")
+            exit(1)
+        return(load_object(io.BytesIO(data),book))
+
+
+    ## Get remote files
+    @measured('get')
+    def get_remote(self):
         ## Get remote config
         out_text("Loading remote config ...")
         self.get_rconfig()
 
-        if do:
-            ## Copy remote files
-            out_green("Copying remote files ...")
-            call(["cp",remote_tar_gz_otp,local_tar_gz_otp])
+        ## Per-client logs are checked by listing their segments
+        if self.config.get('MODE','archive') == 'log':
+            return(self.get_log() != None)
+
+        ## Nothing to do if this generation has been applied already
+        state = load_info(self.path(STATE_FILE))
+        if 'GEN' in self.rconfig and state.get('GEN') == self.rconfig['GEN'] and state.get('HASH') == self.rconfig.get('HASH'):
+            out_text("Remote generation "+self.rconfig['GEN']+" is up to date.")
+            return(True)
+
+        if self.config.get('MODE','archive') == 'objects':
+            sha = self.get_objects()
+        elif self.seekable():
+            sha = self.get_container()
+        else:
+            sha = self.get_archive()
+
+        ## Remember the generation (unless its data has not arrived in the cloud yet)
+        if sha != None and 'GEN' in self.rconfig:
+            if sha == self.rconfig.get('HASH'):
+                save_info(self.path(STATE_FILE),{'GEN':self.rconfig['GEN'],'HASH':sha})
+            else:
+                out_text("Remote data does not match generation "+self.rconfig['GEN']+" yet.")
+        return(sha != None)
+
+
+    ## Put remote files
+    @measured('put')
+    def put_remote(self):
+        if self.config.get('MODE','archive') == 'objects':
+            sha = self.put_objects()
+        elif self.config.get('MODE','archive') == 'log':
+            sha = self.put_log()
+        elif self.config.get('ARCHIVE','seekable') == 'tar' or self.config.get('COMPRESS','auto') == 'gzip':
+            sha = self.put_archive()
+        else:
+            sha = self.put_container()
+
+        ## Update remote config (next generation)
+        out_green("Updating remote config ...")
+        gen = int(parse_info(self.store().read('safe.info') or b'').get('GEN','0'))+1
+        self.set_remoteid(self.config['ID'])
+        self.set_remotetime(time.time())
+        self.set_remotegen(gen,sha)
+        self.set_rconfig()
+        save_info(self.path(STATE_FILE),{'GEN':str(gen),'HASH':sha})
+        out_done()
+
+
+    ## Get remote archive (stream: decrypt, decompress, extract)
+    def get_archive(self):
+        store = self.store()
+        st = store.stat('safe.tar.gz.otp')
+        if st == None:
+            return(None)
+
+        ## Check whether local files need updating
+        sig = load_sig(self.path(SIG_FILE))
+        if sig != None and sig[0] == st.size:
+            if sig[1] == st.tag or cloud_hash(store,'safe.tar.gz.otp') == sig[2]:
+                save_sig(self.path(SIG_FILE),st,sig[2])
+                return(sig[2])
+
+        with store.open('safe.tar.gz.otp') as f:
+            if not is_native(f):
+                return(self.get_legacy_archive())
+
+            ## Decrypt, decompress and extract remote files
+            out_green("Decrypting and extracting remote files ...")
+            clear_folder(self.config['TMP'])
+            if os.path.exists(self.path(CONTAINER_STATE)):
+                os.unlink(self.path(CONTAINER_STATE))
+            gz, tar = blockpipe(), blockpipe()
+            src = hashed(f)
+            start_stage(decrypt_stage,gz,src,gz,self.padbook())
+            start_stage(decompress_stage,tar,gz,tar)
+            untar(tar,self.config['TMP'])
+        save_sig(self.path(SIG_FILE),st,src.hexdigest())
+        out_done()
+        return(src.hexdigest())
+
+
+    ## Get remote archive written by onetime (copy, decrypt, extract)
+    def get_legacy_archive(self):
+        import shutil
+        from subprocess import call
+        local_tar_gz_otp = self.path('.otpsync/safe.tar.gz.otp')
+
+        ## Copy remote files
+        out_green("Copying remote files ...")
+        with self.store().open('safe.tar.gz.otp') as src, open(local_tar_gz_otp,'wb') as dst:
+            shutil.copyfileobj(src,dst,OTP_BLOCK)
+        out_done()
+
+        ## Decrypt remote files
+        out_green("Decrypting remote files ...")
+        call(["python2.7",self.config['ONETIME'],"-d","-p",self.find_pad(self.rconfig['ID']),
+              "-C",self.config['CONF'],"-o",self.path('.otpsync/safe.tar.gz'),local_tar_gz_otp])
+        out_done()
+
+        ## Extract remote files
+        out_green("Extracting remote files ...\n")
+        clear_folder(self.config['TMP'])
+        call(["tar","vxfz",self.path('.otpsync/safe.tar.gz'),"-C",self.config['TMP']])
+        out_done()
+        sha = file_hash(local_tar_gz_otp)
+        save_sig(self.path(SIG_FILE),self.store().stat('safe.tar.gz.otp'),sha)
+        return(sha)
+
+
+    ## Put remote archive (stream: archive, compress, encrypt into the cloud)
+    def put_archive(self):
+        store = self.store()
+        book = self.padbook()
+
+        ## Upper bound of the archive size (tar headers, incompressible data)
+        dirs, files = file_structure(self.config['TMP'])
+        size = sum(e.size for e in files.values())
+        self.check_pads(book,size+size//100+1024*(len(dirs)+len(files))+20480)
+
+        ## Codec (gzip: archives readable by older versions)
+        codec = choose_codec(self.config['TMP'],self.config.get('COMPRESS','auto'))
+        if codec == 'zdict':
+            codec = 'zlib'
+
+        out_green("Compressing ("+codec+") and encrypting local files ...")
+        tar, gz = blockpipe(), blockpipe()
+        result = {}
+        start_stage(tar_stage,tar,self.config['TMP'],tar)
+        if codec == 'gzip':
+            start_stage(gzip_stage,gz,tar,gz)
+        else:
+            start_stage(compress_stage,gz,tar,gz,codec,result)
+        with store.writer() as out:
+            with out.open('safe.tar.gz.otp') as f:
+                dst = hashed(f)
+                otp_encrypt(gz,dst,book,self.config['ID'])
+        save_sig(self.path(SIG_FILE),store.stat('safe.tar.gz.otp'),dst.hexdigest())
+        self.rconfig['CODEC'] = codec
+        store.delete('safe.otpc')
+        out_done()
+        if codec != 'gzip':
+            stats.packed(codec,result['raw'],result['packed'],result['gzip'])
+        self.report_codecs()
+        self.report_pads(book)
+        return(dst.hexdigest())
+
+
+    ## Whether the group holds a seekable archive (the newer one if there is a tar archive, too)
+    def seekable(self):
+        otpc, tar = self.store().stat('safe.otpc'), self.store().stat('safe.tar.gz.otp')
+        if otpc == None:
+            return(False)
+        return(tar == None or otpc.mtime >= tar.mtime)
+
+
+    ## Get remote seekable archive (decrypt the member index, then only the chunks TMP does not hold yet)
+    def get_container(self):
+        import hashlib
+        import shutil
+        store = self.store()
+        tmp = self.config['TMP']
+        book = self.padbook()
+        old = load_members(self.path(CONTAINER_STATE))
+        fetched = 0
+        downloaded = 0
+        read = lambda offset, length: store.read_range('safe.otpc',offset,length)
+        with store.open('safe.otpc') as f:
+            out_green("Decrypting member index and Merkle tree ...")
+            new, trees, sha = read_container(f,book)
             out_done()
 
-            ## Decrypt remote files
-            out_green("Decrypting remote files ...")
-            call(["python2.7",self.config['ONETIME'],"-d","-p",self.find_pad(self.rconfig['ID']),
-                  "-C",self.config['CONF'],"-o","./.otpsync/safe.tar.gz",local_tar_gz_otp])
+            ## Update changed files in place
+            for pth, m in sorted(new.items()):
+                if m.sha == '-':
+                    if os.path.isfile(tmp+pth):
+                        os.unlink(tmp+pth)
+                    create_dir(tmp+pth)
+                    continue
+                if mirrored(tmp+pth,m,old.get(pth)):
+                    continue
+                out_green("Fetching remote file: "+pth)
+                if trees == None:
+                    data = read_member(f,m,book)
+                    downloaded += m.length
+                else:
+                    data, n = fetch_member(read,tmp+pth,m,trees[pth],book)
+                    downloaded += n
+                if data == None or hashlib.sha256(data).hexdigest() != m.sha:
+                    out_text("Remote file "+pth+" is corrupt! Exiting...")
+                    exit(1)
+                if os.path.isdir(tmp+pth):
+                    shutil.rmtree(tmp+pth)
+                create_dir(os.path.dirname(tmp+pth))
+                with open(tmp+pth,'wb') as output:
+                    output.write(data)
+                os.utime(tmp+pth,ns=(m.mtime,m.mtime))
+                fetched += 1
+            size = f.seek(0,2)
+
+        ## Remove files and directories that are gone on the remote side
+        prune_folder(tmp,new)
+        save_members(self.path(CONTAINER_STATE),new)
+        out_text("Fetched "+str(fetched)+" changed remote files ("+str(downloaded)+" of "+
+                 str(size)+" archive bytes read).")
+        return(sha)
+
+
+    ## Put remote seekable archive (encrypt changed chunks, copy the encrypted chunks of unchanged data)
+    def put_container(self):
+        import hashlib
+        store = self.store()
+        tmp = self.config['TMP']
+        book = self.padbook()
+        ID = self.config['ID']
+        codec = self.config.get('COMPRESS','auto')
+        recorded = load_members(self.path(CONTAINER_STATE))
+
+        ## Hashes of the files (known ones are not read again)
+        dirs, files = file_structure(tmp)
+        shas = {}
+        for pth in files:
+            st = os.stat(tmp+pth)
+            m = recorded.get(pth)
+            if m != None and m.sha != '-' and m.size == st.st_size and m.mtime == st.st_mtime_ns:
+                shas[pth] = m.sha
+            else:
+                shas[pth] = cached_hash(tmp+pth,st) or file_hash(tmp+pth)
+
+        used = 0
+        saved = 0
+        out = store.writer()
+        with out, contextlib.ExitStack() as stack:
+            ## Members and chunks of the current archive by content (version 1 members are encrypted again)
+            src = None
+            old = {}
+            old_chunks = {}
+            if store.exists('safe.otpc'):
+                src = stack.enter_context(store.open('safe.otpc'))
+                members, old_trees, old_sha = read_container(src,book)
+                for pth, m in members.items():
+                    if m.sha != '-' and old_trees != None:
+                        old[m.sha] = (m,old_trees[pth])
+                        for l, offset in zip(old_trees[pth],chunk_offsets(m,old_trees[pth])):
+                            old_chunks[l.hash] = (offset,l)
+
+            ## Upper bound of the pad needed (changed files, Merkle tree, member index)
+            size = sum(os.path.getsize(tmp+pth) for pth in files if shas[pth] not in old)
+            leaves = size//MERKLE_CHUNK+len(files)
+            self.check_pads(book,size+size//100+(len(dirs)+len(files))*(CONTAINER_MEMBER.size+256)+leaves*MERKLE_LEAF.size+1024)
+
+            dst = stack.enter_context(out.open('safe.otpc','w+b'))
+            dst.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC,CONTAINER_VERSION,0,0))
+            new = {}
+            trees = {}
+            written = {}
+            for pth in dirs:
+                if pth != '.':
+                    new[pth] = member('-',0,0,0,0,0)
+            for pth in sorted(files):
+                st = os.stat(tmp+pth)
+                sha = shas[pth]
+                if sha in written:
+                    m, leaves = written[sha]
+                    saved += m.pad
+                elif sha in old:
+                    m, leaves = old[sha]
+                    m = m._replace(offset=copy_range(src,dst,m.offset,m.length))
+                    saved += m.pad
+                else:
+                    ## Chunks of a changed file that the archive holds already are copied as they are
+                    out_green("Encrypting local file: "+pth)
+                    chunks, hashes = file_chunks(tmp+pth)
+                    offset = dst.tell()
+                    leaves = []
+                    for data, h in zip(chunks,hashes):
+                        if h in old_chunks:
+                            l = old_chunks[h][1]
+                            copy_range(src,dst,old_chunks[h][0],l.length)
+                            saved += l.pad
+                        else:
+                            start, length, n = write_member(dst,data,book,ID,codec)
+                            l = leaf(h,length,n)
+                            used += n
+                        leaves.append(l)
+                    m = member(sha,st.st_size,0,offset,dst.tell()-offset,sum(l.pad for l in leaves))
+                    out_done()
+                written[sha] = (m,leaves)
+                new[pth] = m._replace(size=st.st_size,mtime=st.st_mtime_ns)
+                trees[pth] = leaves
+
+            ## Encrypt the Merkle tree and the member index, then fill in the header
+            out_green("Encrypting Merkle tree and member index ...")
+            offset, length, n = write_member(dst,pack_trees(trees),book,ID,codec)
+            used += n
+            merkle = pack_record(b'T',MERKLE_TREE.pack(offset,length,archive_root(trees)))
+            offset, length, n = write_member(dst,merkle+pack_members(new),book,ID,codec)
+            used += n
+            head = CONTAINER_HEADER.pack(CONTAINER_MAGIC,CONTAINER_VERSION,offset,length)
+            dst.seek(0)
+            dst.write(head)
+            dst.seek(offset)
+            sha = hashlib.sha256(head+dst.read(length)).hexdigest()
             out_done()
+        save_members(self.path(CONTAINER_STATE),new)
 
-            ## Extract remote files
-            out_green("Extracting remote files ...\n")
-            clear_folder(self.config['TMP'])
-            call(["tar","vxfz","./.otpsync/safe.tar.gz","-C",self.config['TMP']])
+        ## The tar archive of older versions is outdated now
+        store.delete('safe.tar.gz.otp')
+        self.rconfig['CODEC'] = codec
+        out_text("Used "+str(used)+" pad bytes, saved "+str(saved)+" pad bytes by reusing unchanged data.")
+        self.report_codecs()
+        self.report_pads(book)
+        return(sha)
+
+
+    ## Check the remote seekable archive: Merkle tree, files of TMP that differ, and every chunk (stops at the first bad one)
+    def verify(self):
+        store = self.store()
+        tmp = self.config['TMP']
+        if self.config.get('MODE','archive') != 'archive' or not self.seekable():
+            out_text("Only seekable archives (MODE = archive) can be verified! Exiting...")
+            exit(1)
+        book = self.padbook()
+        read = lambda offset, length: store.read_range('safe.otpc',offset,length)
+        with store.open('safe.otpc') as f:
+            out_green("Decrypting member index and Merkle tree ...")
+            members, trees, sha = read_container(f,book)
             out_done()
-            done = True
+            if trees == None:
+                out_text("The remote archive was written by an older version and has no Merkle tree! Exiting...")
+                exit(1)
+            out_text("Merkle root: "+archive_root(trees).hex())
+
+            ## Files of TMP that differ from the archive (no decryption needed)
+            dirs, files = file_structure(tmp)
+            differ = 0
+            for pth, leaves in sorted(trees.items()):
+                if pth not in files:
+                    out_blue("Missing in TMP: "+pth)
+                    differ += 1
+                    continue
+                diff = merkle_diff(merkle_levels([l.hash for l in leaves]),merkle_levels(file_chunks(tmp+pth)[1]))
+                if len(diff) > 0:
+                    out_blue("Differs from remote: "+pth+" (chunks "+','.join(str(i) for i in diff)+")")
+                    differ += 1
+            for pth in sorted(files):
+                if pth not in trees:
+                    out_blue("Not in the remote archive: "+pth)
+                    differ += 1
 
-        return(done)
+            ## Decrypt every chunk in parallel and check it against its leaf
+            out_green("Verifying "+str(sum(len(l) for l in trees.values()))+" chunks of "+str(len(trees))+" remote files ...")
+            for pth, leaves in sorted(trees.items()):
+                bad = read_chunks(read,members[pth],leaves,list(range(len(leaves))),book)[1]
+                if bad != None:
+                    out_text("Chunk "+str(bad)+" of remote file "+pth+" is corrupt! Exiting...")
+                    exit(1)
+            out_done()
+        out_text(str(differ)+" files of TMP differ from the remote archive.")
+        return(differ == 0)
 
 
-    ## Put remote archive (compress, encrypt, copy)
-    def put_remote(self):
-        remote_tar_gz_otp = self.config['CLOUD']+self.config['GROUP']+'/safe.tar.gz.otp'
-        local_tar_gz_otp = './.otpsync/safe.tar.gz.otp'
+    ## Get remote objects (decrypt manifest, rebuild changed files from chunks)
+    def get_objects(self):
+        import hashlib
+        data = self.store().read('manifest.otp')
+        if data == None:
+            return(None)
+        book = self.padbook()
 
-        ## Compress local files
-        out_green("Compressing local files ...\n")
-        call(["tar","vcfz","./.otpsync/safe.tar.gz","-C",self.config['TMP'],"."])
+        ## Decrypt remote manifest
+        self.load_zdicts(book)
+        out_green("Decrypting remote manifest ...")
+        sha = hashlib.sha256(data).hexdigest()
+        new, chunks = parse_manifest(load_object(io.BytesIO(data),book))
+        old, old_chunks = load_manifest(self.path(LOCAL_MANIFEST))
         out_done()
-        ## Encrypt local files
-        out_green("Encrypting local files ...")
-        call(["python2.7",self.config['ONETIME'],"-e","-C",self.config['CONF'],
-              "-p",self.find_pad(self.config['ID']),"-o",local_tar_gz_otp,"./.otpsync/safe.tar.gz"])
+        fetched, downloaded = self.apply_manifest(new,chunks,old,old_chunks,book)
+        save_manifest(self.path(LOCAL_MANIFEST),new,chunks)
+        out_text("Fetched "+str(fetched)+" changed remote files ("+str(downloaded)+" chunks downloaded).")
+        return(sha)
+
+
+    ## Bring TMP to the state of a manifest (old: manifest TMP was built from)
+    def apply_manifest(self,new,chunks,old,old_chunks,book):
+        import shutil
+        import concurrent.futures
+        tmp = self.config['TMP']
+
+        ## Chunks available in unchanged local files (path, offset)
+        sources = {}
+        def add_sources(pth,e,table):
+            offset = 0
+            for cid in chunk_list(e):
+                if cid not in table:
+                    return
+                sources[cid] = (pth,offset,table[cid].size)
+                offset += table[cid].size
+        for pth, e in old.items():
+            if e.chunks != '-' and os.path.isfile(tmp+pth):
+                st = os.stat(tmp+pth)
+                if st.st_size == e.size and st.st_mtime_ns == e.mtime:
+                    add_sources(pth,e,old_chunks)
+
+        ## Chunk data from a local file or from the cloud (verified, a download is tried twice)
+        downloaded = []
+        def get_chunk(cid):
+            if cid in sources:
+                pth, offset, size = sources[cid]
+                try:
+                    with open(tmp+pth,'rb') as f:
+                        f.seek(offset)
+                        data = f.read(size)
+                    if chunk_id(data) == cid:
+                        return data
+                except OSError:
+                    pass
+            downloaded.append(cid)
+            for attempt in range(2):
+                data = self.load_remote('objects/'+chunks[cid].obj+'.otp',book)
+                if chunk_id(data) == cid:
+                    return data
+            out_text("Remote object "+chunks[cid].obj+" does not match chunk "+cid+"! Exiting...")
+            exit(1)
+
+        ## Rebuild changed files (chunks are fetched in parallel)
+        fetched = 0
+        pool = concurrent.futures.ThreadPoolExecutor(S3_WORKERS)
+        for pth, e in sorted(new.items()):
+            if e.chunks == '-':
+                if os.path.isfile(tmp+pth):
+                    os.unlink(tmp+pth)
+                create_dir(tmp+pth)
+                continue
+            if pth in old and old[pth].chunks == e.chunks and os.path.isfile(tmp+pth):
+                st = os.stat(tmp+pth)
+                if st.st_size == e.size and st.st_mtime_ns == e.mtime:
+                    continue
+            out_green("Fetching remote file: "+pth)
+            data = b''.join(pool.map(counted(get_chunk),chunk_list(e)))
+            if os.path.isdir(tmp+pth):
+                shutil.rmtree(tmp+pth)
+            create_dir(os.path.dirname(tmp+pth))
+            with open(tmp+pth,'wb') as f:
+                f.write(data)
+            os.utime(tmp+pth,ns=(e.mtime,e.mtime))
+            add_sources(pth,e,chunks)
+            fetched += 1
+        pool.shutdown()
+
+        ## Remove files and directories that are gone on the remote side
+        prune_folder(tmp,new)
+        return(fetched,len(downloaded))
+
+
+    ## Put remote objects (encrypt and upload chunks the remote side has not seen)
+    def put_objects(self):
+        import hashlib
+        tmp = self.config['TMP']
+        book = self.padbook()
+        ID = self.config['ID']
+        old, chunks = load_manifest(self.path(LOCAL_MANIFEST))
+        new = build_manifest(tmp,old)
+        store = self.store()
+
+        ## Upper bound of the pad needed (changed files, chunk table lines, manifest)
+        size = sum(e.size for e in new.values() if e.chunks == None)
+        self.check_pads(book,size+size//100+size//CHUNK_MIN*128+len(pack_manifest(old,chunks))+len(new)*256+1024)
+
+        ## Encrypt new chunks of changed files, then the manifest (it appears after all of them)
+        with store.writer() as out:
+            used, saved = self.store_chunks(new,chunks,book,out)
+
+            ## Drop chunks that are no longer referenced
+            live = set()
+            for e in new.values():
+                live.update(chunk_list(e))
+            dead = [chunks.pop(cid) for cid in list(chunks) if cid not in live]
+
+            out_green("Encrypting manifest ...")
+            used += store_object('manifest.otp',pack_manifest(new,chunks),book,ID,
+                                 self.config.get('COMPRESS','auto'),None,out)
+        save_manifest(self.path(LOCAL_MANIFEST),new,chunks)
+        sha = hashlib.sha256(store.read('manifest.otp')).hexdigest()
         out_done()
-        ## Copy local files
-        out_green("Copying local files ...")
-        call(["cp",local_tar_gz_otp,remote_tar_gz_otp])
+
+        ## Remove their objects once the new manifest is in place
+        for c in dead:
+            store.delete('objects/'+c.obj+'.otp')
+        out_text("Used "+str(used)+" pad bytes, saved "+str(saved)+" pad bytes by deduplication.")
+        self.report_codecs()
+        self.report_pads(book)
+        return(sha)
+
+
+    ## Encrypt the chunks of changed files (manifest entries without chunks) the cloud has not seen
+    def store_chunks(self,new,chunks,book,out):
+        import uuid
+        tmp = self.config['TMP']
+        zdict = self.zdict(book,out)
+        used = 0
+        saved = 0
+        for pth, e in sorted(new.items()):
+            if e.chunks == None:
+                out_green("Encrypting local file: "+pth)
+                with open(tmp+pth,'rb') as f:
+                    data = f.read()
+                cids = []
+                for start, end in chunk_bounds(data):
+                    cid = chunk_id(data[start:end])
+                    if cid in chunks:
+                        saved += chunks[cid].pad
+                    else:
+                        obj = uuid.uuid4().hex
+                        n = store_object('objects/'+obj+'.otp',data[start:end],book,self.config['ID'],
+                                         self.config.get('COMPRESS','auto'),zdict,out)
+                        chunks[cid] = centry(obj,end-start,n)
+                        used += n
+                    cids.append(cid)
+                new[pth] = e._replace(chunks=','.join(cids))
+                out_done()
+        return(used,saved)
+
+
+    ## Load the compression dictionaries of the group (decrypted copies are kept in ZDICT_DIR)
+    def load_zdicts(self,book):
+        import re
+        names = self.store().list('objects')
+        if len(names) == 0:
+            return
+        create_dir(self.path(ZDICT_DIR))
+        for name in names:
+            result = re.match("^zdict-([0-9a-f]{16})\\.otp$",name)
+            if result == None or bytes.fromhex(result.group(1)) in self.zdicts:
+                continue
+            key = bytes.fromhex(result.group(1))
+            if key not in zdicts:
+                local = os.path.join(self.path(ZDICT_DIR),result.group(1))
+                if not os.path.exists(local):
+                    with open(local+'.new','wb') as f:
+                        f.write(self.load_remote('objects/'+name,book))
+                    os.replace(local+'.new',local)
+                with open(local,'rb') as f:
+                    zdicts[key] = f.read()
+            self.zdicts[key] = zdicts[key]
+
+
+    ## Dictionary for small files (one stored in the cloud group, or trained on the small files in TMP if the group
+    ## has none yet)
+    def zdict(self,book,out):
+        if self.config.get('COMPRESS','auto') not in ['auto','zdict']:
+            return None
+        self.load_zdicts(book)
+        if len(self.zdicts) > 0:
+            return self.zdicts[min(self.zdicts)]
+
+        ## Retry training only once the number of small files has doubled
+        tmp = self.config['TMP']
+        small = sorted(pth for pth, e in file_structure(tmp)[1].items() if e.size <= ZDICT_SIZE//2)
+        attempt = load_info(os.path.join(self.path(ZDICT_DIR),'untrained'))
+        if len(small) < 16 or len(small) < 2*int(attempt.get('FILES','0')):
+            return None
+        samples = []
+        for pth in small[:256]:
+            with open(tmp+pth,'rb') as f:
+                samples.append(f.read(1 << 12))
+        zdict = train_zdict(samples)
+        create_dir(self.path(ZDICT_DIR))
+
+        ## Only worth it if the samples save more than the dictionary costs itself
+        gain = sum(len(pack(data,'zlib'))-len(pack(data,'zdict',zdict)) for data in samples) if len(zdict) > 0 else 0
+        if gain <= len(pack_best(zdict)[0]):
+            save_info(os.path.join(self.path(ZDICT_DIR),'untrained'),{'FILES':len(small)})
+            return None
+        name = zdict_id(zdict).hex()
+        out_green("Training compression dictionary on "+str(len(samples))+" small files ...")
+        store_object('objects/zdict-'+name+'.otp',zdict,book,self.config['ID'],'auto',None,out)
+        with open(os.path.join(self.path(ZDICT_DIR),name),'wb') as f:
+            f.write(zdict)
+        zdicts[zdict_id(zdict)] = self.zdicts[zdict_id(zdict)] = zdict
         out_done()
-        ## Update remote config
-        out_green("Updating remote config ...")
-        self.set_remoteid(self.config['ID'])
-        self.set_remotetime(time.time())
-        self.set_rconfig()
+        return zdict
+
+
+    ## Report the compression of this push against the gzip path
+    def report_codecs(self):
+        saved = 0
+        for codec, (n, raw, packed, baseline) in sorted(stats.codecs.items()):
+            out_text("Compressed "+str(n)+" x "+codec+": "+str(raw)+" -> "+str(packed)+" bytes (gzip path: "+str(baseline)+" bytes).")
+            saved += baseline-packed
+        if len(stats.codecs) > 0:
+            out_text("Saved "+str(saved)+" pad bytes compared with the gzip path.")
+        stats.codecs = {}
+
+
+    ## Segments published since the applied ones (sorted by Lamport time)
+    def new_segments(self,applied,book):
+        import re
+        segments = []
+        store = self.store()
+        regex = re.compile("^([0-9]{8})\\.otp$")
+        for ID in store.list('log'):
+            for name in store.list('log/'+ID):
+                result = re.match(regex,name)
+                if result != None and int(result.group(1)) > applied.get(ID,(0,0))[0]:
+                    segments.append(read_segment(self.load_remote('log/'+ID+'/'+name,book)))
+        return(sorted(segments,key=lambda seg: (seg.lamport,seg.ID,seg.seq)))
+
+
+    ## Get remote log (merge new segments of all clients, rebuild changed files)
+    def get_log(self):
+        book = self.padbook()
+        applied = load_logs(self.path(LOG_STATE))
+        old, old_chunks = load_manifest(self.path(LOCAL_MANIFEST))
+        ## Start from the manifest of the objects mode
+        if len(applied) == 0 and len(old) == 0 and self.store().exists('manifest.otp'):
+            old, old_chunks = parse_manifest(self.load_remote('manifest.otp',book))
+        self.load_zdicts(book)
+        segments = self.new_segments(applied,book)
+        if len(segments) == 0:
+            if len(applied) == 0:
+                return(None)
+            out_text("Remote log is up to date.")
+            return(log_hash(applied))
+        out_green("Merging "+str(len(segments))+" remote log segments ...")
+        new, chunks = dict(old), dict(old_chunks)
+        merge_segments(new,chunks,segments,applied)
         out_done()
+        fetched, downloaded = self.apply_manifest(new,chunks,old,old_chunks,book)
+        save_manifest(self.path(LOCAL_MANIFEST),new,chunks)
+        save_logs(self.path(LOG_STATE),applied)
+        out_text("Fetched "+str(fetched)+" changed remote files ("+str(downloaded)+" chunks downloaded).")
+        return(log_hash(applied))
+
+
+    ## Put remote log (publish the changes as a new immutable segment of this client)
+    def put_log(self):
+        tmp = self.config['TMP']
+        book = self.padbook()
+        ID = self.config['ID']
+        base, chunks = load_manifest(self.path(LOCAL_MANIFEST))
+        cur = build_manifest(tmp,base)
+
+        ## Upper bound of the pad needed (changed files, chunk table lines, segment)
+        size = sum(e.size for e in cur.values() if e.chunks == None)
+        self.check_pads(book,size+size//100+size//CHUNK_MIN*128+len(cur)*256+1024)
+
+        ## Changes against the state this client has merged
+        known = set(chunks)
+        with self.store().writer() as out:
+            used, saved = self.store_chunks(cur,chunks,book,out)
+        entries = dict((pth,e) for pth, e in cur.items() if base.get(pth) != e)
+        deleted = [pth for pth in base if pth not in cur]
+        added = dict((cid,c) for cid, c in chunks.items() if cid not in known)
+        applied = load_logs(self.path(LOG_STATE))
+
+        while True:
+            ## Optimistic generation check: merge what other clients published meanwhile
+            segments = self.new_segments(applied,book)
+            if len(segments) > 0:
+                out_green("Merging "+str(len(segments))+" concurrent log segments ...")
+                merge_segments(base,chunks,segments,applied)
+                out_done()
+            seq = applied.get(ID,(0,0))[0]+1
+            lamport = max([l for s, l in applied.values()]+[0])+1
+            seg = segment(ID,seq,lamport,entries,deleted,added)
+
+            ## Publish without ever replacing an existing segment
+            out_green("Encrypting log segment "+str(seq)+" ...")
+            sealed, n = seal_object(write_segment(seg),book,ID,self.config.get('COMPRESS','auto'))
+            used += n
+            published = self.store().publish('log/'+ID+'/'+'{:08d}'.format(seq)+'.otp',sealed)
+            out_done()
+            if published:
+                break
+            out_text("Segment "+str(seq)+" was published meanwhile, merging again ...")
+
+        ## Merged state (own changes are already in TMP)
+        merge_segments(base,chunks,[seg],applied)
+        self.apply_manifest(base,chunks,cur,chunks,book)
+        save_manifest(self.path(LOCAL_MANIFEST),base,chunks)
+        save_logs(self.path(LOG_STATE),applied)
+        out_text("Used "+str(used)+" pad bytes, saved "+str(saved)+" pad bytes by deduplication.")
+        self.report_codecs()
+        self.report_pads(book)
+        return(log_hash(applied))
+
+
+    ## Pad index
+    def padbook(self):
+        return open_padbook(self.config['CONF'],self.config['PADS'])
+
+
+    ## Stop before any pad byte is used if the pads of this client cannot take nbytes
+    def check_pads(self,book,nbytes):
+        remaining = book.remaining(self.config['ID'])
+        if remaining < nbytes:
+            out_text("Not enough pad left for "+self.config['ID']+" ("+str(nbytes)+" bytes needed, "
+                     +str(remaining)+" bytes available)! Exiting...")
+            exit(1)
+
+
+    ## Print remaining pad capacity (warn below PADWARN MB)
+    def report_pads(self,book):
+        remaining = book.remaining(self.config['ID'])
+        msg = "Remaining pad capacity: {:.2f} MB in {:d} pads.".format(remaining/1e6,len(book.select(self.config['ID'])))
+        if remaining < float(self.config.get('PADWARN','10'))*1e6:
+            out_text(bcolors.WARNING+msg+" Generate new pads soon!"+bcolors.ENDC)
+        else:
+            out_text(msg)
+
 
-        
     ## Find correct pad (use first find if there are multiple pads for one user)
     def find_pad(self,ID):
-        regex = re.compile("^.*/"+ID+"_[0-9]{2}-[0-9]{2}-[0-9]{4}_[0-9]{2}-[0-9]{2}-[0-9]{2}\.pad$")
+        import re
+        regex = re.compile("^.*/"+ID+r"_[0-9]{2}-[0-9]{2}-[0-9]{4}_[0-9]{2}-[0-9]{2}-[0-9]{2}\.pad$")
         allpads = all_files_of(self.config['PADS'])
         pads = list(filter(regex.match,allpads))
         
@@ -332,26 +3969,57 @@ class otpsync:
         return(pad)
 
 
-    ## Generate pad from /dev/random
-    def generate_pad(self):
-        size = float(def_input('Size of pad in MB','10'))
-        pad_name=self.config['ID']+"_"+datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
-        out_text("Generating pad '"+pad_name+"'")
-        out_text("This may take a while ...")
-        call(["dd","if=/dev/random","of="+self.config['PADS']+pad_name,"bs=1000",
-              "count="+"{:.0f}".format(1000*size)])
+    ## Generate pad from the entropy sources (RNG, comma separated)
+    def generate_pad(self,size=None):
+        import re
+        import datetime
+        if size == None:
+            size = float(def_input('Size of pad in MB','10'))
+        sources = self.config.get('RNG','/dev/random').split(',')
+        ## Resume an interrupted pad of this ID first
+        regex = re.compile(PAD_NAME[:-1]+"\\.part$")
+        parts = [pth for pth in all_files_of(self.config['PADS']) if re.match(regex,os.path.basename(pth))
+                 and pad_owner(pth[:-5])[0] == self.config['ID']]
+        if len(parts) > 0:
+            pad_name = os.path.basename(parts[0][:-5])
+        else:
+            ## Never overwrite an existing pad
+            pad_name = None
+            while pad_name == None or os.path.exists(os.path.join(self.config['PADS'],pad_name)):
+                if pad_name != None:
+                    time.sleep(1)
+                pad_name = self.config['ID']+"_"+datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S")+".pad"
+        out_text("Generating pad '"+pad_name+"' from "+", ".join(sources))
+        out_text("This may take a while ...\n")
+        make_pad(os.path.join(self.config['PADS'],pad_name),int(size*1e6),sources)
         out_done()
 
-             
+
+    ## Keep PADCOUNT active pads of PADSIZE MB for this ID (background refill)
+    def refill_pads(self):
+        import fcntl
+        lock = open(os.path.join(self.config['PADS'],'.refill.lock'),'w')
+        try:
+            fcntl.flock(lock,fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            out_text("Another refill is already running! Exiting...")
+            exit(1)
+        count = int(self.config.get('PADCOUNT','2'))
+        size = float(self.config.get('PADSIZE','10'))
+        out_text("Keeping "+str(count)+" pads of "+str(size)+" MB for "+self.config['ID']+" ...")
+        while True:
+            book = self.padbook()
+            if len(book.select(self.config['ID'])) < count:
+                self.generate_pad(size)
+            else:
+                time.sleep(60)
+
+
     ## Get remote config
     def get_rconfig(self):
-        remote_id_file = self.config['CLOUD']+self.config['GROUP']+'/safe.info'
-        if os.path.exists(remote_id_file):
-            regex=re.compile("^([a-zA-Z]+) = (.+)$")
-            with open(remote_id_file, "r") as cfg:
-                for line in cfg:
-                    result = re.match(regex,line)
-                    self.rconfig[result.group(1)] = result.group(2)
+        data = self.store().read('safe.info')
+        if data != None:
+            self.rconfig.update(parse_info(data))
             out_text("Found the following remote parameters:")
             fmt_data = '{0:7} = {1:20}'
             for key,parameter in self.rconfig.items():
@@ -363,10 +4031,10 @@ class otpsync:
         
     ## Write remote config
     def set_rconfig(self):
-        remote_id_file = self.config['CLOUD']+self.config['GROUP']+'/safe.info'
-        with open(remote_id_file, "w+") as output:
-            for key, data in self.rconfig.items():
-             output.write(key+' = '+str(data)+'\n')
+        with self.store().writer() as out:
+            with out.open('safe.info','w') as output:
+                for key, data in self.rconfig.items():
+                    output.write(key+' = '+str(data)+'\n')
 
              
     ## Set ID in the cloud
@@ -378,9 +4046,17 @@ class otpsync:
     def set_remotetime(self,T):
         self.rconfig['TIME'] = T
 
+
+    ## Set generation and content hash in the cloud
+    def set_remotegen(self,gen,sha):
+        self.rconfig['GEN'] = gen
+        self.rconfig['HASH'] = sha
+
         
     ## Sync
+    @measured('sync')
     def sync(self,ask):
+        import shutil
 
         if ask:
             out_text("Starting full synchronization ...")
@@ -390,25 +4066,65 @@ class otpsync:
         updated = False
         
         ## Get remote and local file tree
-        local_dirs, local_files = file_structure("./")
-        remote_dirs, remote_files = file_structure(self.config['TMP'])
+        local = tree(self.root,self.path('.otpsync/scan-local'))
+        remote = tree(self.config['TMP'],self.path('.otpsync/scan-tmp'))
+        local.scan()
+        remote.scan()
+        local_dirs, local_files = local.dirs, local.files
+        remote_dirs, remote_files = remote.dirs, remote.files
 
-        ## Files to be updated
-        update_paths = intsct(local_files,remote_files)
-
-        
-        for pth in update_paths:
-            ## Local newer than remote
-            if get_time(pth,local_files) > get_time(pth,remote_files)+DT:
-                shutil.copy2(pth,self.config['TMP']+pth)
+        ## Files to be updated: a copy changed if its stat changed since the last sync and so did its content
+        ## (touched or restored files cost no pad); if both changed, the newer one wins
+        synced = load_synced(self.path(SYNC_STATE))
+        known = load_hashes(self.path(HASH_CACHE))
+        backups = self.backups()
+        for pth in intsct(local_files,remote_files):
+            l = (local_files[pth].size,local_files[pth].mtime)
+            r = (remote_files[pth].size,remote_files[pth].mtime)
+            s = synced.get(pth)
+            ## Entries without a hash (written by earlier versions) know nothing about the content
+            if s != None and s.sha == '':
+                s = None
+            if s != None and s.local == l and s.remote == r:
+                continue
+            lsha = content_hash(self.root+pth)
+            rsha = content_hash(self.config['TMP']+pth)
+            if lsha == rsha:
+                synced[pth] = sentry(lsha,l,r)
+                continue
+            lchanged = s == None or (s.local != l and s.sha != lsha)
+            rchanged = s == None or (s.remote != r and s.sha != rsha)
+            ## The copy that is replaced goes to the backups
+            kind = 'sync'
+            if lchanged == rchanged:
+                if s != None:
+                    out_text("Conflicting changes of "+pth+" (keeping the newer copy, the other one goes to the backups).")
+                    kind = 'backup'
+                lchanged = l[1] >= r[1]
+            backups.keep(pth,self.config['TMP']+pth if lchanged else self.root+pth,kind)
+            if lchanged:
+                copy_file(self.root+pth,self.config['TMP']+pth,True)
+                set_hash(self.config['TMP']+pth,lsha)
+                remote.add_file(pth)
                 out_head("Updating remote file: "+pth)
                 updated = True
-            ## Remote newer than local
-            elif DT+get_time(pth,local_files) < get_time(pth,remote_files):
-                shutil.copy2(self.config['TMP']+pth,pth)
+            else:
+                copy_file(self.config['TMP']+pth,self.root+pth,True)
+                set_hash(self.root+pth,rsha)
+                local.add_file(pth)
                 out_head("Updating local file: "+pth)
+            synced[pth] = sentry(lsha if lchanged else rsha,(local.files[pth].size,local.files[pth].mtime),
+                                 (remote.files[pth].size,remote.files[pth].mtime))
+            backups.add(pth,self.root+pth)
 
                 
+        ## Files of a copy go to the backups before they are deleted
+        def discard(t,pth):
+            for key in [key for key in t.files if key == pth or key.startswith(pth+'/')]:
+                backups.keep(key,t.path(key),'backup',move=True)
+                backups.note(key,'deleted')
+            t.remove(pth)
+
         ## Consider new/deleted files & folders only if ask=True
         if ask:
                 
@@ -423,13 +4139,15 @@ class otpsync:
                 while askagain:
                     ask = def_input("Local (d)elete / Remote (c)reate / (i)gnore ?","i")
                     if ask == 'c':
-                        if not os.path.exists(os.path.dirname(self.config['TMP']+pth)):
-                            os.makedirs(os.path.dirname(self.config['TMP']+pth))
-                        shutil.copy2(pth,self.config['TMP']+pth)
+                        create_dir(os.path.dirname(self.config['TMP']+pth))
+                        copy_file(self.root+pth,self.config['TMP']+pth)
+                        remote.add_dir(os.path.dirname(pth))
+                        remote.add_file(pth)
+                        backups.add(pth,self.root+pth)
                         askagain = False
                         updated = True
                     elif ask == 'd':
-                        shutil.move(pth,self.config['BACKUP']+pth)
+                        discard(local,pth)
                         askagain = False
                     elif ask == 'i':
                         askagain = False
@@ -442,22 +4160,22 @@ class otpsync:
                 while askagain:
                     ask = def_input("Local (c)reate / Remote (d)elete / (i)gnore ?","i")
                     if ask == 'c':
-                        if not os.path.exists(os.path.dirname(pth)):
-                            os.makedirs(os.path.dirname(pth))
-                        shutil.copy2(self.config['TMP']+pth,pth)
+                        create_dir(os.path.dirname(self.root+pth))
+                        copy_file(self.config['TMP']+pth,self.root+pth)
+                        local.add_dir(os.path.dirname(pth))
+                        local.add_file(pth)
+                        backups.add(pth,self.root+pth)
                         askagain = False
                     elif ask == 'd':
-                        shutil.move(self.config['TMP']+pth,self.config['BACKUP']+pth)
+                        discard(remote,pth)
                         askagain = False
                         updated = True
                     elif ask == 'i':
                         askagain = False
 
                         
-            ## Get remote and local file tree again (files have been added/deleted)
-            local_dirs, local_files = file_structure("./")
-            remote_dirs, remote_files = file_structure(self.config['TMP'])
-            ## Find differences and ask user what to do
+            ## Find differences and ask user what to do (the trees are updated in place)
+            ignored = set()
             ask_dirs_rl = diff(remote_dirs,local_dirs)
 
             
@@ -469,28 +4187,24 @@ class otpsync:
                 while askagain:
                     ask = def_input("Local (c)reate / Remote (d)elete / (i)gnore ?","i")
                     if ask == 'c':
-                        if not os.path.exists(os.path.dirname(pth)):
-                            os.makedirs(os.path.dirname(pth))
+                        create_dir(self.root+pth)
+                        local.add_dir(pth)
                         askagain = False
                     elif ask == 'd':
+                        discard(remote,pth)
                         shutil.rmtree(self.config['TMP']+pth)
                         askagain = False
                         updated = True                
                     elif ask == 'i':
+                        ignored.add(pth)
                         askagain = False
                 
-                ## Get remote and local file tree again (directories have been added/deleted)
-                local_dirs, local_files = file_structure("./")
-                remote_dirs, remote_files = file_structure(self.config['TMP'])
                 ## Find differences and ask user what to do
-                ask_dirs_rl = diff(remote_dirs,local_dirs)
+                ask_dirs_rl = [d for d in diff(remote_dirs,local_dirs) if d not in ignored]
 
                 
-            ## Get remote and local file tree again (files have been added/deleted)
-            local_dirs, local_files = file_structure("./")
-            remote_dirs, remote_files = file_structure(self.config['TMP'])
             ## Find differences and ask user what to do
-            ask_dirs_lr = diff(local_dirs,remote_dirs)
+            ask_dirs_lr = [d for d in diff(local_dirs,remote_dirs) if d not in ignored]
 
             
             while len(ask_dirs_lr)> 0:
@@ -501,175 +4215,446 @@ class otpsync:
                 while askagain:
                     ask = def_input("Remote (c)reate / Local (d)elete / (i)gnore ?","i")
                     if ask == 'c':
-                        if not os.path.exists(os.path.dirname(self.config['TMP']+pth)):
-                            os.makedirs(os.path.dirname(self.config['TMP']+pth))
+                        create_dir(self.config['TMP']+pth)
+                        remote.add_dir(pth)
                         askagain = False
                         updated = True                
                     elif ask == 'd':
-                        shutil.rmtree(pth)
+                        discard(local,pth)
+                        shutil.rmtree(self.root+pth)
                         askagain = False
                     elif ask == 'i':
+                        ignored.add(pth)
                         askagain = False
                         
-                ## Get remote and local file tree again (directories have been added/deleted)
-                local_dirs, local_files = file_structure("./")
-                remote_dirs, remote_files = file_structure(self.config['TMP'])
                 ## Find differences and ask user what to do
-                ask_dirs_lr = diff(local_dirs,remote_dirs)
+                ask_dirs_lr = [d for d in diff(local_dirs,remote_dirs) if d not in ignored]
 
+        local.save()
+        remote.save()
+        save_synced(self.path(SYNC_STATE),dict((pth,s) for pth, s in synced.items() if pth in local.files and pth in remote.files))
+        ## Versions of this sync belong to the generation it pushes
+        backups.commit(self.generation()+1 if updated else self.generation())
+        if len(hash_cache) != known:
+            save_hashes(self.path(HASH_CACHE),(os.path.abspath(self.root)+os.sep,os.path.abspath(self.config['TMP'])+os.sep))
         return updated
 
+    ## List the versions of the files below pth (a summary of all generations if pth is '')
+    def list_versions(self,pth=''):
+        paths = self.backups().versions()
+        date = lambda t: time.strftime('%d-%m-%Y %H:%M:%S',time.localtime(t))
+        pth = os.path.normpath(pth) if pth != '' else '.'
+        if pth == '.':
+            gens = {}
+            for vs in paths.values():
+                for v in vs:
+                    g = gens.setdefault(v.gen,[v.time,0])
+                    g[0] = min(g[0],v.time)
+                    g[1] += 1
+            fmt_data = '{0:>10}  {1:19}  {2:>8}'
+            out_blue(fmt_data.format('Generation','Time','Versions'))
+            for gen in sorted(gens):
+                out_text(fmt_data.format(gen,date(gens[gen][0]),gens[gen][1]))
+            out_text(str(len(paths))+" paths in the backups, current generation "+str(self.generation())+".")
+            return(True)
+        keys = sorted(key for key in paths if key == pth or key.startswith(pth+'/'))
+        if len(keys) == 0:
+            out_text("No versions of "+pth+" in the backups.")
+            return(False)
+        fmt_data = '{0:>10}  {1:19}  {2:8}  {3:12}  {4:>10}  {5}'
+        out_blue(fmt_data.format('Generation','Time','Kind','Hash','Size','Path'))
+        for key in keys:
+            for v in paths[key]:
+                out_text(fmt_data.format(v.gen,date(v.time),v.kind,v.sha[:12],v.size if v.kind != 'deleted' else '',key))
+        return(True)
+
+
+    ## Restore the files below pth as of a generation (default: the current one) into dest (default: the synced
+    ## directory, where a file that differs goes to the backups first); returns False if a version is not available
+    def restore(self,pth,gen=None,dest=None):
+        backups = self.backups()
+        gen = self.generation() if gen == None else gen
+        pth = os.path.normpath(pth)
+        state = backups.state(gen,pth)
+
+        ## Files never recorded have not changed since the backups were started (only needed for another destination)
+        live = {}
+        if dest != None:
+            local = tree(self.root)
+            local.scan()
+            prefix = '' if pth == '.' else pth+'/'
+            versions = backups.versions()
+            for key, e in local.files.items():
+                key = os.path.normpath(key)
+                if (key == pth or key.startswith(prefix)) and key not in versions:
+                    live[key] = self.root+key
+                    state[key] = bversion(0,0.0,'sync',content_hash(live[key]),e.size,e.mtime,key)
+        if len(state) == 0:
+            out_text("No files below "+pth+" as of generation "+str(gen)+"!")
+            return(False)
+
+        ok = True
+        restored = unchanged = 0
+        for key, v in sorted(state.items()):
+            target = os.path.join(expanduser(dest),key) if dest != None else self.root+key
+            src = live.get(key) or backups.content(v)
+            if src == None:
+                out_text("No copy of "+key+" as of generation "+str(gen)+" is left!")
+                ok = False
+                continue
+            if os.path.isfile(target):
+                if content_hash(target) == v.sha:
+                    unchanged += 1
+                    continue
+                if dest == None:
+                    backups.keep(key,target,'backup')
+                os.unlink(target)
+            create_dir(os.path.dirname(target))
+            copy_file(src,target)
+            ## Files restored in place are new edits (pushed by the next sync)
+            if dest != None:
+                os.utime(target,(v.mtime,v.mtime))
+            else:
+                os.utime(target)
+            out_head("Restored: "+key)
+            restored += 1
+        backups.commit(self.generation())
+        out_text("Restored "+str(restored)+" files as of generation "+str(gen)+" ("+str(unchanged)+" unchanged).")
+        return(ok)
+
+
+    ## Retention and garbage collection of the backups (BACKUPKEEP generations, BACKUPDAYS days)
+    def prune_backups(self):
+        dropped, freed = self.backups().prune()
+        out_text("Removed "+str(dropped)+" versions and "+str(freed//1024)+" KB from the backups.")
+
+
+    ## Watch for changes and sync continuously (quick sync, pushes batched over DEBOUNCE seconds)
+    def watch(self):
+        debounce = float(self.config.get('DEBOUNCE','5'))
+        ## Network stores are polled
+        try:
+            watcher = inotify_watch(self.root,self.store().folder)
+            out_text("Watching for changes (inotify) ...")
+        except (OSError,AttributeError,TypeError):
+            watcher = poll_watch(self.root,self.store(),float(self.config.get('POLL','2')))
+            out_text("Watching for changes (polling) ...")
+        remote = True
+        first = last = None
+        while True:
+            ## Apply remote updates right away, push local changes once they have settled (or after ten debounce
+            ## windows at most); both get first, so a newer upload of another client is merged before a push
+            now = time.time()
+            settled = first != None and (now-last >= debounce or now-first >= 10*debounce)
+            if remote or settled:
+                if settled:
+                    first = last = None
+                self.get_remote()
+                if self.sync(False):
+                    self.put_remote()
+                self.report_metrics()
+                out_line()
+            local, remote = watcher.wait(debounce if first == None else max(0,min(last+debounce,first+10*debounce)-now))
+            if local:
+                last = time.time()
+                if first == None:
+                    first = last
+
+
+    ## Write profile and metrics of this run (PROFILE: pstats file, METRICS: JSON or .prom textfile)
+    def report_metrics(self):
+        import json
+        if stats.profiler != None:
+            stats.profiler.dump_stats(self.config['PROFILE'])
+        if 'METRICS' not in self.config or len(stats.phases) == 0:
+            stats.clear()
+            return
+        remaining = self.padbook().remaining(self.config['ID'])
+
+        ## Cumulative counters of all runs
+        totals = {'runs':0,'steps':{}}
+        if os.path.exists(self.path(METRICS_FILE)):
+            with open(self.path(METRICS_FILE),'r') as f:
+                totals = json.load(f)
+        totals['runs'] += 1
+        totals['last'] = time.time()
+        for step, p in stats.phases.items():
+            total = totals['steps'].setdefault(step,{'calls':0,'time':0.0,'bytes':0,'pad':0})
+            for key in total:
+                total[key] += p[key]
+        with open(self.path(METRICS_FILE)+'.new','w') as f:
+            json.dump(totals,f)
+        os.replace(self.path(METRICS_FILE)+'.new',self.path(METRICS_FILE))
+
+        ## Replace the export in one step (node exporter may read it any time)
+        output = expanduser(self.config['METRICS'])
+        with open(output+'.new','w') as f:
+            if output.endswith('.prom'):
+                f.write(prometheus({'id':self.config['ID'],'group':self.config['GROUP']},stats.phases,totals,remaining))
+            else:
+                json.dump({'id':self.config['ID'],'group':self.config['GROUP'],'time':totals['last'],
+                           'steps':stats.phases,'pad_remaining':remaining,'totals':totals},f,indent=1)
+        os.replace(output+'.new',output)
+        stats.clear()
+
+
     ## Copy otpsync to remote directory
     def copy_script(self):
-        remote_script = self.config['CLOUD']+self.config['GROUP']+'/otpsync.py'
-        if not os.path.exists(expanduser(remote_script)):
+        if not self.store().exists('otpsync.py'):
             out_text("Copying otpsync.py to remote directory ...")
         else:
             out_text("Replacing otpsync.py in remote directory ...")
-        shutil.copy2(self.script_path,expanduser(remote_script))
+        with self.store().writer() as out:
+            copy_file(self.script_path,out.stage('otpsync.py'))
     
                 
-###################### MAIN ######################
+## Programmatic interface: Sync(root).run()
+Sync = otpsync
 
-# No parameter
-if len(sys.argv) == 1:
-    
-    ## Check whether local directory is under otpsync control:
-    otps = otpsync()
-    if otps.under_control("./"):
-        print_info()
-        otps.load_config("./")
-        otps.get_remote()
-        out_line()
-        synced = otps.sync(False) # Noask
-        if synced:
-            otps.put_remote()
-        out_line()
-        out_text("Finished. Have a nice day ...")
-        out_line()
-        exit(0)
-    else:
-        print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
-        exit(1)
 
-## Single parameter
-elif len(sys.argv) == 2:
+###################### MAIN ######################
 
-    ## Print help
-    if sys.argv[1] in ['help','-h','h']:
-        print_help();
-        exit(0)
+## Command line interface
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv
 
-    ## Copy otpsync.py to remote destination
-    if sys.argv[1] in ['copy','-c','c']:
+    # No parameter
+    if len(argv) == 1:
+
+        ## Check whether local directory is under otpsync control:
         otps = otpsync()
         if otps.under_control("./"):
+            ## Fast path for hooks and cron jobs (checked before any other output)
+            otps.load_config("./",False)
+            if otps.unchanged():
+                out_text("Nothing changed since the last sync.")
+                exit(0)
             print_info()
-            otps.load_config("./")
+            otps.show_config()
+            otps.run(False) # Noask
+            otps.report_metrics()
             out_line()
-            otps.copy_script()
+            out_text("Finished. Have a nice day ...")
             out_line()
             exit(0)
         else:
             print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
             exit(1)
 
-    ## Create OTP from /dev/random for this ID
-    if sys.argv[1] in ['otp','-o','o']:
+    ## Sync many directories at once
+    elif argv[1] in ['batch','-m','m']:
+        workers = BATCH_WORKERS
+        roots = []
+        for arg in argv[2:]:
+            if arg.startswith('-j'):
+                workers = int(arg[2:])
+            elif arg.startswith('@'):
+                roots += read_roots(arg[1:])
+            else:
+                roots.append(arg)
+        if len(roots) == 0:
+            roots = read_roots(BATCH_FILE)
+        out_line()
+        ok = run_batch(roots,workers)
+        out_line()
+        exit(0 if ok else 1)
+
+    ## Backups: list versions, restore files, retention
+    elif argv[1] in ['versions','restore','prune'] and len(argv) <= 5:
         otps = otpsync()
-        if otps.under_control("./"):
-            print_info()
-            otps.load_config("./")
-            out_line()
-            otps.generate_pad()
-            out_line()
-            exit(0)
-        else:
+        if not otps.under_control("./"):
             print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
             exit(1)
-            
-    ## Create OTPsync structure
-    if sys.argv[1] in ['init','-i','i']:
-        otps = otpsync()
-        if not otps.under_control("./"):
-            print_info()
-            otps.create_config("./")
-            exit(0)
+        otps.load_config("./")
+        out_line()
+        if argv[1] == 'versions' and len(argv) <= 3:
+            ok = otps.list_versions(argv[2] if len(argv) == 3 else '')
+        elif argv[1] == 'restore' and len(argv) >= 3:
+            ok = otps.restore(argv[2],int(argv[3]) if len(argv) >= 4 else None,argv[4] if len(argv) == 5 else None)
+        elif argv[1] == 'prune' and len(argv) == 2:
+            otps.prune_backups()
+            ok = True
         else:
-            print(bcolors.WARNING + "This is already an active OTPsync directory!" + bcolors.ENDC)
+            print(bcolors.WARNING + "Wrong number of arguments!" + bcolors.ENDC)
+            print_help();
             exit(1)
+        out_line()
+        exit(0 if ok else 1)
 
-    ## Push local data in cloud (overwrites remote files)
-    if sys.argv[1] in ['push','-p','p']:
-        otps = otpsync()
-        if otps.under_control("./"):
-            print_info()
-            otps.load_config("./")
-            while True:
-                uin = def_input("Overwrite remote files? (yes|no)","no")
-                if uin == 'yes': 
-                    otps.put_remote()
-                    exit(0)
-                elif uin == 'no':
-                    exit(0)
-        else:
-            print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
-            exit(1)
+    ## Single parameter
+    elif len(argv) == 2:
 
-    ## Get remote data (overwrites local files)
-    if sys.argv[1] in ['get','-g','g']:
-        otps = otpsync()
-        if otps.under_control("./"):
-            print_info()
-            otps.load_config("./")
-            while True:
-                uin = def_input("Overwrite local files? (yes|no)","no")
-                if uin == 'yes': 
-                    otps.get_remote()
-                    exit(0)
-                elif uin == 'no':
-                    exit(0)
-        else:
-            print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
-            exit(1)
-            
-    ## Sync directory
-    if sys.argv[1] in ['sync','-s','s']:
-        ## Check whether local directory is under otpsync control:
-        otps = otpsync()
-        if otps.under_control("./"):
-            print_info()
-            otps.load_config("./")
-            otps.get_remote()
-            out_line()
-            synced = otps.sync(True) # Ask
-            if synced:
-                otps.put_remote()
+        ## Print help
+        if argv[1] in ['help','-h','h']:
+            print_help();
+            exit(0)
+
+        ## Copy otpsync.py to remote destination
+        if argv[1] in ['copy','-c','c']:
+            otps = otpsync()
+            if otps.under_control("./"):
+                print_info()
+                otps.load_config("./")
+                out_line()
+                otps.copy_script()
+                out_line()
+                exit(0)
+            else:
+                print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
+                exit(1)
+
+        ## Create OTP from /dev/random for this ID
+        if argv[1] in ['otp','-o','o']:
+            otps = otpsync()
+            if otps.under_control("./"):
+                print_info()
+                otps.load_config("./")
+                out_line()
+                otps.generate_pad()
+                out_line()
+                exit(0)
+            else:
+                print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
+                exit(1)
+
+        ## Benchmark encryption engine
+        if argv[1] in ['bench','-b','b']:
+            otps = otpsync()
+            onetime = '/usr/bin/onetime'
+            if otps.under_control("./"):
+                otps.load_config("./")
+                onetime = otps.config['ONETIME']
             out_line()
-            out_text("Finished. Have a nice day ...")
+            bench_all(onetime)
             out_line()
             exit(0)
+
+        ## Watch and sync continuously
+        if argv[1] in ['watch','-w','w']:
+            otps = otpsync()
+            if otps.under_control("./"):
+                print_info()
+                otps.load_config("./")
+                out_line()
+                try:
+                    otps.watch()
+                except KeyboardInterrupt:
+                    out_line()
+                    out_text("Stopped watching. Have a nice day ...")
+                    out_line()
+                    exit(0)
+            else:
+                print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
+                exit(1)
+
+        ## Verify the remote archive
+        if argv[1] in ['verify','-v','v']:
+            otps = otpsync()
+            if otps.under_control("./"):
+                otps.load_config("./")
+                out_line()
+                ok = otps.verify()
+                out_line()
+                exit(0 if ok else 1)
+            else:
+                print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
+                exit(1)
+
+        ## Keep pads for this ID topped up
+        if argv[1] in ['refill','-r','r']:
+            otps = otpsync()
+            if otps.under_control("./"):
+                otps.load_config("./")
+                out_line()
+                otps.refill_pads()
+            else:
+                print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
+                exit(1)
+
+        ## Create OTPsync structure
+        if argv[1] in ['init','-i','i']:
+            otps = otpsync()
+            if not otps.under_control("./"):
+                print_info()
+                otps.create_config("./")
+                exit(0)
+            else:
+                print(bcolors.WARNING + "This is already an active OTPsync directory!" + bcolors.ENDC)
+                exit(1)
+
+        ## Push local data in cloud (overwrites remote files)
+        if argv[1] in ['push','-p','p']:
+            otps = otpsync()
+            if otps.under_control("./"):
+                print_info()
+                otps.load_config("./")
+                while True:
+                    uin = def_input("Overwrite remote files? (yes|no)","no")
+                    if uin == 'yes': 
+                        otps.put_remote()
+                        otps.report_metrics()
+                        exit(0)
+                    elif uin == 'no':
+                        exit(0)
+            else:
+                print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
+                exit(1)
+
+        ## Get remote data (overwrites local files)
+        if argv[1] in ['get','-g','g']:
+            otps = otpsync()
+            if otps.under_control("./"):
+                print_info()
+                otps.load_config("./")
+                while True:
+                    uin = def_input("Overwrite local files? (yes|no)","no")
+                    if uin == 'yes': 
+                        otps.get_remote()
+                        otps.report_metrics()
+                        exit(0)
+                    elif uin == 'no':
+                        exit(0)
+            else:
+                print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
+                exit(1)
+
+        ## Sync directory
+        if argv[1] in ['sync','-s','s']:
+            ## Check whether local directory is under otpsync control:
+            otps = otpsync()
+            if otps.under_control("./"):
+                print_info()
+                otps.load_config("./")
+                otps.run(True) # Ask
+                otps.report_metrics()
+                out_line()
+                out_text("Finished. Have a nice day ...")
+                out_line()
+                exit(0)
+            else:
+                print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
+                print_help();
+                exit(1)
+
         else:
-            print(bcolors.WARNING + "This is not an active OTPsync directory!" + bcolors.ENDC)
             print_help();
-            exit(1)
+            exit(0)
+
+    ## Double parameter
+    elif len(argv) == 3:
+        print(bcolors.WARNING + "Wrong number of arguments!" + bcolors.ENDC)
+        print_help();
+        exit(1)
 
+    ## No valid call
     else:
+        print(bcolors.WARNING + "Wrong number of arguments!" + bcolors.ENDC)
         print_help();
-        exit(0)
-            
-## Double parameter
-elif len(sys.argv) == 3:
-    print(bcolors.WARNING + "Wrong number of arguments!" + bcolors.ENDC)
-    print_help();
-    exit(1)
-
-## No valid call
-else:
-    print(bcolors.WARNING + "Wrong number of arguments!" + bcolors.ENDC)
-    print_help();
-    exit(1)
+        exit(1)
 
-    
-###################### MAIN ######################
 
+if __name__ == '__main__':
+    main()
+
+###################### MAIN ######################
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+##
+## S3 STAND-IN
+## ===========
+## (A minimal in-memory S3 server to test the S3 store of otpsync)
+##
+## Run as >> python3 ./s3server.py PORT [FAIL]
+## and set ENDPOINT = http://127.0.0.1:PORT in .otpsync/otpsync.cfg.
+## FAIL is the share of requests that fail (5xx or a dropped connection).
+
+import sys
+import time
+import random
+import hashlib
+import hmac
+import threading
+import socket
+import email.utils
+import urllib.parse
+import http.server
+import socketserver
+
+## Keys per page of object listings (small, so paging is exercised)
+PAGE = 3
+
+## Credentials the server accepts (ACCESSKEY and SECRETKEY in the config)
+ACCESSKEY = 'test'
+SECRETKEY = 'test'
+
+## Request handler (objects, uploads and counters are kept by the server)
+class handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        super().setup()
+
+    def log_message(self,*args):
+        pass
+
+    ## Key, query and body of a request (None after a 403 if it is not signed with the secret of the server)
+    def parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = urllib.parse.unquote(url.path).split('/',2)
+        key = parts[2] if len(parts) > 2 else ''
+        pairs = urllib.parse.parse_qsl(url.query,keep_blank_values=True)
+        n = int(self.headers.get('Content-Length','0'))
+        body = self.rfile.read(n) if n > 0 else b''
+        if hashlib.sha256(body).hexdigest() != self.headers.get('x-amz-content-sha256') or not self.signed(url.path,pairs):
+            self.server.count('denied')
+            self.send(403)
+            return None
+        self.server.count(self.command)
+        return key, dict(pairs), body
+
+    ## Check the signature (AWS Signature Version 4, rebuilt from the request as received)
+    def signed(self,path,pairs):
+        auth = self.headers.get('Authorization','')
+        if not auth.startswith('AWS4-HMAC-SHA256 '):
+            return False
+        fields = dict(item.strip().split('=',1) for item in auth[len('AWS4-HMAC-SHA256 '):].split(','))
+        key, scope = fields['Credential'].split('/',1)
+        date = self.headers.get('x-amz-date','')
+        if key != self.server.key or not scope.startswith(date[:8]+'/') or not scope.endswith('/s3/aws4_request'):
+            return False
+        names = fields['SignedHeaders'].split(';')
+        if 'host' not in names or 'x-amz-date' not in names or 'x-amz-content-sha256' not in names:
+            return False
+        query = '&'.join(urllib.parse.quote(k,safe='~')+'='+urllib.parse.quote(v,safe='~') for k, v in sorted(pairs))
+        headers = ''.join(name+':'+' '.join(self.headers.get(name,'').split())+'\n' for name in names)
+        canonical = '\n'.join([self.command,path,query,headers,';'.join(names),self.headers['x-amz-content-sha256']])
+        text = 'AWS4-HMAC-SHA256\n'+date+'\n'+scope+'\n'+hashlib.sha256(canonical.encode()).hexdigest()
+        k = ('AWS4'+self.server.secret).encode()
+        for part in scope.split('/'):
+            k = hmac.new(k,part.encode(),hashlib.sha256).digest()
+        return hmac.compare_digest(hmac.new(k,text.encode(),hashlib.sha256).hexdigest(),fields['Signature'])
+
+    def send(self,status,data=b'',headers={}):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key,value)
+        if self.command == 'HEAD' and status == 200:
+            self.send_header('Content-Length',headers['X-Length'])
+        else:
+            self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    ## Fail a share of the requests (half with 503, half by dropping the connection)
+    def fail(self):
+        if random.random() >= self.server.failure:
+            return False
+        if random.random() < 0.5:
+            self.send(503)
+        else:
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+        return True
+
+    def meta(self,key):
+        data, mtime = self.server.objects[key]
+        return {'ETag':'"'+hashlib.md5(data).hexdigest()+'"','Last-Modified':email.utils.formatdate(mtime,usegmt=True),
+                'X-Length':str(len(data))}
+
+    def do_HEAD(self):
+        request = self.parse()
+        if request == None or self.fail():
+            return
+        key, query, body = request
+        if key not in self.server.objects:
+            return self.send(404)
+        self.send(200,b'',self.meta(key))
+
+    def do_GET(self):
+        request = self.parse()
+        if request == None or self.fail():
+            return
+        key, query, body = request
+        if query.get('list-type') == '2':
+            return self.send(200,self.listing(query))
+        if key not in self.server.objects:
+            return self.send(404)
+        data = self.server.objects[key][0]
+        if 'Range' in self.headers:
+            start, end = self.headers['Range'].split('=')[1].split('-')
+            start, end = int(start), min(int(end),len(data)-1)
+            if start >= len(data):
+                return self.send(416)
+            return self.send(206,data[start:end+1],self.meta(key))
+        self.send(200,data,self.meta(key))
+
+    ## ListObjectsV2 (paged, folders on the first page)
+    def listing(self,query):
+        prefix = query.get('prefix','')
+        delimiter = query.get('delimiter')
+        files = []
+        folders = []
+        for key in sorted(k for k in self.server.objects if k.startswith(prefix)):
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                folder = prefix+rest.split(delimiter)[0]+delimiter
+                if folder not in folders:
+                    folders.append(folder)
+            else:
+                files.append(key)
+        start = int(query.get('continuation-token','0'))
+        xml = '<?xml version="1.0"?><ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+        for key in files[start:start+PAGE]:
+            data = self.server.objects[key][0]
+            xml += '<Contents><Key>'+key+'</Key><Size>'+str(len(data))+'</Size><ETag>"'+hashlib.md5(data).hexdigest()+'"</ETag></Contents>'
+        if start == 0:
+            for folder in folders:
+                xml += '<CommonPrefixes><Prefix>'+folder+'</Prefix></CommonPrefixes>'
+        if start+PAGE < len(files):
+            xml += '<NextContinuationToken>'+str(start+PAGE)+'</NextContinuationToken>'
+        return (xml+'</ListBucketResult>').encode()
+
+    def do_PUT(self):
+        request = self.parse()
+        if request == None or self.fail():
+            return
+        key, query, body = request
+        etag = {'ETag':'"'+hashlib.md5(body).hexdigest()+'"'}
+        if 'uploadId' in query:
+            self.server.uploads[query['uploadId']][int(query['partNumber'])] = body
+            return self.send(200,b'',etag)
+        with self.server.lock:
+            if self.headers.get('If-None-Match') == '*' and key in self.server.objects:
+                return self.send(412)
+            self.server.objects[key] = (body,time.time())
+        self.send(200,b'',etag)
+
+    def do_POST(self):
+        request = self.parse()
+        if request == None or self.fail():
+            return
+        key, query, body = request
+        if 'uploads' in query:
+            upload = str(random.getrandbits(64))
+            self.server.uploads[upload] = {}
+            return self.send(200,('<InitiateMultipartUploadResult><UploadId>'+upload+
+                                  '</UploadId></InitiateMultipartUploadResult>').encode())
+        parts = self.server.uploads.pop(query['uploadId'])
+        self.server.objects[key] = (b''.join(parts[n] for n in sorted(parts)),time.time())
+        self.server.count('multipart')
+        self.send(200,b'<CompleteMultipartUploadResult></CompleteMultipartUploadResult>')
+
+    def do_DELETE(self):
+        request = self.parse()
+        if request == None or self.fail():
+            return
+        key, query, body = request
+        if 'uploadId' in query:
+            self.server.uploads.pop(query['uploadId'],None)
+        else:
+            self.server.objects.pop(key,None)
+        self.send(204)
+
+## Threaded server with the objects of one bucket in memory
+class s3server(socketserver.ThreadingMixIn,http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self,port=0,failure=0.0,key=ACCESSKEY,secret=SECRETKEY):
+        super().__init__(('127.0.0.1',port),handler)
+        self.failure = failure
+        self.key = key
+        self.secret = secret
+        self.objects = {}
+        self.uploads = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self,name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name,0)+1
+
+    ## Endpoint for ENDPOINT in the config
+    def endpoint(self):
+        return 'http://127.0.0.1:'+str(self.server_address[1])
+
+    ## Serve in a background thread
+    def start(self):
+        threading.Thread(target=self.serve_forever,daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    server = s3server(int(sys.argv[1]),float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
+    print("Serving on "+server.endpoint()+" ...")
+    server.serve_forever()
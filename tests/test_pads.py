@@ -0,0 +1,187 @@
+##
+## Tests of the pad engine (otp_encrypt / otp_decrypt) and of the pad index shared by processes (padbook)
+##
+## Run as >> python3 -m pytest tests
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import otpsync
+
+
+## Write a pad of a client ID (size includes the reserved ID bytes)
+def make_pad(folder,ID,size,created='01-01-2000_00-00-00'):
+    pth = os.path.join(folder,ID+'_'+created+'.pad')
+    with open(pth,'wb') as f:
+        f.write(os.urandom(size))
+    return pth
+
+## Frames of an encrypted stream (pad ID, offset, length)
+def frames(data):
+    frames = []
+    pos = len(otpsync.OTP_MAGIC)
+    while pos < len(data):
+        pid, offset, n = otpsync.OTP_FRAME.unpack_from(data,pos)
+        frames.append((pid,offset,n))
+        pos += otpsync.OTP_FRAME.size+n
+    return frames
+
+## Claim and use pad bytes with an index of its own (run in a separate process); returns the used ranges
+def claimer(conf,folder,ID,rounds,seed):
+    import random
+    rnd = random.Random(seed)
+    book = otpsync.padbook(conf,folder)
+    used = []
+    for i in range(rounds):
+        claim = book.claim(ID,rnd.randint(1,3000))
+        if claim == None:
+            break
+        pid, start, end = claim
+        ## Use part of the claim and hand back the tail (or use all of it)
+        pos = rnd.randint(start+1,end) if rnd.random() < 0.5 else end
+        used.append((pid,start,pos))
+        book.release(pid,pos,end)
+    return used
+
+
+class padtest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pads = os.path.join(self.tmp,'pads')
+        os.mkdir(self.pads)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def book(self,name='conf'):
+        return otpsync.padbook(os.path.join(self.tmp,name),self.pads)
+
+    def encrypt(self,book,data,ID='alice'):
+        out = io.BytesIO()
+        n = otpsync.otp_encrypt(io.BytesIO(data),out,book,ID)
+        self.assertEqual(n,len(data))
+        return out.getvalue()
+
+    def decrypt(self,book,data):
+        out = io.BytesIO()
+        otpsync.otp_decrypt(io.BytesIO(data),out,book)
+        return out.getvalue()
+
+    def test_round_trip(self):
+        make_pad(self.pads,'alice',1 << 20)
+        data = os.urandom(3*otpsync.OTP_BLOCK+123)
+        sealed = self.encrypt(self.book(),data)
+        self.assertEqual(sealed[:len(otpsync.OTP_MAGIC)],otpsync.OTP_MAGIC)
+        self.assertNotEqual(sealed[-len(data):],data)
+        ## Another client decrypts with its own index of the same pads
+        self.assertEqual(self.decrypt(self.book('other'),sealed),data)
+
+    def test_framing(self):
+        ## Two pads: the frames continue on the second one once the first is used up
+        first = make_pad(self.pads,'alice',otpsync.PAD_IDLEN+5000,'01-01-2000_00-00-00')
+        second = make_pad(self.pads,'alice',1 << 20,'02-01-2000_00-00-00')
+        ids = {}
+        for pth in [first,second]:
+            with open(pth,'rb') as f:
+                ids[otpsync.pad_id(f.read(otpsync.PAD_IDLEN))] = pth
+        book = self.book()
+        data = os.urandom(2*otpsync.OTP_BLOCK)
+        sealed = self.encrypt(book,data)
+        fs = frames(sealed)
+        self.assertEqual(sum(n for pid, offset, n in fs),len(data))
+        self.assertEqual([ids[pid] for pid, offset, n in fs][0],first)
+        self.assertEqual([ids[pid] for pid, offset, n in fs][-1],second)
+        ## Frames are contiguous within a pad, never start in the reserved ID bytes and never pass the end of a pad
+        ends = {}
+        for pid, offset, n in fs:
+            self.assertGreaterEqual(offset,otpsync.PAD_IDLEN)
+            self.assertLessEqual(n,otpsync.OTP_BLOCK)
+            self.assertLessEqual(offset+n,os.path.getsize(ids[pid]))
+            self.assertEqual(offset,ends.get(pid,otpsync.PAD_IDLEN))
+            ends[pid] = offset+n
+        self.assertEqual(ends[fs[0][0]],otpsync.PAD_IDLEN+5000)
+        self.assertEqual(self.decrypt(book,sealed),data)
+        ## The next encryption starts behind the last frame
+        more = frames(self.encrypt(book,b'x'*10))
+        self.assertEqual(more,[(fs[-1][0],fs[-1][1]+fs[-1][2],10)])
+
+    def test_exhaustion(self):
+        make_pad(self.pads,'alice',otpsync.PAD_IDLEN+1000)
+        book = self.book()
+        sealed = self.encrypt(book,os.urandom(1000))
+        with self.assertRaises(SystemExit):
+            self.encrypt(book,b'x')
+        ## Pads of other clients are not used either
+        make_pad(self.pads,'bob',1 << 16)
+        book.refresh(True)
+        with self.assertRaises(SystemExit):
+            self.encrypt(book,b'x')
+        self.assertEqual(book.remaining('alice'),0)
+        self.assertEqual(len(frames(sealed)),1)
+
+    def test_concurrent_claims(self):
+        make_pad(self.pads,'alice',otpsync.PAD_IDLEN+200000,'01-01-2000_00-00-00')
+        make_pad(self.pads,'alice',otpsync.PAD_IDLEN+200000,'02-01-2000_00-00-00')
+        ## Processes with indexes in different CONF folders that share the pad folder
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(4) as pool:
+            jobs = [pool.apply_async(claimer,(os.path.join(self.tmp,'conf'+str(i)),self.pads,'alice',200,i))
+                    for i in range(4)]
+            used = [r for job in jobs for r in job.get(60)]
+        self.assertGreater(len(used),400)
+        by_pad = {}
+        for pid, start, end in used:
+            self.assertGreaterEqual(start,otpsync.PAD_IDLEN)
+            by_pad.setdefault(pid,[]).append((start,end))
+        for ranges in by_pad.values():
+            ranges.sort()
+            for (s1, e1), (s2, e2) in zip(ranges,ranges[1:]):
+                self.assertLessEqual(e1,s2)
+        ## A new index never hands out bytes used by any of them
+        claim = self.book('fresh').claim('alice',1)
+        if claim != None:
+            self.assertTrue(all(claim[1] >= e for s, e in by_pad.get(claim[0],[])))
+
+    def test_retired_tail(self):
+        make_pad(self.pads,'alice',otpsync.PAD_IDLEN+1000)
+        book = self.book()
+        pid, start, end = book.claim('alice',5000)
+        self.assertEqual((start,end),(otpsync.PAD_IDLEN,otpsync.PAD_IDLEN+1000))
+        ## Claimed up to the end: the pad is retired
+        self.assertEqual(book.claim('alice',1),None)
+        self.assertEqual(book.pads[pid].state,'retired')
+        ## The unused tail comes back: the pad is used again, behind the used part only
+        book.release(pid,otpsync.PAD_IDLEN+400,end)
+        self.assertEqual(book.pads[pid].state,'active')
+        self.assertEqual(book.claim('alice',5000),(pid,otpsync.PAD_IDLEN+400,end))
+        book.release(pid,end,end)
+        self.assertEqual(book.claim('alice',1),None)
+        self.assertEqual(self.book('other').claim('alice',1),None)
+
+    def test_spare_tail(self):
+        make_pad(self.pads,'alice',otpsync.PAD_IDLEN+1000)
+        a = self.book('a')
+        b = self.book('b')
+        pid, a_start, a_end = a.claim('alice',500)
+        pid, b_start, b_end = b.claim('alice',5000)
+        self.assertEqual(b_start,a_end)
+        self.assertEqual(b.claim('alice',1),None)
+        self.assertEqual(b.pads[pid].state,'retired')
+        ## The tail of a is behind the claim of b: a keeps it and uses it next, though the pad is retired
+        a.release(pid,a_start+100,a_end)
+        self.assertEqual(a.claim('alice',1000),(pid,a_start+100,a_end))
+        a.release(pid,a_end,a_end)
+        b.release(pid,b_end,b_end)
+        for book in [a,b,self.book('c')]:
+            self.assertEqual(book.claim('alice',1),None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+##
+## Tests of the S3 store against the in-memory stand-in (tests/s3server.py)
+##
+## Run as >> python3 -m pytest tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import otpsync
+from s3server import s3server, ACCESSKEY, SECRETKEY
+
+
+class s3storetest(unittest.TestCase):
+
+    failure = 0.0
+
+    def setUp(self):
+        self.server = s3server(failure=self.failure).start()
+        self.config = {'ENDPOINT':self.server.endpoint(),'REGION':'us-east-1','ACCESSKEY':ACCESSKEY,'SECRETKEY':SECRETKEY}
+        self.store = otpsync.open_store('s3://bucket/otp/','group',self.config)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_put_get(self):
+        self.store.put('safe.info',b'GEN = 1\n')
+        self.assertEqual(self.store.read('safe.info'),b'GEN = 1\n')
+        self.assertEqual(self.store.stat('safe.info').size,8)
+        self.assertEqual(self.store.read_range('safe.info',4,3),b'= 1')
+        self.assertIn('otp/group/safe.info',self.server.objects)
+        self.store.delete('safe.info')
+        self.assertEqual(self.store.read('safe.info'),None)
+        self.assertEqual(self.store.stat('safe.info'),None)
+
+    def test_list(self):
+        for name in ['a','b','c','d','objects/x.otp','log/c1/00000001.otp']:
+            self.store.put(name,name.encode())
+        self.assertEqual(self.store.list(),['a','b','c','d','log','objects'])
+        self.assertEqual(self.store.list('log/c1'),['00000001.otp'])
+
+    def test_multipart(self):
+        data = os.urandom(2*otpsync.S3_PART+12345)
+        self.store.put('safe.otpc',data)
+        self.assertEqual(self.server.counts.get('multipart'),1)
+        self.assertEqual(self.store.read('safe.otpc'),data)
+        with self.store.open('safe.otpc') as f:
+            self.assertEqual(f.read(),data)
+        self.assertEqual(self.store.read_range('safe.otpc',otpsync.S3_PART-10,20),data[otpsync.S3_PART-10:otpsync.S3_PART+10])
+
+    def test_publish(self):
+        self.assertTrue(self.store.publish('log/c1/00000001.otp',b'one'))
+        self.assertFalse(self.store.publish('log/c1/00000001.otp',b'two'))
+        self.assertEqual(self.store.read('log/c1/00000001.otp'),b'one')
+
+    def test_writer(self):
+        with self.store.writer() as out:
+            out.write('objects/x.otp',b'chunk')
+            with out.open('safe.info','w') as f:
+                f.write('GEN = 2\n')
+        self.assertEqual(self.store.read('objects/x.otp'),b'chunk')
+        self.assertEqual(self.store.read('safe.info'),b'GEN = 2\n')
+
+    def test_wrong_secret(self):
+        config = dict(self.config,SECRETKEY='wrong')
+        store = otpsync.open_store('s3://bucket/otp/','group',config)
+        with self.assertRaises(SystemExit):
+            store.put('safe.info',b'GEN = 1\n')
+        self.assertGreater(self.server.counts.get('denied',0),0)
+        self.assertNotIn('otp/group/safe.info',self.server.objects)
+
+
+## Same operations while a fifth of the requests fail (retried with backoff)
+class s3retrytest(s3storetest):
+
+    failure = 0.2
+
+
+if __name__ == '__main__':
+    unittest.main()